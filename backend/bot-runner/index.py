@@ -133,7 +133,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         # Update bot status
         new_status = 'active' if action == 'activate' else 'inactive'
-        update_query = f"UPDATE bots SET status = '{new_status}', updated_at = CURRENT_TIMESTAMP WHERE id = {bot_id} RETURNING *"
+        update_query = f"UPDATE bots SET status = '{new_status}', updated_at = CURRENT_TIMESTAMP, config_version = config_version + 1 WHERE id = {bot_id} RETURNING *"
         cursor.execute(update_query)
         updated_bot = cursor.fetchone()
         conn.commit()
@@ -342,6 +342,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         update_parts.append("updated_at = CURRENT_TIMESTAMP")
+        update_parts.append("config_version = config_version + 1")
         update_clause = ", ".join(update_parts)
         
         query = f"UPDATE t_p5255237_telegram_bot_service.bots SET {update_clause} WHERE id = {bot_id} RETURNING *"
@@ -0,0 +1,566 @@
+import json
+import os
+import asyncio
+import socket
+import time
+import uuid
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import (
+    TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.methods import TelegramMethod
+
+# Сегменты получателей: условие на bot_users (алиас bu)
+SEGMENT_FILTERS = {
+    'all': 'TRUE',
+    'free_qr': 'bu.received_free_qr = TRUE',
+    'vip_qr': 'bu.received_vip_qr = TRUE',
+    'no_vip': 'bu.received_vip_qr IS NOT TRUE'
+}
+
+# Получатели читаются страницами; после каждой страницы сохраняется контрольная точка
+BROADCAST_PAGE_SIZE = int(os.environ.get('BROADCAST_PAGE_SIZE', '100'))
+# Одновременных отправок; реальную скорость держит telegram_rate_limiter
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '25'))
+# Сколько секунд один вызов рассылает (вызывается по расписанию раз в минуту)
+BROADCAST_TIME_BUDGET = float(os.environ.get('BROADCAST_TIME_BUDGET', '50'))
+# Рассылка в статусе running без контрольной точки дольше этого времени подхватывается другим вызовом
+BROADCAST_STALE_AFTER = int(os.environ.get('BROADCAST_STALE_AFTER', '180'))
+BROADCAST_MAX_TEXT_LENGTH = 4096
+# Попыток доставки одному получателю при временных ошибках (429 после повторов лимитера, 5xx, сеть)
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get('BROADCAST_MAX_ATTEMPTS', '3'))
+# Через сколько секунд после временной ошибки получателю пробуем отправить снова
+BROADCAST_RETRY_DELAY = int(os.environ.get('BROADCAST_RETRY_DELAY', '60'))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class TokenBucket:
+    '''Корзина токенов; токены можно занимать в долг - долг и есть очередь ожидающих отправок'''
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self) -> float:
+        '''Занять токен и вернуть, сколько секунд ждать его появления (FIFO без блокировок)'''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def is_idle(self) -> bool:
+        '''Корзина снова полная - ее можно выбросить без потери ограничения'''
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+# Урезанная версия лимитера из telegram-bot-engine: получатели рассылки - только личные чаты, по одному
+# сообщению на каждого, поэтому корзины на чат и группу не нужны, а у корзины бота нет запаса на всплеск
+class TelegramRateLimiter:
+    '''Ограничение скорости отправки одного бота; на 429 весь бот ждет retry_after'''
+    
+    def __init__(self, bot_rate: float = 30.0, max_retries: int = 3, max_wait: float = 30.0):
+        self.bot_rate = bot_rate
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self._bot_buckets: Dict[int, TokenBucket] = {}
+        self._paused_until: Dict[int, float] = {}
+        self.stats = {'queued': 0, 'sent': 0, 'throttled': 0, 'dropped': 0}
+    
+    def _reserve(self, bot_id: int) -> float:
+        bucket = self._bot_buckets.get(bot_id)
+        if bucket is None:
+            # Без запаса на всплеск: рассылка сразу идет на пределе и не должна его превышать
+            bucket = self._bot_buckets[bot_id] = TokenBucket(self.bot_rate, 1)
+        return max(bucket.reserve(), self._paused_until.get(bot_id, 0.0) - time.monotonic())
+    
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        for attempt in range(self.max_retries + 1):
+            delay = self._reserve(bot.id)
+            if delay > 0:
+                self.stats['queued'] += 1
+                await asyncio.sleep(delay)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats['throttled'] += 1
+                self._paused_until[bot.id] = max(self._paused_until.get(bot.id, 0.0), time.monotonic() + e.retry_after)
+                if attempt == self.max_retries or e.retry_after > self.max_wait:
+                    self.stats['dropped'] += 1
+                    raise
+                continue
+            self.stats['sent'] += 1
+            return result
+
+# Каждый получатель рассылки - отдельный личный чат, поэтому упираемся только в лимит бота
+telegram_rate_limiter = TelegramRateLimiter(
+    bot_rate=float(os.environ.get('TELEGRAM_BOT_RATE', '30')),
+    max_wait=float(os.environ.get('TELEGRAM_MAX_RETRY_WAIT', '30'))
+)
+
+class PooledConnection:
+    '''Соединение, выданное пулом: close() возвращает его в пул вместо закрытия'''
+    
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            self._pool.putconn(self)
+            self._conn = None
+
+class ConnectionPool:
+    '''Пул соединений с PostgreSQL, который переживает тёплые вызовы функции'''
+    
+    def __init__(self, max_size: int = 5, health_check_after: float = 30.0):
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._in_use: Dict[int, PooledConnection] = {}
+        self._lock = threading.Lock()
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0, 'health_checks': 0}
+    
+    def _connect(self):
+        database_url = os.environ.get('DATABASE_URL', '')
+        if not database_url:
+            raise ValueError('DATABASE_URL not configured')
+        self.stats['connects'] += 1
+        return psycopg2.connect(database_url)
+    
+    def _discard(self, conn) -> None:
+        self.stats['discards'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        self.stats['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self) -> PooledConnection:
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if self._is_healthy(conn, released_at):
+                    self.stats['reuses'] += 1
+                    pooled = PooledConnection(self, conn)
+                    self._in_use[id(conn)] = pooled
+                    return pooled
+                self._discard(conn)
+            
+            if len(self._in_use) >= self.max_size:
+                raise Exception(f'Connection pool exhausted (max_size={self.max_size})')
+            
+            conn = self._connect()
+            pooled = PooledConnection(self, conn)
+            self._in_use[id(conn)] = pooled
+            return pooled
+    
+    def putconn(self, pooled: PooledConnection) -> None:
+        conn = pooled._conn
+        with self._lock:
+            if self._in_use.get(id(conn)) is not pooled:
+                return
+            del self._in_use[id(conn)]
+            try:
+                # Завершаем незакрытую транзакцию, чтобы следующий запрос начал с чистого состояния
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            if conn.closed or len(self._idle) >= self.max_size:
+                self._discard(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+    
+    def release_all(self) -> None:
+        '''Вернуть в пул соединения, которые не были закрыты в ходе запроса'''
+        for pooled in list(self._in_use.values()):
+            pooled.close()
+
+db_pool = ConnectionPool(max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')))
+
+def get_db_connection() -> PooledConnection:
+    '''Выдает подключение к базе данных из пула'''
+    return db_pool.getconn()
+
+def json_response(status_code: int, data: Dict) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(data, default=str),
+        'isBase64Encoded': False
+    }
+
+def get_owned_bot(cursor, bot_id: int, user_id: int) -> Optional[Dict]:
+    '''Бот, если он принадлежит пользователю'''
+    cursor.execute(f'''SELECT id, name FROM t_p5255237_telegram_bot_service.bots
+                      WHERE id = {bot_id} AND user_id = {user_id}''')
+    return cursor.fetchone()
+
+def create_broadcast(conn, bot_id: int, user_id: int, text: str, segment: str) -> Dict:
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    text_escaped = text.replace("'", "''")
+    cursor.execute(f'''INSERT INTO t_p5255237_telegram_bot_service.broadcasts
+                      (bot_id, message_text, segment, created_by)
+                      VALUES ({bot_id}, '{text_escaped}', '{segment}', {user_id})
+                      RETURNING id, bot_id, segment, status, created_at''')
+    broadcast = cursor.fetchone()
+    conn.commit()
+    cursor.close()
+    return broadcast
+
+def claim_broadcast(conn) -> Optional[Dict]:
+    '''Взять одну незавершенную рассылку; брошенная упавшим вызовом подхватывается с контрольной точки'''
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    worker_escaped = WORKER_ID.replace("'", "''")
+    cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.broadcasts
+                      SET status = 'running', locked_by = '{worker_escaped}', locked_at = CURRENT_TIMESTAMP,
+                          started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+                      WHERE id = (
+                          SELECT id FROM t_p5255237_telegram_bot_service.broadcasts
+                          WHERE status = 'pending'
+                             OR (status = 'running' AND locked_at < CURRENT_TIMESTAMP - INTERVAL '{BROADCAST_STALE_AFTER} seconds')
+                          ORDER BY id
+                          LIMIT 1
+                          FOR UPDATE SKIP LOCKED
+                      )
+                      RETURNING id, bot_id, message_text, segment, last_user_id''')
+    broadcast = cursor.fetchone()
+    if broadcast:
+        cursor.execute(f'''SELECT telegram_token FROM t_p5255237_telegram_bot_service.bots
+                          WHERE id = {broadcast['bot_id']}''')
+        bot = cursor.fetchone()
+        broadcast['telegram_token'] = bot['telegram_token'] if bot else None
+    conn.commit()
+    cursor.close()
+    return broadcast
+
+def fetch_recipients(conn, broadcast: Dict, after_user_id: int) -> List[Dict]:
+    '''Следующая страница получателей (keyset по bot_users.id); уже обработанные пропускаются'''
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    segment_filter = SEGMENT_FILTERS.get(broadcast['segment'], 'TRUE')
+    cursor.execute(f'''SELECT bu.id, bu.telegram_user_id
+                      FROM t_p5255237_telegram_bot_service.bot_users bu
+                      WHERE bu.bot_id = {broadcast['bot_id']} AND bu.id > {after_user_id}
+                        AND bu.is_blocked IS NOT TRUE AND {segment_filter}
+                        AND NOT EXISTS (
+                            SELECT 1 FROM t_p5255237_telegram_bot_service.broadcast_deliveries d
+                            WHERE d.broadcast_id = {broadcast['id']} AND d.user_id = bu.id
+                        )
+                      ORDER BY bu.id
+                      LIMIT {BROADCAST_PAGE_SIZE}''')
+    recipients = cursor.fetchall()
+    conn.commit()
+    cursor.close()
+    return recipients
+
+def fetch_retries(conn, broadcast: Dict) -> List[Dict]:
+    '''Следующая страница получателей, которым пора повторить отправку после временной ошибки'''
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(f'''SELECT bu.id, bu.telegram_user_id, d.attempts
+                      FROM t_p5255237_telegram_bot_service.broadcast_deliveries d
+                      JOIN t_p5255237_telegram_bot_service.bot_users bu ON bu.id = d.user_id
+                      WHERE d.broadcast_id = {broadcast['id']} AND d.status = 'retry'
+                        AND d.sent_at < CURRENT_TIMESTAMP - INTERVAL '{BROADCAST_RETRY_DELAY} seconds'
+                      ORDER BY d.user_id
+                      LIMIT {BROADCAST_PAGE_SIZE}''')
+    recipients = cursor.fetchall()
+    conn.commit()
+    cursor.close()
+    return recipients
+
+def has_retries(conn, broadcast_id: int) -> bool:
+    cursor = conn.cursor()
+    cursor.execute(f'''SELECT EXISTS (
+                          SELECT 1 FROM t_p5255237_telegram_bot_service.broadcast_deliveries
+                          WHERE broadcast_id = {broadcast_id} AND status = 'retry'
+                      )''')
+    pending = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    return pending
+
+async def deliver(bot: Bot, semaphore: asyncio.Semaphore, text: str, recipient: Dict) -> Tuple[int, str, Optional[str]]:
+    '''Отправить сообщение одному получателю: (user_id, статус, ошибка)'''
+    async with semaphore:
+        try:
+            await bot.send_message(chat_id=recipient['telegram_user_id'], text=text)
+            return recipient['id'], 'sent', None
+        except TelegramForbiddenError as e:
+            return recipient['id'], 'blocked', str(e)[:500]
+        except (TelegramRetryAfter, TelegramServerError, TelegramNetworkError) as e:
+            # Временная ошибка: получатель попадет в повторный проход, пока не кончатся попытки
+            final = recipient.get('attempts', 0) + 1 >= BROADCAST_MAX_ATTEMPTS
+            return recipient['id'], 'failed' if final else 'retry', str(e)[:500]
+        except Exception as e:
+            return recipient['id'], 'failed', str(e)[:500]
+
+def save_page(conn, broadcast_id: int, last_user_id: int, results: List[Tuple[int, str, Optional[str]]]) -> str:
+    '''Записать результаты страницы и контрольную точку одной транзакцией; возвращает текущий статус рассылки'''
+    cursor = conn.cursor()
+    execute_values(
+        cursor,
+        '''INSERT INTO t_p5255237_telegram_bot_service.broadcast_deliveries (broadcast_id, user_id, status, error)
+           VALUES %s
+           ON CONFLICT (broadcast_id, user_id) DO UPDATE
+           SET status = EXCLUDED.status, error = EXCLUDED.error,
+               attempts = broadcast_deliveries.attempts + 1, sent_at = CURRENT_TIMESTAMP
+           WHERE broadcast_deliveries.status = 'retry' ''',
+        [(broadcast_id, user_id, status, error) for user_id, status, error in results]
+    )
+    blocked_ids = [user_id for user_id, status, _ in results if status == 'blocked']
+    if blocked_ids:
+        cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.bot_users
+                          SET is_blocked = TRUE, blocked_at = CURRENT_TIMESTAMP
+                          WHERE id IN ({', '.join(str(user_id) for user_id in blocked_ids)})''')
+    sent = sum(1 for _, status, _ in results if status == 'sent')
+    failed = sum(1 for _, status, _ in results if status == 'failed')
+    cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.broadcasts
+                      SET last_user_id = GREATEST(last_user_id, {last_user_id}),
+                          sent_count = sent_count + {sent}, failed_count = failed_count + {failed},
+                          blocked_count = blocked_count + {len(blocked_ids)},
+                          locked_at = CURRENT_TIMESTAMP
+                      WHERE id = {broadcast_id}
+                      RETURNING status''')
+    status = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    return status
+
+def finish_broadcast(conn, broadcast_id: int, status: str) -> None:
+    cursor = conn.cursor()
+    cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.broadcasts
+                      SET status = '{status}', finished_at = CURRENT_TIMESTAMP, locked_by = NULL, locked_at = NULL
+                      WHERE id = {broadcast_id} AND status = 'running' ''')
+    conn.commit()
+    cursor.close()
+
+def release_broadcast(conn, broadcast_id: int) -> None:
+    '''Время вызова вышло: отдать рассылку следующему вызову, продолжит с контрольной точки'''
+    cursor = conn.cursor()
+    cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.broadcasts
+                      SET status = 'pending', locked_by = NULL, locked_at = NULL
+                      WHERE id = {broadcast_id} AND status = 'running' ''')
+    conn.commit()
+    cursor.close()
+
+def defer_broadcast(conn, broadcast_id: int) -> None:
+    '''Остались только повторы, которым еще рано: рассылку подхватит как брошенную через BROADCAST_STALE_AFTER'''
+    cursor = conn.cursor()
+    cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.broadcasts
+                      SET locked_by = NULL, locked_at = CURRENT_TIMESTAMP
+                      WHERE id = {broadcast_id} AND status = 'running' ''')
+    conn.commit()
+    cursor.close()
+
+async def run_broadcast(conn, broadcast: Dict, deadline: float) -> Dict[str, int]:
+    '''Рассылать страницами до конца списка или до истечения времени вызова'''
+    stats = {'sent': 0, 'failed': 0, 'blocked': 0, 'retry': 0}
+    if not broadcast['telegram_token']:
+        finish_broadcast(conn, broadcast['id'], 'canceled')
+        return stats
+    
+    session = AiohttpSession()
+    session.middleware(telegram_rate_limiter)
+    bot = Bot(token=broadcast['telegram_token'], session=session)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_user_id = broadcast['last_user_id']
+    try:
+        while True:
+            if time.monotonic() >= deadline:
+                release_broadcast(conn, broadcast['id'])
+                break
+            recipients = fetch_recipients(conn, broadcast, last_user_id)
+            if recipients:
+                last_user_id = recipients[-1]['id']
+            else:
+                # Список пройден до конца: повторяем отправку тем, кому помешала временная ошибка
+                recipients = fetch_retries(conn, broadcast)
+            if not recipients:
+                if has_retries(conn, broadcast['id']):
+                    defer_broadcast(conn, broadcast['id'])
+                else:
+                    finish_broadcast(conn, broadcast['id'], 'done')
+                break
+            
+            results = await asyncio.gather(*(
+                deliver(bot, semaphore, broadcast['message_text'], recipient) for recipient in recipients
+            ))
+            for _, status, _ in results:
+                stats[status] += 1
+            
+            if save_page(conn, broadcast['id'], last_user_id, results) == 'canceled':
+                break
+    finally:
+        await session.close()
+    
+    print(f"[BROADCAST {broadcast['id']}] sent={stats['sent']} failed={stats['failed']} blocked={stats['blocked']} retry={stats['retry']} checkpoint={last_user_id}")
+    return stats
+
+def process_broadcasts(time_budget: float) -> Dict[str, int]:
+    '''Разбирать рассылки, пока есть незавершенные и не вышло время вызова'''
+    deadline = time.monotonic() + time_budget
+    totals = {'broadcasts': 0, 'sent': 0, 'failed': 0, 'blocked': 0, 'retry': 0}
+    conn = get_db_connection()
+    try:
+        while time.monotonic() < deadline:
+            broadcast = claim_broadcast(conn)
+            if not broadcast:
+                break
+            totals['broadcasts'] += 1
+            stats = asyncio.run(run_broadcast(conn, broadcast, deadline))
+            for key, value in stats.items():
+                totals[key] += value
+    finally:
+        conn.close()
+    return totals
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Bot owner broadcasts - create, list and cancel broadcasts; scheduled processing sends them at Telegram's safe rate
+    Args: event - GET ?bot_id= (list); POST {action: create|cancel|process}; X-User-Id header identifies the owner
+          context - cloud function context
+    Returns: HTTP response with broadcasts or processing stats
+    '''
+    # Соединения, не возвращенные прошлым вызовом (ранний return или исключение), возвращаем в пул
+    db_pool.release_all()
+    
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    
+    if method == 'GET':
+        try:
+            user_id = int(headers.get('x-user-id', ''))
+        except ValueError:
+            return json_response(401, {'error': 'X-User-Id header is required'})
+        params = event.get('queryStringParameters') or {}
+        try:
+            bot_id = int(params.get('bot_id', ''))
+        except ValueError:
+            return json_response(400, {'error': 'bot_id parameter is required'})
+        
+        conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        if not get_owned_bot(cursor, bot_id, user_id):
+            cursor.close()
+            conn.close()
+            return json_response(404, {'error': 'Bot not found'})
+        cursor.execute(f'''SELECT id, bot_id, segment, status, sent_count, failed_count, blocked_count,
+                                 created_at, started_at, finished_at, LEFT(message_text, 200) AS message_preview
+                          FROM t_p5255237_telegram_bot_service.broadcasts
+                          WHERE bot_id = {bot_id}
+                          ORDER BY created_at DESC
+                          LIMIT 50''')
+        broadcasts = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return json_response(200, {'broadcasts': broadcasts, 'total': len(broadcasts)})
+    
+    if method != 'POST':
+        return json_response(405, {'error': 'Method not allowed'})
+    
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return json_response(400, {'error': 'Invalid JSON'})
+    action = body.get('action', 'process')
+    
+    if action == 'process':
+        time_budget = min(float(body.get('time_budget', BROADCAST_TIME_BUDGET)), BROADCAST_TIME_BUDGET)
+        totals = process_broadcasts(time_budget)
+        return json_response(200, {
+            'message': 'Broadcasts processed',
+            **totals,
+            'telegram_rate_limiter': telegram_rate_limiter.stats
+        })
+    
+    try:
+        user_id = int(headers.get('x-user-id', ''))
+    except ValueError:
+        return json_response(401, {'error': 'X-User-Id header is required'})
+    
+    if action == 'create':
+        text = (body.get('text') or '').strip()
+        segment = body.get('segment', 'all')
+        try:
+            bot_id = int(body.get('bot_id', ''))
+        except (TypeError, ValueError):
+            return json_response(400, {'error': 'bot_id is required'})
+        if not text or len(text) > BROADCAST_MAX_TEXT_LENGTH:
+            return json_response(400, {'error': f'text is required and must be at most {BROADCAST_MAX_TEXT_LENGTH} characters'})
+        if segment not in SEGMENT_FILTERS:
+            return json_response(400, {'error': f"segment must be one of: {', '.join(SEGMENT_FILTERS)}"})
+        
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            bot = get_owned_bot(cursor, bot_id, user_id)
+            cursor.close()
+            if not bot:
+                return json_response(404, {'error': 'Bot not found'})
+            broadcast = create_broadcast(conn, bot_id, user_id, text, segment)
+        finally:
+            conn.close()
+        return json_response(201, {'broadcast': broadcast})
+    
+    if action == 'cancel':
+        try:
+            broadcast_id = int(body.get('broadcast_id', ''))
+        except (TypeError, ValueError):
+            return json_response(400, {'error': 'broadcast_id is required'})
+        
+        conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # Идущая рассылка остановится после текущей страницы
+        cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.broadcasts br
+                          SET status = 'canceled', finished_at = CURRENT_TIMESTAMP
+                          FROM t_p5255237_telegram_bot_service.bots b
+                          WHERE br.id = {broadcast_id} AND br.bot_id = b.id AND b.user_id = {user_id}
+                            AND br.status IN ('pending', 'running')
+                          RETURNING br.id''')
+        canceled = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+        conn.close()
+        if not canceled:
+            return json_response(404, {'error': 'Active broadcast not found'})
+        return json_response(200, {'message': 'Broadcast canceled', 'broadcast_id': broadcast_id})
+    
+    return json_response(400, {'error': f'Unknown action: {action}'})
@@ -0,0 +1,142 @@
+'''
+Замер cold start импорта backend-функций и проверка бюджета.
+
+Для каждой функции backend/<name>/index.py несколько раз запускается чистый интерпретатор, который
+импортирует index из каталога функции - так же, как это делает платформа при холодном старте.
+Берется медиана времени импорта; из вывода python -X importtime выбираются самые тяжелые модули.
+Бюджеты в миллисекундах задаются в cold_start_budget.json (default_ms и переопределения по функциям).
+
+Код выхода 1, если хоть одна функция превысила бюджет или не импортируется. Функции с неустановленными
+зависимостями по --skip-missing пропускаются (для локального запуска без requirements.txt).
+
+Запуск: python backend/cold_start_check.py --runs 5 [--only telegram-webhook] [--json]
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BUDGET_FILE = os.path.join(BACKEND_DIR, 'cold_start_budget.json')
+
+# Время меряется внутри дочернего процесса, чтобы не учитывать запуск самого интерпретатора
+IMPORT_SNIPPET = (
+    'import time, sys\n'
+    'started = time.perf_counter()\n'
+    'import index\n'
+    'sys.stdout.write(str((time.perf_counter() - started) * 1000))\n'
+)
+
+def discover_functions() -> List[str]:
+    return sorted(
+        name for name in os.listdir(BACKEND_DIR)
+        if os.path.isfile(os.path.join(BACKEND_DIR, name, 'index.py'))
+    )
+
+def load_budget(path: str) -> Dict[str, Any]:
+    with open(path, encoding='utf-8') as f:
+        budget = json.load(f)
+    budget.setdefault('functions', {})
+    return budget
+
+def parse_importtime(stderr: str, top: int) -> List[Dict[str, Any]]:
+    '''Разбирает вывод -X importtime и возвращает самые тяжелые модули, подключаемые напрямую из index'''
+    children: List[Dict[str, Any]] = []
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if not line.startswith('import time:') or len(parts) != 3 or 'self [us]' in line:
+            continue
+        try:
+            cumulative_us = int(parts[1])
+        except ValueError:
+            continue
+        # Глубина вложенности кодируется отступом: 1 пробел - верхний уровень, каждые 2 - следующий
+        depth = (len(parts[2]) - len(parts[2].lstrip(' ')) - 1) // 2
+        module = parts[2].strip()
+        if depth == 0:
+            # Дочерние модули печатаются раньше родителя: все накопленное до строки index - его импорты
+            if module == 'index':
+                break
+            children = []
+        elif depth == 1:
+            children.append({'module': module, 'ms': round(cumulative_us / 1000, 1)})
+    children.sort(key=lambda item: item['ms'], reverse=True)
+    return children[:top]
+
+def measure(name: str, runs: int, top: int) -> Dict[str, Any]:
+    function_dir = os.path.join(BACKEND_DIR, name)
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    timings: List[float] = []
+    heaviest: List[Dict[str, Any]] = []
+    for run in range(runs):
+        command = [sys.executable, '-c', IMPORT_SNIPPET]
+        # importtime замедляет импорт, поэтому включается только в первом прогоне и в медиану не идет
+        profile = run == 0
+        if profile:
+            command[1:1] = ['-X', 'importtime']
+        result = subprocess.run(command, cwd=function_dir, env=env, capture_output=True, text=True, timeout=120)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f'exit code {result.returncode}'
+            return {'function': name, 'error': error, 'missing': 'ModuleNotFoundError' in error}
+        if profile:
+            heaviest = parse_importtime(result.stderr, top)
+            if runs > 1:
+                continue
+        timings.append(float(result.stdout.strip()))
+    return {
+        'function': name,
+        'median_ms': round(statistics.median(timings), 1),
+        'max_ms': round(max(timings), 1),
+        'heaviest': heaviest
+    }
+
+def check(functions: List[str], budget: Dict[str, Any], runs: int, top: int, skip_missing: bool) -> Dict[str, Any]:
+    results = []
+    failed = False
+    for name in functions:
+        limit = budget['functions'].get(name, budget.get('default_ms', 500))
+        result = measure(name, runs, top)
+        result['budget_ms'] = limit
+        if 'error' in result:
+            result['status'] = 'skipped' if result['missing'] and skip_missing else 'error'
+        else:
+            result['status'] = 'ok' if result['median_ms'] <= limit else 'over'
+        failed = failed or result['status'] in ('error', 'over')
+        results.append(result)
+    return {'ok': not failed, 'runs': runs, 'results': results}
+
+def print_report(report: Dict[str, Any]) -> None:
+    for result in report['results']:
+        name = result['function']
+        if 'error' in result:
+            print(f"{result['status'].upper():7} {name}: {result['error']}")
+            continue
+        print(f"{result['status'].upper():7} {name}: {result['median_ms']} ms (max {result['max_ms']}, budget {result['budget_ms']})")
+        if result['status'] == 'over':
+            for module in result['heaviest']:
+                print(f"          {module['ms']:>8} ms  {module['module']}")
+    print('OK' if report['ok'] else 'FAIL')
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Cold start import time budget check')
+    parser.add_argument('--budget', default=DEFAULT_BUDGET_FILE)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5, help='сколько самых тяжелых модулей показывать')
+    parser.add_argument('--only', action='append', help='проверить только указанные функции')
+    parser.add_argument('--skip-missing', action='store_true', help='не считать ошибкой неустановленные зависимости')
+    parser.add_argument('--json', action='store_true', help='вывести отчет в JSON')
+    args = parser.parse_args(argv)
+    
+    functions = args.only or discover_functions()
+    report = check(functions, load_budget(args.budget), max(1, args.runs), args.top, args.skip_missing)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    return 0 if report['ok'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
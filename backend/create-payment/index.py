@@ -1,9 +1,13 @@
 import json
+import os
 import hashlib
 import urllib.request
 import urllib.error
 from typing import Dict, Any
 
+# Адрес tbank-notification: T-Bank сам сообщает о смене статуса, опрос GetState остается страховкой
+NOTIFICATION_URL = os.environ.get('TBANK_NOTIFICATION_URL', '')
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Create T-Bank payment with different methods (card, SBP, gift)
@@ -210,6 +214,8 @@ def create_card_payment(terminal_key: str, password: str, amount: int, order_id:
             ]
         }
     }
+    if NOTIFICATION_URL:
+        payload['NotificationURL'] = NOTIFICATION_URL
     
     token = generate_token(payload, password)
     payload['Token'] = token
@@ -250,6 +256,8 @@ def create_sbp_payment(terminal_key: str, password: str, amount: int,
         'Description': description,
         'PayType': 'T'
     }
+    if NOTIFICATION_URL:
+        payload['NotificationURL'] = NOTIFICATION_URL
     
     token = generate_token(payload, password)
     payload['Token'] = token
@@ -321,6 +329,8 @@ def create_tpay_payment(terminal_key: str, password: str, amount: int,
         'OrderId': order_id,
         'Description': description
     }
+    if NOTIFICATION_URL:
+        payload['NotificationURL'] = NOTIFICATION_URL
     
     token = generate_token(payload, password)
     payload['Token'] = token
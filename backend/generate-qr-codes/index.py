@@ -1,15 +1,119 @@
 import json
 import os
-from typing import Dict, Any
+import time
+import threading
+from typing import Dict, Any, List, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
-def get_db_connection():
-    '''Создает подключение к базе данных'''
-    database_url = os.environ.get('DATABASE_URL', '')
-    if not database_url:
-        raise ValueError('DATABASE_URL not configured')
-    return psycopg2.connect(database_url)
+# Функции деплоятся по отдельности, и по умолчанию у каждой свой /tmp/qr-cache: заранее отрисованные job-worker
+# картинки видны отправляющим функциям, только если QR_CACHE_DIR задан как общий каталог во всех трех
+QR_PRERENDER_ENABLED = (
+    bool(os.environ.get('QR_CACHE_DIR'))
+    and os.environ.get('QR_PRERENDER_ENABLED', 'true').lower() == 'true'
+)
+
+class PooledConnection:
+    '''Соединение, выданное пулом: close() возвращает его в пул вместо закрытия'''
+    
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            self._pool.putconn(self)
+            self._conn = None
+
+class ConnectionPool:
+    '''Пул соединений с PostgreSQL, который переживает тёплые вызовы функции'''
+    
+    def __init__(self, max_size: int = 5, health_check_after: float = 30.0):
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._in_use: Dict[int, PooledConnection] = {}
+        self._lock = threading.Lock()
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0, 'health_checks': 0}
+    
+    def _connect(self):
+        database_url = os.environ.get('DATABASE_URL', '')
+        if not database_url:
+            raise ValueError('DATABASE_URL not configured')
+        self.stats['connects'] += 1
+        return psycopg2.connect(database_url)
+    
+    def _discard(self, conn) -> None:
+        self.stats['discards'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        self.stats['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self) -> PooledConnection:
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if self._is_healthy(conn, released_at):
+                    self.stats['reuses'] += 1
+                    pooled = PooledConnection(self, conn)
+                    self._in_use[id(conn)] = pooled
+                    return pooled
+                self._discard(conn)
+            
+            if len(self._in_use) >= self.max_size:
+                raise Exception(f'Connection pool exhausted (max_size={self.max_size})')
+            
+            conn = self._connect()
+            pooled = PooledConnection(self, conn)
+            self._in_use[id(conn)] = pooled
+            return pooled
+    
+    def putconn(self, pooled: PooledConnection) -> None:
+        conn = pooled._conn
+        with self._lock:
+            if self._in_use.get(id(conn)) is not pooled:
+                return
+            del self._in_use[id(conn)]
+            try:
+                # Завершаем незакрытую транзакцию, чтобы следующий запрос начал с чистого состояния
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            if conn.closed or len(self._idle) >= self.max_size:
+                self._discard(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+    
+    def release_all(self) -> None:
+        '''Вернуть в пул соединения, которые не были закрыты в ходе запроса'''
+        for pooled in list(self._in_use.values()):
+            pooled.close()
+
+db_pool = ConnectionPool(max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')))
+
+def get_db_connection() -> PooledConnection:
+    '''Выдает подключение к базе данных из пула'''
+    return db_pool.getconn()
 
 def generate_qr_codes_for_bot(bot_id: int, free_count: int, paid_count: int) -> Dict[str, int]:
     '''Генерирует QR-коды для бота'''
@@ -47,6 +151,12 @@ def generate_qr_codes_for_bot(bot_id: int, free_count: int, paid_count: int) ->
         cursor.execute(paid_query)
         paid_inserted = cursor.rowcount
     
+    # Картинки QR-кодов заранее рисует job-worker в общий QR_CACHE_DIR, чтобы выдача ключа не ждала отрисовки
+    if QR_PRERENDER_ENABLED and free_inserted + paid_inserted > 0:
+        cursor.execute(f'''INSERT INTO t_p5255237_telegram_bot_service.jobs (job_type, payload, dedup_key)
+                          VALUES ('prerender_qr', '{json.dumps({'bot_id': int(bot_id)})}'::jsonb, 'prerender_qr:{int(bot_id)}:0')
+                          ON CONFLICT (dedup_key) DO NOTHING''')
+    
     conn.commit()
     cursor.close()
     conn.close()
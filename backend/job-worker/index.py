@@ -0,0 +1,683 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from io import BytesIO
+import requests
+
+CHECK_PAYMENT_STATUS_URL = 'https://functions.poehali.dev/b4079ccb-abcb-4171-b656-2462d93e1ac9'
+
+# Статус платежа приходит уведомлением T-Bank (tbank-notification); опрос GetState - редкая страховка
+# на случай потерянного уведомления: по умолчанию через 1, 5 и 15 минут после создания
+CHECK_PAYMENT_DELAYS = [int(d) for d in os.environ.get('CHECK_PAYMENT_DELAYS', '60,300,900').split(',')]
+# Итоговые статусы, после которых опрашивать T-Bank больше незачем
+PAYMENT_FINAL_FAILED_STATUSES = ('REJECTED', 'CANCELED', 'DEADLINE_EXPIRED', 'REVERSED', 'REFUNDED')
+
+JOB_BATCH_SIZE = int(os.environ.get('JOB_WORKER_BATCH_SIZE', '10'))
+# Сколько секунд один вызов разбирает очередь (вызывается по расписанию раз в минуту)
+JOB_TIME_BUDGET = float(os.environ.get('JOB_WORKER_TIME_BUDGET', '50'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_WORKER_POLL_INTERVAL', '1'))
+# Задача в статусе running дольше этого времени считается брошенной и возвращается в очередь
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', '300'))
+JOB_RETRY_BASE_DELAY = int(os.environ.get('JOB_RETRY_BASE_DELAY', '10'))
+JOB_RETRY_MAX_DELAY = int(os.environ.get('JOB_RETRY_MAX_DELAY', '600'))
+# Сколько секунд одна задача prerender_qr рисует QR-коды; остаток продолжает следующая задача
+QR_PRERENDER_SLICE = float(os.environ.get('QR_PRERENDER_SLICE', '20'))
+QR_PRERENDER_BATCH = 1000
+# Заранее отрисованные PNG нужны telegram-bot-engine и telegram-webhook, поэтому рисуем только в общий каталог,
+# явно заданный в QR_CACHE_DIR; локальный /tmp/qr-cache по умолчанию у каждой функции свой
+QR_CACHE_SHARED = bool(os.environ.get('QR_CACHE_DIR'))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class PermanentJobError(Exception):
+    '''Ошибка, после которой повторять задачу бессмысленно'''
+
+class PooledConnection:
+    '''Соединение, выданное пулом: close() возвращает его в пул вместо закрытия'''
+    
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            self._pool.putconn(self)
+            self._conn = None
+
+class ConnectionPool:
+    '''Пул соединений с PostgreSQL, который переживает тёплые вызовы функции'''
+    
+    def __init__(self, max_size: int = 5, health_check_after: float = 30.0):
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._in_use: Dict[int, PooledConnection] = {}
+        self._lock = threading.Lock()
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0, 'health_checks': 0}
+    
+    def _connect(self):
+        database_url = os.environ.get('DATABASE_URL', '')
+        if not database_url:
+            raise ValueError('DATABASE_URL not configured')
+        self.stats['connects'] += 1
+        return psycopg2.connect(database_url)
+    
+    def _discard(self, conn) -> None:
+        self.stats['discards'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        self.stats['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self) -> PooledConnection:
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if self._is_healthy(conn, released_at):
+                    self.stats['reuses'] += 1
+                    pooled = PooledConnection(self, conn)
+                    self._in_use[id(conn)] = pooled
+                    return pooled
+                self._discard(conn)
+            
+            if len(self._in_use) >= self.max_size:
+                raise Exception(f'Connection pool exhausted (max_size={self.max_size})')
+            
+            conn = self._connect()
+            pooled = PooledConnection(self, conn)
+            self._in_use[id(conn)] = pooled
+            return pooled
+    
+    def putconn(self, pooled: PooledConnection) -> None:
+        conn = pooled._conn
+        with self._lock:
+            if self._in_use.get(id(conn)) is not pooled:
+                return
+            del self._in_use[id(conn)]
+            try:
+                # Завершаем незакрытую транзакцию, чтобы следующий запрос начал с чистого состояния
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            if conn.closed or len(self._idle) >= self.max_size:
+                self._discard(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+    
+    def release_all(self) -> None:
+        '''Вернуть в пул соединения, которые не были закрыты в ходе запроса'''
+        for pooled in list(self._in_use.values()):
+            pooled.close()
+
+db_pool = ConnectionPool(max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')))
+
+def get_db_connection() -> PooledConnection:
+    '''Выдает подключение к базе данных из пула'''
+    return db_pool.getconn()
+
+def enqueue_job(cursor, job_type: str, payload: Dict, delay_seconds: int = 0,
+                dedup_key: Optional[str] = None, max_attempts: int = 5) -> None:
+    '''Поставить задачу в очередь (в транзакции вызывающего); повтор с тем же dedup_key игнорируется'''
+    job_type_escaped = job_type.replace("'", "''")
+    payload_escaped = json.dumps(payload).replace("'", "''")
+    dedup_value = 'NULL'
+    if dedup_key:
+        dedup_key_escaped = dedup_key.replace("'", "''")
+        dedup_value = f"'{dedup_key_escaped}'"
+    query = f'''INSERT INTO t_p5255237_telegram_bot_service.jobs 
+               (job_type, payload, run_at, max_attempts, dedup_key)
+               VALUES ('{job_type_escaped}', '{payload_escaped}'::jsonb, 
+                       CURRENT_TIMESTAMP + INTERVAL '{int(delay_seconds)} seconds', {int(max_attempts)}, {dedup_value})
+               ON CONFLICT (dedup_key) DO NOTHING'''
+    cursor.execute(query)
+
+def reclaim_stale_jobs(conn) -> int:
+    '''Вернуть в очередь задачи воркеров, которые упали, не завершив их'''
+    cursor = conn.cursor()
+    query = f'''UPDATE t_p5255237_telegram_bot_service.jobs 
+               SET status = 'pending', locked_by = NULL, locked_at = NULL, updated_at = CURRENT_TIMESTAMP
+               WHERE status = 'running' AND locked_at < CURRENT_TIMESTAMP - INTERVAL '{JOB_STALE_AFTER} seconds' '''
+    cursor.execute(query)
+    reclaimed = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    return reclaimed
+
+def claim_jobs(conn, limit: int) -> List[Dict]:
+    '''Забрать готовые к запуску задачи; параллельные воркеры пропускают чужие строки'''
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    query = f'''UPDATE t_p5255237_telegram_bot_service.jobs 
+               SET status = 'running', attempts = attempts + 1, locked_by = '{WORKER_ID}', 
+                   locked_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+               WHERE id IN (
+                   SELECT id FROM t_p5255237_telegram_bot_service.jobs 
+                   WHERE status = 'pending' AND run_at <= CURRENT_TIMESTAMP 
+                   ORDER BY run_at LIMIT {int(limit)}
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING *'''
+    cursor.execute(query)
+    jobs = cursor.fetchall()
+    conn.commit()
+    cursor.close()
+    return [dict(job) for job in jobs]
+
+def complete_job(conn, job_id: int) -> None:
+    cursor = conn.cursor()
+    cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.jobs 
+                      SET status = 'done', locked_by = NULL, locked_at = NULL, updated_at = CURRENT_TIMESTAMP
+                      WHERE id = {job_id}''')
+    conn.commit()
+    cursor.close()
+
+def fail_job(conn, job: Dict, error: str, permanent: bool = False) -> str:
+    '''Отложить повтор с экспоненциальной задержкой или пометить задачу проваленной'''
+    error_escaped = error[:1000].replace("'", "''")
+    cursor = conn.cursor()
+    if permanent or job['attempts'] >= job['max_attempts']:
+        status = 'failed'
+        cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.jobs 
+                          SET status = 'failed', last_error = '{error_escaped}', locked_by = NULL, locked_at = NULL,
+                              updated_at = CURRENT_TIMESTAMP
+                          WHERE id = {job['id']}''')
+    else:
+        status = 'pending'
+        delay = min(JOB_RETRY_BASE_DELAY * 2 ** (job['attempts'] - 1), JOB_RETRY_MAX_DELAY)
+        cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.jobs 
+                          SET status = 'pending', last_error = '{error_escaped}', locked_by = NULL, locked_at = NULL,
+                              run_at = CURRENT_TIMESTAMP + INTERVAL '{delay} seconds', updated_at = CURRENT_TIMESTAMP
+                          WHERE id = {job['id']}''')
+    conn.commit()
+    cursor.close()
+    return status
+
+def telegram_api(token: str, api_method: str, data: Dict, files: Dict = None) -> Dict:
+    '''Вызвать Bot API; 400/403 (чат недоступен, бот заблокирован) повторять не будем'''
+    url = f'https://api.telegram.org/bot{token}/{api_method}'
+    if files:
+        response = requests.post(url, data=data, files=files, timeout=30)
+    else:
+        response = requests.post(url, json=data, timeout=10)
+    result = response.json()
+    if not result.get('ok'):
+        description = result.get('description', response.text)
+        if response.status_code in (400, 403):
+            raise PermanentJobError(f'{api_method} failed: {description}')
+        raise Exception(f'{api_method} failed: {description}')
+    return result
+
+# Версия отрисовки входит в ключ кэша: при изменении картинки старые файлы на диске перестают находиться.
+# telegram-bot-engine и telegram-webhook держат копию этого блока (функции деплоятся по отдельности);
+# test_engine.QrRenderCopiesTest сверяет, что копии совпадают с этой реализацией.
+QR_RENDER_VERSION = 1
+
+def render_qr_png(payload: str, variant: str) -> bytes:
+    '''Отрисовывает QR-код как PNG: free - только код, vip - код на VIP обложке'''
+    # qrcode и Pillow тяжелые и нужны только при отрисовке: импортируем здесь, а не при холодном старте
+    import qrcode
+    from PIL import Image, ImageDraw
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill_color="black", back_color="white")
+    
+    if variant != 'vip':
+        bio = BytesIO()
+        qr_img.save(bio, 'PNG')
+        return bio.getvalue()
+    
+    qr_size = qr_img.size[0]
+    cover_width = qr_size
+    cover_height = int(qr_size * 1.4)
+    
+    cover = Image.new('RGB', (cover_width, cover_height), color='#E8F5E9')
+    draw = ImageDraw.Draw(cover, 'RGBA')
+    
+    watermark_color = (129, 199, 132, 40)
+    
+    for i in range(-2, 6):
+        y_pos = i * 80
+        draw.text((20, y_pos), 'VIP', fill=watermark_color, font=None)
+        draw.text((cover_width - 80, y_pos + 40), 'VIP', fill=watermark_color, font=None)
+    
+    title_y = 20
+    draw.text((cover_width // 2 - 50, title_y), '💎 VIP ACCESS', fill='#2E7D32', font=None)
+    
+    qr_y = 80
+    cover.paste(qr_img, (0, qr_y))
+    
+    bio = BytesIO()
+    cover.save(bio, 'PNG')
+    return bio.getvalue()
+
+class LruCache:
+    '''Словарь не больше max_items элементов: при переполнении вытесняется давно не использованный'''
+    
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: OrderedDict = OrderedDict()
+    
+    def get(self, key: Any) -> Any:
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+    
+    def put(self, key: Any, value: Any) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+    
+    def pop(self, key: Any) -> None:
+        self._items.pop(key, None)
+
+class QrImageCache:
+    '''Готовые PNG QR-кодов ключей по (code_number, variant): LRU в памяти процесса и content-addressed каталог на диске'''
+    
+    def __init__(self, directory: str, max_items: int = 256):
+        self.directory = directory
+        self._memory = LruCache(max_items)
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'renders': 0, 'disk_errors': 0}
+    
+    @staticmethod
+    def payload(code_number: int) -> str:
+        return f'POLYTOPE_KEY_{code_number}'
+    
+    @staticmethod
+    def key(code_number: int, variant: str) -> str:
+        payload = QrImageCache.payload(code_number)
+        return hashlib.sha256(f'{QR_RENDER_VERSION}:{variant}:{payload}'.encode('utf-8')).hexdigest()
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f'{key}.png')
+    
+    def _read(self, key: str) -> Optional[bytes]:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError:
+            self.stats['disk_errors'] += 1
+            return None
+    
+    def _write(self, key: str, image: bytes) -> None:
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(image)
+            # Файл появляется атомарно: параллельный читатель не увидит недописанный PNG
+            os.replace(tmp_path, path)
+        except OSError:
+            self.stats['disk_errors'] += 1
+    
+    def _render(self, code_number: int, variant: str, key: str) -> bytes:
+        image = render_qr_png(self.payload(code_number), variant)
+        self.stats['renders'] += 1
+        self._write(key, image)
+        return image
+    
+    def get(self, code_number: int, variant: str) -> bytes:
+        key = self.key(code_number, variant)
+        with self._lock:
+            image = self._memory.get(key)
+        if image is not None:
+            self.stats['memory_hits'] += 1
+            return image
+        
+        image = self._read(key)
+        if image is not None:
+            self.stats['disk_hits'] += 1
+        else:
+            image = self._render(code_number, variant, key)
+        with self._lock:
+            self._memory.put(key, image)
+        return image
+    
+    def prerender(self, code_number: int, variant: str) -> bool:
+        '''Отрисовать в дисковый кэш, не вытесняя LRU; False - файл уже был'''
+        key = self.key(code_number, variant)
+        if self.directory and os.path.exists(self._path(key)):
+            return False
+        self._render(code_number, variant, key)
+        return True
+
+qr_image_cache = QrImageCache(
+    directory=os.environ.get('QR_CACHE_DIR', '/tmp/qr-cache'),
+    max_items=int(os.environ.get('QR_CACHE_MAX_ITEMS', '256'))
+)
+
+def generate_qr_image(code_number: int, variant: str = 'free') -> bytes:
+    '''PNG QR-кода ключа (free или vip) из кэша; отрисовывается при первом обращении'''
+    return qr_image_cache.get(code_number, variant)
+
+def qr_asset_key(code_number: int, variant: str) -> str:
+    '''Ключ картинки QR-кода для кэша file_id (совпадает с ключом дискового кэша отрисовки)'''
+    return f"qr:{QrImageCache.key(code_number, variant)}"
+
+
+def get_file_id(cursor, bot_id: int, asset_key: str) -> Optional[str]:
+    '''file_id картинки, уже загруженной в Telegram этим ботом (таблица telegram_file_ids)'''
+    asset_key_escaped = asset_key.replace("'", "''")
+    cursor.execute(f'''SELECT file_id FROM t_p5255237_telegram_bot_service.telegram_file_ids 
+                      WHERE bot_id = {int(bot_id)} AND asset_key = '{asset_key_escaped}' ''')
+    row = cursor.fetchone()
+    return row['file_id'] if row else None
+
+def save_file_id(cursor, bot_id: int, asset_key: str, file_id: Optional[str]) -> None:
+    '''Запомнить file_id картинки; None удаляет недействительный file_id'''
+    asset_key_escaped = asset_key.replace("'", "''")
+    if file_id is None:
+        cursor.execute(f'''DELETE FROM t_p5255237_telegram_bot_service.telegram_file_ids 
+                          WHERE bot_id = {int(bot_id)} AND asset_key = '{asset_key_escaped}' ''')
+        return
+    file_id_escaped = file_id.replace("'", "''")
+    cursor.execute(f'''INSERT INTO t_p5255237_telegram_bot_service.telegram_file_ids (bot_id, asset_key, file_id)
+                      VALUES ({int(bot_id)}, '{asset_key_escaped}', '{file_id_escaped}')
+                      ON CONFLICT (bot_id, asset_key) DO UPDATE 
+                      SET file_id = EXCLUDED.file_id, updated_at = CURRENT_TIMESTAMP''')
+
+def send_qr_photo(conn, token: str, bot_id: int, chat_id: int, code_number: int, variant: str, caption: str) -> None:
+    '''Отправить картинку QR-ключа; если бот уже загружал этот ключ (админ получает один и тот же), то по file_id'''
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    asset_key = qr_asset_key(code_number, variant)
+    file_id = get_file_id(cursor, bot_id, asset_key)
+    if file_id:
+        try:
+            telegram_api(token, 'sendPhoto', {'chat_id': chat_id, 'caption': caption, 'photo': file_id})
+            cursor.close()
+            return
+        except PermanentJobError as e:
+            # file_id мог стать недействительным - тогда загружаем файл заново
+            if 'file' not in str(e).lower():
+                raise
+            save_file_id(cursor, bot_id, asset_key, None)
+            conn.commit()
+    
+    result = telegram_api(
+        token, 'sendPhoto',
+        {'chat_id': chat_id, 'caption': caption},
+        files={'photo': (f'vip_key_{code_number}.png', generate_qr_image(code_number, variant), 'image/png')}
+    )
+    sizes = result.get('result', {}).get('photo')
+    if sizes:
+        # Фото уже доставлено: ошибка записи кэша не должна приводить к повтору задачи и второй отправке
+        try:
+            save_file_id(cursor, bot_id, asset_key, sizes[-1]['file_id'])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"[WARN] file_id for bot {bot_id} not saved: {e}")
+    cursor.close()
+
+def run_check_payment(conn, payload: Dict) -> None:
+    '''Проверить статус платежа; при оплате поставить выдачу ключа, иначе запланировать следующую проверку'''
+    order_id = payload['order_id']
+    step = payload.get('step', 0)
+    
+    cursor = conn.cursor()
+    # Если уведомление T-Bank уже обновило платеж, в GetState не ходим
+    order_id_escaped = order_id.replace("'", "''")
+    cursor.execute(f"SELECT status FROM t_p5255237_telegram_bot_service.payments WHERE order_id = '{order_id_escaped}'")
+    row = cursor.fetchone()
+    db_status = row[0] if row else None
+    if db_status in PAYMENT_FINAL_FAILED_STATUSES:
+        cursor.close()
+        return
+    if db_status == 'CONFIRMED':
+        confirmed = True
+    else:
+        response = requests.post(CHECK_PAYMENT_STATUS_URL, json={'order_id': order_id}, timeout=10)
+        confirmed = bool(response.json().get('confirmed'))
+    
+    if confirmed:
+        enqueue_job(cursor, 'deliver_vip_key', payload, dedup_key=f'deliver_vip_key:{order_id}')
+    elif step + 1 < len(CHECK_PAYMENT_DELAYS):
+        enqueue_job(
+            cursor, 'check_payment', {**payload, 'step': step + 1},
+            delay_seconds=CHECK_PAYMENT_DELAYS[step + 1],
+            dedup_key=f'check_payment:{order_id}:{step + 1}'
+        )
+    else:
+        cursor.execute(f'''SELECT telegram_token FROM t_p5255237_telegram_bot_service.bots 
+                          WHERE id = {int(payload['bot_id'])}''')
+        bot = cursor.fetchone()
+        if bot:
+            telegram_api(bot[0], 'sendMessage', {
+                'chat_id': payload['chat_id'],
+                'text': "⏱ Время проверки истекло. Если вы оплатили заказ, нажмите 'Купить VIP-ключ' снова для проверки статуса."
+            })
+    conn.commit()
+    cursor.close()
+
+def allocate_vip_code(cursor, bot_id: int, user_id: int) -> Optional[Dict]:
+    '''Атомарно выдать первый свободный VIP-ключ; если свободны только ключи из блоков, арендованных движком,
+    берется один из них (выдача из блока проверяет lease_owner и is_used и просто пропустит такой ключ)'''
+    for lease_condition in ('AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP)', ''):
+        cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.qr_codes 
+                          SET is_used = true, used_by_user_id = {user_id}, used_at = CURRENT_TIMESTAMP,
+                              lease_owner = NULL, lease_expires_at = NULL
+                          WHERE id = (
+                              SELECT id FROM t_p5255237_telegram_bot_service.qr_codes 
+                              WHERE bot_id = {bot_id} AND code_type = 'vip' AND is_used = false 
+                              {lease_condition}
+                              ORDER BY code_number LIMIT 1
+                              FOR UPDATE SKIP LOCKED
+                          )
+                          RETURNING id, code_number''')
+        qr_code = cursor.fetchone()
+        if qr_code:
+            return qr_code
+    return None
+
+def run_deliver_vip_key(conn, payload: Dict) -> None:
+    '''Выдать VIP-ключ по оплаченному платежу; ключ закрепляется за платежом, поэтому повтор не выдаст второй'''
+    order_id_escaped = payload['order_id'].replace("'", "''")
+    bot_id = int(payload['bot_id'])
+    user_id = int(payload['user_id'])
+    is_admin = bool(payload.get('is_admin'))
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(f'''SELECT p.id, p.telegram_user_id, p.vip_qr_code_id, p.vip_delivered_at, 
+                             b.telegram_token, b.vip_success_message
+                      FROM t_p5255237_telegram_bot_service.payments p
+                      JOIN t_p5255237_telegram_bot_service.bots b ON p.bot_id = b.id
+                      WHERE p.order_id = '{order_id_escaped}' 
+                      FOR UPDATE OF p''')
+    payment = cursor.fetchone()
+    if not payment or payment['vip_delivered_at']:
+        conn.commit()
+        cursor.close()
+        return
+    
+    if payment['vip_qr_code_id']:
+        cursor.execute(f'''SELECT id, code_number FROM t_p5255237_telegram_bot_service.qr_codes 
+                          WHERE id = {payment['vip_qr_code_id']}''')
+        qr_code = cursor.fetchone()
+    elif is_admin:
+        cursor.execute(f'''SELECT id, code_number FROM t_p5255237_telegram_bot_service.qr_codes 
+                          WHERE bot_id = {bot_id} AND code_type = 'vip'
+                          ORDER BY code_number LIMIT 1''')
+        qr_code = cursor.fetchone()
+    else:
+        qr_code = allocate_vip_code(cursor, bot_id, user_id)
+        if qr_code:
+            cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.bot_users 
+                              SET received_vip_qr = true, vip_qr_received_at = CURRENT_TIMESTAMP 
+                              WHERE bot_id = {bot_id} AND telegram_user_id = {payment['telegram_user_id']}''')
+    
+    if qr_code:
+        cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.payments 
+                          SET vip_qr_code_id = {qr_code['id']} WHERE id = {payment['id']}''')
+    conn.commit()
+    
+    chat_id = payload['chat_id']
+    if not qr_code:
+        telegram_api(payment['telegram_token'], 'sendMessage', {
+            'chat_id': chat_id,
+            'text': "✅ Оплата подтверждена! Но VIP-ключи закончились. Обратитесь к администратору."
+        })
+        cursor.close()
+        return
+    
+    code_number = qr_code['code_number']
+    if payment['vip_success_message']:
+        text = payment['vip_success_message'].format(code_number=code_number)
+    else:
+        text = (
+            f"✅ Ключ оплачен! Спасибо за покупку!\n\n"
+            f"💎 Ваш VIP QR-код №{code_number}\n\n"
+            f"Покажите этот код на кассе для получения доступа к VIP-товарам"
+        )
+    
+    send_qr_photo(conn, payment['telegram_token'], bot_id, chat_id, code_number, 'vip', text)
+    
+    cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.payments 
+                      SET vip_delivered_at = CURRENT_TIMESTAMP WHERE id = {payment['id']}''')
+    conn.commit()
+    cursor.close()
+
+def run_prerender_qr(conn, payload: Dict) -> None:
+    '''Заполнить общий дисковый кэш QR-кодов бота после их создания (generate-qr-codes)'''
+    bot_id = int(payload['bot_id'])
+    after = int(payload.get('after', 0))
+    if not QR_CACHE_SHARED:
+        print(f"[QR PRERENDER] Shared QR_CACHE_DIR is not configured, bot {bot_id} skipped")
+        return
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(f'''SELECT code_number, code_type FROM t_p5255237_telegram_bot_service.qr_codes 
+                      WHERE bot_id = {bot_id} AND code_number > {after}
+                      ORDER BY code_number LIMIT {QR_PRERENDER_BATCH}''')
+    codes = cursor.fetchall()
+    
+    started = time.monotonic()
+    rendered = 0
+    last_code = after
+    for code in codes:
+        variant = 'vip' if code['code_type'] == 'vip' else 'free'
+        if qr_image_cache.prerender(code['code_number'], variant):
+            rendered += 1
+        last_code = code['code_number']
+        if time.monotonic() - started > QR_PRERENDER_SLICE:
+            break
+    
+    if codes and (last_code != codes[-1]['code_number'] or len(codes) == QR_PRERENDER_BATCH):
+        enqueue_job(cursor, 'prerender_qr', {'bot_id': bot_id, 'after': last_code},
+                    dedup_key=f'prerender_qr:{bot_id}:{last_code}')
+    conn.commit()
+    cursor.close()
+    print(f"[QR PRERENDER] Bot {bot_id}: {rendered} rendered, up to code {last_code}")
+
+JOB_HANDLERS = {
+    'check_payment': run_check_payment,
+    'deliver_vip_key': run_deliver_vip_key,
+    'prerender_qr': run_prerender_qr,
+}
+
+def run_job(conn, job: Dict, stats: Dict[str, int]) -> None:
+    job_handler = JOB_HANDLERS.get(job['job_type'])
+    try:
+        if not job_handler:
+            raise PermanentJobError(f"Unknown job type: {job['job_type']}")
+        job_handler(conn, job['payload'])
+        complete_job(conn, job['id'])
+        stats['succeeded'] += 1
+    except Exception as e:
+        conn.rollback()
+        status = fail_job(conn, job, str(e), permanent=isinstance(e, PermanentJobError))
+        stats['failed' if status == 'failed' else 'retried'] += 1
+        print(f"[JOB {job['id']}] {job['job_type']} attempt {job['attempts']} failed ({status}): {e}")
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Background job worker - runs due jobs from the Postgres queue (payment checks, VIP key delivery, QR pre-render)
+    Args: event - cloud function event (scheduled trigger, every minute)
+          context - cloud function context
+    Returns: HTTP response with processing stats
+    '''
+    # Соединения, не возвращенные прошлым вызовом (ранний return или исключение), возвращаем в пул
+    db_pool.release_all()
+    
+    method: str = event.get('httpMethod', 'POST')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    body_str = event.get('body') or '{}'
+    body = json.loads(body_str) if body_str else {}
+    # Ручной вызов может ограничить время разбора очереди (0 - один проход)
+    time_budget = min(float(body.get('time_budget', JOB_TIME_BUDGET)), JOB_TIME_BUDGET)
+    
+    started = time.monotonic()
+    stats = {'processed': 0, 'succeeded': 0, 'retried': 0, 'failed': 0, 'reclaimed': 0}
+    
+    conn = get_db_connection()
+    try:
+        stats['reclaimed'] = reclaim_stale_jobs(conn)
+        
+        while True:
+            jobs = claim_jobs(conn, JOB_BATCH_SIZE)
+            for job in jobs:
+                run_job(conn, job, stats)
+                stats['processed'] += 1
+            if time.monotonic() - started >= time_budget:
+                break
+            if not jobs:
+                time.sleep(JOB_POLL_INTERVAL)
+    finally:
+        conn.close()
+    
+    print(f"[JOB WORKER {WORKER_ID}] {stats}")
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'message': 'Jobs processed', **stats}),
+        'isBase64Encoded': False
+    }
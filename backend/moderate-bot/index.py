@@ -123,7 +123,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                        moderation_reason = '{reason_escaped}',
                        moderated_by = {admin_id},
                        moderated_at = CURRENT_TIMESTAMP,
-                       updated_at = CURRENT_TIMESTAMP
+                       updated_at = CURRENT_TIMESTAMP,
+                       config_version = config_version + 1
                    WHERE id = {bot_id} 
                    RETURNING *'''
         
@@ -0,0 +1,294 @@
+import json
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+import requests
+from requests.adapters import HTTPAdapter
+
+GET_STATE_URL = 'https://securepay.tinkoff.ru/v2/GetState'
+
+# Незавершенные статусы, которые сверяем с T-Bank (остальные приходят уведомлением и окончательны)
+PENDING_STATUSES = ('NEW', 'AUTHORIZED')
+
+RECONCILE_BATCH_SIZE = int(os.environ.get('RECONCILE_BATCH_SIZE', '200'))
+# Одновременных запросов к T-Bank за один проход
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '8'))
+# Повторная проверка платежа не раньше чем через base * 2^check_attempts секунд (но не реже max)
+RECONCILE_BASE_INTERVAL = int(os.environ.get('RECONCILE_BASE_INTERVAL', '60'))
+RECONCILE_MAX_INTERVAL = int(os.environ.get('RECONCILE_MAX_INTERVAL', '3600'))
+RECONCILE_MAX_ATTEMPTS = int(os.environ.get('RECONCILE_MAX_ATTEMPTS', '20'))
+# Платежи старше этого срока T-Bank уже не подтвердит
+RECONCILE_MAX_AGE_HOURS = int(os.environ.get('RECONCILE_MAX_AGE_HOURS', '48'))
+
+# Одна keep-alive сессия на все потоки: пул соединений не меньше числа потоков
+http = requests.Session()
+http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=RECONCILE_CONCURRENCY))
+
+class PooledConnection:
+    '''Соединение, выданное пулом: close() возвращает его в пул вместо закрытия'''
+    
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            self._pool.putconn(self)
+            self._conn = None
+
+class ConnectionPool:
+    '''Пул соединений с PostgreSQL, который переживает тёплые вызовы функции'''
+    
+    def __init__(self, max_size: int = 5, health_check_after: float = 30.0):
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._in_use: Dict[int, PooledConnection] = {}
+        self._lock = threading.Lock()
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0, 'health_checks': 0}
+    
+    def _connect(self):
+        database_url = os.environ.get('DATABASE_URL', '')
+        if not database_url:
+            raise ValueError('DATABASE_URL not configured')
+        self.stats['connects'] += 1
+        return psycopg2.connect(database_url)
+    
+    def _discard(self, conn) -> None:
+        self.stats['discards'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        self.stats['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self) -> PooledConnection:
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if self._is_healthy(conn, released_at):
+                    self.stats['reuses'] += 1
+                    pooled = PooledConnection(self, conn)
+                    self._in_use[id(conn)] = pooled
+                    return pooled
+                self._discard(conn)
+            
+            if len(self._in_use) >= self.max_size:
+                raise Exception(f'Connection pool exhausted (max_size={self.max_size})')
+            
+            conn = self._connect()
+            pooled = PooledConnection(self, conn)
+            self._in_use[id(conn)] = pooled
+            return pooled
+    
+    def putconn(self, pooled: PooledConnection) -> None:
+        conn = pooled._conn
+        with self._lock:
+            if self._in_use.get(id(conn)) is not pooled:
+                return
+            del self._in_use[id(conn)]
+            try:
+                # Завершаем незакрытую транзакцию, чтобы следующий запрос начал с чистого состояния
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            if conn.closed or len(self._idle) >= self.max_size:
+                self._discard(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+    
+    def release_all(self) -> None:
+        '''Вернуть в пул соединения, которые не были закрыты в ходе запроса'''
+        for pooled in list(self._in_use.values()):
+            pooled.close()
+
+db_pool = ConnectionPool(max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')))
+
+def get_db_connection() -> PooledConnection:
+    '''Выдает подключение к базе данных из пула'''
+    return db_pool.getconn()
+
+def select_due_payments(conn) -> List[Dict]:
+    '''Платежи, которым пора на проверку: интервал растет с числом уже сделанных проверок'''
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    statuses = ', '.join(f"'{s}'" for s in PENDING_STATUSES)
+    query = f'''SELECT p.id, p.order_id, p.payment_id, b.tbank_terminal_key, b.tbank_password
+               FROM t_p5255237_telegram_bot_service.payments p
+               JOIN t_p5255237_telegram_bot_service.bots b ON p.bot_id = b.id
+               WHERE p.status IN ({statuses})
+                 AND COALESCE(p.payment_id, '') <> ''
+                 AND COALESCE(b.tbank_terminal_key, '') <> '' AND COALESCE(b.tbank_password, '') <> ''
+                 AND COALESCE(p.check_attempts, 0) < {RECONCILE_MAX_ATTEMPTS}
+                 AND p.created_at > CURRENT_TIMESTAMP - INTERVAL '{RECONCILE_MAX_AGE_HOURS} hours'
+                 AND (p.last_check_at IS NULL OR p.last_check_at < CURRENT_TIMESTAMP - 
+                      LEAST({RECONCILE_BASE_INTERVAL} * POWER(2, LEAST(COALESCE(p.check_attempts, 0), 16)), 
+                            {RECONCILE_MAX_INTERVAL}) * INTERVAL '1 second')
+               ORDER BY p.last_check_at NULLS FIRST
+               LIMIT {RECONCILE_BATCH_SIZE}'''
+    cursor.execute(query)
+    payments = cursor.fetchall()
+    cursor.close()
+    return payments
+
+def fetch_state(payment: Dict) -> Tuple[int, Optional[str]]:
+    '''GetState для одного платежа; при ошибке статус None (платеж просто перепроверим позже)'''
+    token_data = {
+        'TerminalKey': payment['tbank_terminal_key'],
+        'PaymentId': payment['payment_id'],
+        'Password': payment['tbank_password']
+    }
+    sorted_values = ''.join(str(v) for k, v in sorted(token_data.items()))
+    params = {
+        'TerminalKey': payment['tbank_terminal_key'],
+        'PaymentId': payment['payment_id'],
+        'Token': hashlib.sha256(sorted_values.encode()).hexdigest()
+    }
+    try:
+        response = http.post(GET_STATE_URL, json=params, timeout=10)
+        result = response.json()
+        if not result.get('Success', True) and not result.get('Status'):
+            print(f"[RECONCILE] GetState failed for {payment['order_id']}: {result.get('Message')}")
+            return payment['id'], None
+        return payment['id'], result.get('Status')
+    except Exception as e:
+        print(f"[RECONCILE] GetState error for {payment['order_id']}: {e}")
+        return payment['id'], None
+
+def apply_states(conn, states: List[Tuple[int, Optional[str]]]) -> List[int]:
+    '''Записать результаты одним UPDATE; возвращает id платежей, подтвержденных этим проходом'''
+    cursor = conn.cursor()
+    statuses = ', '.join(f"'{s}'" for s in PENDING_STATUSES)
+    # Условие на статус: уведомление T-Bank могло обновить платеж, пока шел запрос, его не затираем
+    query = f'''UPDATE t_p5255237_telegram_bot_service.payments p
+               SET status = COALESCE(v.status, p.status),
+                   confirmed_at = CASE WHEN v.status = 'CONFIRMED' 
+                                       THEN COALESCE(p.confirmed_at, CURRENT_TIMESTAMP) ELSE p.confirmed_at END,
+                   last_check_at = CURRENT_TIMESTAMP,
+                   check_attempts = COALESCE(p.check_attempts, 0) + 1
+               FROM (VALUES %s) AS v(id, status)
+               WHERE p.id = v.id AND p.status IN ({statuses})
+               RETURNING p.id, v.status'''
+    rows = execute_values(cursor, query, states, template='(%s::integer, %s::varchar)', fetch=True)
+    cursor.close()
+    return [row[0] for row in rows if row[1] == 'CONFIRMED']
+
+def enqueue_deliveries(conn, payment_ids: List[int]) -> int:
+    '''Поставить выдачу VIP-ключей одним INSERT; dedup_key не даст задвоить выдачу с tbank-notification'''
+    if not payment_ids:
+        return 0
+    cursor = conn.cursor()
+    ids = ', '.join(str(int(payment_id)) for payment_id in payment_ids)
+    query = f'''INSERT INTO t_p5255237_telegram_bot_service.jobs (job_type, payload, dedup_key)
+               SELECT 'deliver_vip_key',
+                      jsonb_build_object('bot_id', p.bot_id, 'chat_id', p.telegram_user_id, 'order_id', p.order_id,
+                                         'user_id', u.id, 'is_admin', p.telegram_user_id = ANY(COALESCE(b.admin_telegram_ids, ARRAY[]::BIGINT[]))),
+                      'deliver_vip_key:' || p.order_id
+               FROM t_p5255237_telegram_bot_service.payments p
+               JOIN t_p5255237_telegram_bot_service.bots b ON p.bot_id = b.id
+               JOIN t_p5255237_telegram_bot_service.bot_users u 
+                    ON u.bot_id = p.bot_id AND u.telegram_user_id = p.telegram_user_id
+               WHERE p.id IN ({ids}) AND p.order_id LIKE 'vip\\_%'
+               ON CONFLICT (dedup_key) DO NOTHING'''
+    cursor.execute(query)
+    queued = cursor.rowcount
+    cursor.close()
+    return queued
+
+def reconcile() -> Dict[str, int]:
+    '''Один проход сверки: выборка, параллельные GetState, пакетная запись'''
+    conn = get_db_connection()
+    try:
+        payments = select_due_payments(conn)
+        conn.commit()
+        if not payments:
+            return {'checked': 0, 'updated': 0, 'confirmed': 0, 'queued': 0, 'errors': 0}
+        
+        # Запросы к T-Bank идут без открытой транзакции
+        with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY) as pool:
+            states = list(pool.map(fetch_state, payments))
+        
+        confirmed_ids = apply_states(conn, states)
+        queued = enqueue_deliveries(conn, confirmed_ids)
+        conn.commit()
+        
+        errors = sum(1 for _, status in states if status is None)
+        changed = sum(1 for _, status in states if status and status not in PENDING_STATUSES)
+        print(f"[RECONCILE] checked={len(states)} changed={changed} confirmed={len(confirmed_ids)} errors={errors}")
+        return {
+            'checked': len(states),
+            'updated': changed,
+            'confirmed': len(confirmed_ids),
+            'queued': queued,
+            'errors': errors
+        }
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Scheduled reconciliation of pending T-Bank payments - concurrent GetState, batched status update
+    Args: event - HTTP request from the scheduler (any method except OPTIONS)
+          context - cloud function context
+    Returns: Counters of checked, updated and confirmed payments
+    '''
+    # Соединения, не возвращенные прошлым вызовом (ранний return или исключение), возвращаем в пул
+    db_pool.release_all()
+    
+    method: str = event.get('httpMethod', 'POST')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    try:
+        stats = reconcile()
+    except Exception as e:
+        print(f"[RECONCILE] Error: {e}")
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'message': 'Reconciliation finished', **stats}),
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,285 @@
+import json
+import os
+import hashlib
+import hmac
+import threading
+import time
+from typing import Dict, Any, Optional, List, Tuple
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+# Порядок статусов T-Bank: уведомления могут прийти не по порядку, откатывать статус назад нельзя
+STATUS_RANK = {
+    'NEW': 0,
+    'FORM_SHOWED': 1,
+    'AUTHORIZING': 2,
+    '3DS_CHECKING': 2,
+    '3DS_CHECKED': 2,
+    'AUTHORIZED': 3,
+    'CONFIRMING': 4,
+    'CONFIRMED': 5,
+    'REVERSING': 6,
+    'PARTIAL_REVERSED': 6,
+    'REVERSED': 7,
+    'REFUNDING': 6,
+    'PARTIAL_REFUNDED': 6,
+    'REFUNDED': 7,
+    'REJECTED': 7,
+    'CANCELED': 7,
+    'DEADLINE_EXPIRED': 7,
+}
+
+def generate_token(params: Dict[str, Any], password: str) -> str:
+    '''Токен T-Bank: та же схема, что в create-payment (значения по отсортированным ключам + Password)'''
+    params_copy = params.copy()
+    params_copy['Password'] = password
+    
+    sorted_keys = sorted(params_copy.keys())
+    # В уведомлениях есть булевы поля (Success), T-Bank подписывает их как "true"/"false"
+    values = [
+        (str(params_copy[key]).lower() if isinstance(params_copy[key], bool) else str(params_copy[key]))
+        for key in sorted_keys
+        if key not in ['Token', 'Receipt', 'Data'] and not isinstance(params_copy[key], (dict, list))
+    ]
+    
+    concatenated = ''.join(values)
+    return hashlib.sha256(concatenated.encode('utf-8')).hexdigest()
+
+class PooledConnection:
+    '''Соединение, выданное пулом: close() возвращает его в пул вместо закрытия'''
+    
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            self._pool.putconn(self)
+            self._conn = None
+
+class ConnectionPool:
+    '''Пул соединений с PostgreSQL, который переживает тёплые вызовы функции'''
+    
+    def __init__(self, max_size: int = 5, health_check_after: float = 30.0):
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._in_use: Dict[int, PooledConnection] = {}
+        self._lock = threading.Lock()
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0, 'health_checks': 0}
+    
+    def _connect(self):
+        database_url = os.environ.get('DATABASE_URL', '')
+        if not database_url:
+            raise ValueError('DATABASE_URL not configured')
+        self.stats['connects'] += 1
+        return psycopg2.connect(database_url)
+    
+    def _discard(self, conn) -> None:
+        self.stats['discards'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        self.stats['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self) -> PooledConnection:
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if self._is_healthy(conn, released_at):
+                    self.stats['reuses'] += 1
+                    pooled = PooledConnection(self, conn)
+                    self._in_use[id(conn)] = pooled
+                    return pooled
+                self._discard(conn)
+            
+            if len(self._in_use) >= self.max_size:
+                raise Exception(f'Connection pool exhausted (max_size={self.max_size})')
+            
+            conn = self._connect()
+            pooled = PooledConnection(self, conn)
+            self._in_use[id(conn)] = pooled
+            return pooled
+    
+    def putconn(self, pooled: PooledConnection) -> None:
+        conn = pooled._conn
+        with self._lock:
+            if self._in_use.get(id(conn)) is not pooled:
+                return
+            del self._in_use[id(conn)]
+            try:
+                # Завершаем незакрытую транзакцию, чтобы следующий запрос начал с чистого состояния
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            if conn.closed or len(self._idle) >= self.max_size:
+                self._discard(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+    
+    def release_all(self) -> None:
+        '''Вернуть в пул соединения, которые не были закрыты в ходе запроса'''
+        for pooled in list(self._in_use.values()):
+            pooled.close()
+
+db_pool = ConnectionPool(max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')))
+
+def get_db_connection() -> PooledConnection:
+    '''Выдает подключение к базе данных из пула'''
+    return db_pool.getconn()
+
+def enqueue_vip_delivery(cursor, payment: Dict) -> None:
+    '''Поставить выдачу VIP-ключа в очередь job-worker (повторное уведомление не создаст вторую задачу)'''
+    cursor.execute(f'''SELECT id FROM t_p5255237_telegram_bot_service.bot_users 
+                      WHERE bot_id = {payment['bot_id']} AND telegram_user_id = {payment['telegram_user_id']}''')
+    user = cursor.fetchone()
+    if not user:
+        print(f"[TBANK] No bot user for order {payment['order_id']}, delivery skipped")
+        return
+    
+    payload = {
+        'bot_id': payment['bot_id'],
+        'chat_id': payment['telegram_user_id'],
+        'order_id': payment['order_id'],
+        'user_id': user['id'],
+        'is_admin': payment['telegram_user_id'] in (payment['admin_telegram_ids'] or [])
+    }
+    payload_escaped = json.dumps(payload).replace("'", "''")
+    dedup_key_escaped = f"deliver_vip_key:{payment['order_id']}".replace("'", "''")
+    cursor.execute(f'''INSERT INTO t_p5255237_telegram_bot_service.jobs (job_type, payload, dedup_key)
+                      VALUES ('deliver_vip_key', '{payload_escaped}'::jsonb, '{dedup_key_escaped}')
+                      ON CONFLICT (dedup_key) DO NOTHING''')
+
+def process_notification(notification: Dict[str, Any]) -> Optional[str]:
+    '''Применить уведомление к платежу; возвращает текст ошибки, если уведомление отклонено'''
+    order_id = str(notification.get('OrderId', ''))
+    status = str(notification.get('Status', ''))
+    if not order_id or not status:
+        return 'OrderId and Status required'
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        order_id_escaped = order_id.replace("'", "''")
+        cursor.execute(f'''SELECT p.id, p.bot_id, p.order_id, p.status, p.telegram_user_id,
+                                 b.tbank_terminal_key, b.tbank_password, b.admin_telegram_ids
+                          FROM t_p5255237_telegram_bot_service.payments p
+                          JOIN t_p5255237_telegram_bot_service.bots b ON p.bot_id = b.id
+                          WHERE p.order_id = '{order_id_escaped}'
+                          FOR UPDATE OF p''')
+        payment = cursor.fetchone()
+        if not payment:
+            return f'Payment {order_id} not found'
+        
+        if not payment['tbank_password'] or notification.get('TerminalKey') != payment['tbank_terminal_key']:
+            return 'Terminal key mismatch'
+        expected_token = generate_token(notification, payment['tbank_password'])
+        if not hmac.compare_digest(expected_token, str(notification.get('Token', ''))):
+            return 'Invalid token'
+        
+        current_rank = STATUS_RANK.get(payment['status'], 0)
+        new_rank = STATUS_RANK.get(status, 0)
+        if new_rank < current_rank or status == payment['status']:
+            # Повтор или запоздавшее уведомление - платеж уже в этом или более позднем статусе
+            conn.commit()
+            return None
+        
+        status_escaped = status.replace("'", "''")
+        payment_id_escaped = str(notification.get('PaymentId', '')).replace("'", "''")
+        confirmed_clause = ', confirmed_at = COALESCE(confirmed_at, CURRENT_TIMESTAMP)' if status == 'CONFIRMED' else ''
+        cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.payments 
+                          SET status = '{status_escaped}', 
+                              payment_id = COALESCE(NULLIF(payment_id, ''), '{payment_id_escaped}'),
+                              last_check_at = CURRENT_TIMESTAMP{confirmed_clause}
+                          WHERE id = {payment['id']}''')
+        
+        if status == 'CONFIRMED' and payment['order_id'].startswith('vip_') and payment['telegram_user_id']:
+            enqueue_vip_delivery(cursor, payment)
+        
+        conn.commit()
+        print(f"[TBANK] Order {order_id}: {payment['status']} -> {status}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: T-Bank payment notification receiver - verifies Token, updates payment status, queues VIP key delivery
+    Args: event - HTTP POST from T-Bank with payment notification JSON
+          context - cloud function context
+    Returns: "OK" on success so that T-Bank stops resending the notification
+    '''
+    # Соединения, не возвращенные прошлым вызовом (ранний return или исключение), возвращаем в пул
+    db_pool.release_all()
+    
+    method: str = event.get('httpMethod', 'POST')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        notification = json.loads(event.get('body') or '{}')
+    except ValueError:
+        notification = None
+    if not isinstance(notification, dict):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid JSON'}),
+            'isBase64Encoded': False
+        }
+    
+    error = process_notification(notification)
+    if error:
+        print(f"[TBANK] Notification rejected: {error}")
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'text/plain'},
+        'body': 'OK',
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,84 @@
+'''
+Замер пропускной способности обработки Update в одном воркере.
+
+Прогоняет чтения из БД, которые выполняет типичный Update (FSM-состояние и данные,
+настройки бота, бронирования пользователя), сначала последовательно, затем конкурентно,
+и печатает число Update в секунду. Пишущих запросов нет, Telegram не вызывается.
+
+Отдельно меряется подготовка Dispatcher на один Update: cold - Bot и Dispatcher собираются
+заново (как до кэша и после изменения настроек бота), warm - берутся из кэша get_dispatcher.
+
+Запуск: DATABASE_URL=... python benchmark.py --bot-id 1 --updates 200 --concurrency 20 --setup-runs 50
+'''
+import argparse
+import asyncio
+import statistics
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+
+import index
+
+async def simulate_update(storage: index.PostgresStorage, bot_id: int, telegram_user_id: int) -> None:
+    key = StorageKey(bot_id=bot_id, chat_id=telegram_user_id, user_id=telegram_user_id)
+    await storage.get_state(key)
+    await storage.get_data(key)
+    await index.get_bot_settings(bot_id)
+    await index.get_user_bookings(bot_id, telegram_user_id)
+
+def measure_dispatcher_setup(bot_id: int, bot_settings: dict, runs: int) -> None:
+    cold = []
+    for _ in range(runs):
+        index._dispatchers.pop(bot_id, None)
+        started = time.perf_counter()
+        index.get_dispatcher(bot_id, bot_settings)
+        cold.append(time.perf_counter() - started)
+    
+    warm = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        index.get_dispatcher(bot_id, bot_settings)
+        warm.append(time.perf_counter() - started)
+    
+    cold_ms = statistics.median(cold) * 1000
+    warm_ms = statistics.median(warm) * 1000
+    print(f"dispatcher setup: cold {cold_ms:.2f} ms/update, warm {warm_ms:.4f} ms/update "
+          f"(median of {runs}, {cold_ms / max(warm_ms, 1e-6):.0f}x)")
+
+async def run(bot_id: int, updates: int, concurrency: int, setup_runs: int) -> None:
+    storage = index.PostgresStorage()
+    # Синтетические отрицательные id не пересекаются с реальными пользователями Telegram
+    user_ids = [-(i + 1) for i in range(updates)]
+    await simulate_update(storage, bot_id, user_ids[0])  # прогрев пула и кэша настроек
+    
+    started = time.perf_counter()
+    for telegram_user_id in user_ids:
+        await simulate_update(storage, bot_id, telegram_user_id)
+    sequential = time.perf_counter() - started
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def limited(telegram_user_id: int) -> None:
+        async with semaphore:
+            await simulate_update(storage, bot_id, telegram_user_id)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(telegram_user_id) for telegram_user_id in user_ids))
+    concurrent = time.perf_counter() - started
+    
+    print(f"updates={updates} pool_max_size={index.db.max_size} concurrency={concurrency}")
+    print(f"sequential: {updates / sequential:.1f} updates/s ({sequential * 1000 / updates:.1f} ms/update)")
+    print(f"concurrent: {updates / concurrent:.1f} updates/s ({concurrent * 1000 / updates:.1f} ms/update)")
+    print(f"db stats: {index.db.stats}")
+    
+    measure_dispatcher_setup(bot_id, await index.get_bot_settings(bot_id), setup_runs)
+    await index.db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Telegram bot engine concurrency benchmark')
+    parser.add_argument('--bot-id', type=int, required=True)
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--setup-runs', type=int, default=50, help='сколько раз собирать Dispatcher для замера')
+    args = parser.parse_args()
+    index.loop_runner.run(run(args.bot_id, args.updates, args.concurrency, max(1, args.setup_runs)))
@@ -1,16 +1,27 @@
 import json
 import os
 import asyncio
-from typing import Dict, Any, Optional
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import atexit
+import contextlib
+import hashlib
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable
+import asyncpg
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.methods import TelegramMethod, SendMessage, EditMessageText, AnswerCallbackQuery
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
-import qrcode
+from decimal import Decimal
 from io import BytesIO
 
 class BotStates(StatesGroup):
@@ -27,75 +38,51 @@ class PostgresStorage(BaseStorage):
     
     async def set_state(self, key: StorageKey, state: StateType = None) -> None:
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
             state_str = state.state if state else ''
-            state_str_escaped = state_str.replace("'", "''")
-            
-            query = f'''INSERT INTO t_p5255237_telegram_bot_service.bot_fsm_states 
+            await db.execute(
+                '''INSERT INTO t_p5255237_telegram_bot_service.bot_fsm_states 
                    (bot_id, chat_id, user_id, state) 
-                   VALUES ({key.bot_id}, '{key.chat_id}'::bigint, '{key.user_id}'::bigint, '{state_str_escaped}')
+                   VALUES ($1, $2, $3, $4)
                    ON CONFLICT (bot_id, chat_id, user_id) 
-                   DO UPDATE SET state = '{state_str_escaped}', updated_at = CURRENT_TIMESTAMP'''
-            
-            print(f"[DEBUG] set_state query: {query[:200]}...")
-            cursor.execute(query)
-            conn.commit()
-            cursor.close()
-            conn.close()
+                   DO UPDATE SET state = EXCLUDED.state, updated_at = CURRENT_TIMESTAMP''',
+                key.bot_id, key.chat_id, key.user_id, state_str
+            )
         except Exception as e:
             print(f"[ERROR] set_state failed: {e}")
-            print(f"[ERROR] Query was: {query[:200] if 'query' in locals() else 'N/A'}...")
     
     async def get_state(self, key: StorageKey) -> Optional[str]:
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            query = f'''SELECT state FROM t_p5255237_telegram_bot_service.bot_fsm_states 
-                   WHERE bot_id = {key.bot_id} AND chat_id = '{key.chat_id}'::bigint AND user_id = '{key.user_id}'::bigint'''
-            cursor.execute(query)
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            return result[0] if result and result[0] else None
+            state = await db.fetchval(
+                '''SELECT state FROM t_p5255237_telegram_bot_service.bot_fsm_states 
+                   WHERE bot_id = $1 AND chat_id = $2 AND user_id = $3''',
+                key.bot_id, key.chat_id, key.user_id
+            )
+            return state or None
         except Exception as e:
             print(f"[ERROR] get_state failed: {e}")
             return None
     
     async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            data_json = json.dumps(data).replace("'", "''")
-            
-            query = f'''INSERT INTO t_p5255237_telegram_bot_service.bot_fsm_states 
+            await db.execute(
+                '''INSERT INTO t_p5255237_telegram_bot_service.bot_fsm_states 
                    (bot_id, chat_id, user_id, data) 
-                   VALUES ({key.bot_id}, '{key.chat_id}'::bigint, '{key.user_id}'::bigint, '{data_json}')
+                   VALUES ($1, $2, $3, $4)
                    ON CONFLICT (bot_id, chat_id, user_id) 
-                   DO UPDATE SET data = '{data_json}', updated_at = CURRENT_TIMESTAMP'''
-            
-            print(f"[DEBUG] set_data query: {query[:200]}...")
-            cursor.execute(query)
-            conn.commit()
-            cursor.close()
-            conn.close()
+                   DO UPDATE SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP''',
+                key.bot_id, key.chat_id, key.user_id, data
+            )
         except Exception as e:
             print(f"[ERROR] set_data failed: {e}")
-            print(f"[ERROR] Query was: {query[:200] if 'query' in locals() else 'N/A'}...")
     
     async def get_data(self, key: StorageKey) -> Dict[str, Any]:
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            query = f'''SELECT data FROM t_p5255237_telegram_bot_service.bot_fsm_states 
-                   WHERE bot_id = {key.bot_id} AND chat_id = '{key.chat_id}'::bigint AND user_id = '{key.user_id}'::bigint'''
-            cursor.execute(query)
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            if result and result[0]:
-                return json.loads(result[0])
-            return {}
+            data = await db.fetchval(
+                '''SELECT data FROM t_p5255237_telegram_bot_service.bot_fsm_states 
+                   WHERE bot_id = $1 AND chat_id = $2 AND user_id = $3''',
+                key.bot_id, key.chat_id, key.user_id
+            )
+            return data or {}
         except Exception as e:
             print(f"[ERROR] get_data failed: {e}")
             return {}
@@ -103,297 +90,727 @@ class PostgresStorage(BaseStorage):
     async def close(self) -> None:
         pass
 
-def get_db_connection():
-    '''Создает подключение к базе данных'''
-    database_url = os.environ.get('DATABASE_URL', '')
-    if not database_url:
-        raise Exception('DATABASE_URL not configured')
-    return psycopg2.connect(database_url)
-
-def get_active_bots() -> list:
-    '''Получить все активные боты из БД'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = '''SELECT * FROM t_p5255237_telegram_bot_service.bots 
-               WHERE status = 'active' AND moderation_status = 'approved' '''
-    cursor.execute(query)
-    bots = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [dict(bot) for bot in bots]
-
-def register_telegram_user(bot_id: int, user: types.User) -> int:
-    '''Регистрирует пользователя Telegram в базе данных'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    username_escaped = (user.username or '').replace("'", "''")
-    first_name_escaped = (user.first_name or '').replace("'", "''")
-    last_name_escaped = (user.last_name or '').replace("'", "''")
-    
-    check_query = f'''SELECT id FROM t_p5255237_telegram_bot_service.bot_users 
-                     WHERE bot_id = {bot_id} AND telegram_user_id = {user.id}'''
-    cursor.execute(check_query)
-    existing = cursor.fetchone()
+class AsyncDatabase:
+    '''Пул asyncpg-соединений, который живет вместе с event loop контейнера'''
+    
+    def __init__(self, min_size: int = 1, max_size: int = 5, statement_cache_size: int = 100):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self._pool: Optional[asyncpg.Pool] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.stats = {'queries': 0, 'pools_created': 0}
+    
+    @staticmethod
+    async def _init_connection(conn: asyncpg.Connection) -> None:
+        # Как и psycopg2, отдаем json/jsonb уже разобранными
+        for type_name in ('json', 'jsonb'):
+            await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+    
+    async def pool(self) -> asyncpg.Pool:
+        loop = asyncio.get_running_loop()
+        if self._pool is not None and self._loop is loop:
+            return self._pool
+        if self._lock is None or self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+            self._pool = None
+        async with self._lock:
+            if self._pool is None:
+                database_url = os.environ.get('DATABASE_URL', '')
+                if not database_url:
+                    raise Exception('DATABASE_URL not configured')
+                self._pool = await asyncpg.create_pool(
+                    database_url,
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                    statement_cache_size=self.statement_cache_size,
+                    init=self._init_connection
+                )
+                self.stats['pools_created'] += 1
+        return self._pool
+    
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        '''Соединение из пула для нескольких запросов подряд (например, в одной транзакции)'''
+        self.stats['queries'] += 1
+        pool = await self.pool()
+        async with pool.acquire() as conn:
+            yield conn
+    
+    async def fetch(self, query: str, *args) -> List[Dict]:
+        self.stats['queries'] += 1
+        pool = await self.pool()
+        return [dict(row) for row in await pool.fetch(query, *args)]
+    
+    async def fetchrow(self, query: str, *args) -> Optional[Dict]:
+        self.stats['queries'] += 1
+        pool = await self.pool()
+        row = await pool.fetchrow(query, *args)
+        return dict(row) if row else None
+    
+    async def fetchval(self, query: str, *args) -> Any:
+        self.stats['queries'] += 1
+        pool = await self.pool()
+        return await pool.fetchval(query, *args)
+    
+    async def execute(self, query: str, *args) -> str:
+        self.stats['queries'] += 1
+        pool = await self.pool()
+        return await pool.execute(query, *args)
     
-    if existing:
-        user_id = existing['id']
-    else:
-        insert_query = f'''INSERT INTO t_p5255237_telegram_bot_service.bot_users 
-                          (bot_id, telegram_user_id, username, first_name, last_name)
-                          VALUES ({bot_id}, {user.id}, '{username_escaped}', '{first_name_escaped}', '{last_name_escaped}')
-                          RETURNING id'''
-        cursor.execute(insert_query)
-        user_id = cursor.fetchone()['id']
-        conn.commit()
-    
-    cursor.close()
-    conn.close()
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+db = AsyncDatabase(
+    max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')),
+    # При работе через pgbouncer в режиме transaction кэш prepared statements нужно отключить (0)
+    statement_cache_size=int(os.environ.get('DB_STATEMENT_CACHE_SIZE', '100'))
+)
+
+async def get_active_bots() -> list:
+    '''Получить список активных ботов (только id и имя, без тяжелых текстовых полей)'''
+    return await db.fetch(
+        '''SELECT id, name FROM t_p5255237_telegram_bot_service.bots 
+           WHERE status = 'active' AND moderation_status = 'approved'
+           ORDER BY id'''
+    )
+
+async def register_telegram_user(bot_id: int, user: types.User) -> int:
+    '''Регистрирует пользователя Telegram в базе данных'''
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(
+            '''SELECT id, is_blocked FROM t_p5255237_telegram_bot_service.bot_users 
+               WHERE bot_id = $1 AND telegram_user_id = $2''',
+            bot_id, user.id
+        )
+        user_id = row['id'] if row else None
+        if row and row['is_blocked']:
+            # Пользователь снова пишет боту - значит разблокировал, возвращаем его в рассылки
+            await conn.execute(
+                '''UPDATE t_p5255237_telegram_bot_service.bot_users 
+                   SET is_blocked = FALSE, blocked_at = NULL WHERE id = $1''',
+                user_id
+            )
+        if user_id is None:
+            user_id = await conn.fetchval(
+                '''INSERT INTO t_p5255237_telegram_bot_service.bot_users 
+                   (bot_id, telegram_user_id, username, first_name, last_name)
+                   VALUES ($1, $2, $3, $4, $5)
+                   RETURNING id''',
+                bot_id, user.id, user.username or '', user.first_name or '', user.last_name or ''
+            )
     return user_id
 
-def get_free_qr_key(bot_id: int, user_id: int, telegram_user_id: int = None) -> Optional[Dict]:
+async def allocate_qr_key(bot_id: int, code_type: str, user_id: Optional[int],
+                          respect_leases: bool = True) -> Optional[Dict]:
+    '''Атомарно выдать первый свободный QR-ключ: конкурентные вызовы пропускают чужие блокировки.
+    С respect_leases=False берутся и ключи, арендованные другими воркерами (их выдача из блока просто не пройдет)'''
+    lease_condition = 'AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP)' if respect_leases else ''
+    return await db.fetchrow(
+        f'''UPDATE t_p5255237_telegram_bot_service.qr_codes 
+            SET is_used = true, used_by_user_id = $3, used_at = CURRENT_TIMESTAMP,
+                lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = (
+                SELECT id FROM t_p5255237_telegram_bot_service.qr_codes 
+                WHERE bot_id = $1 AND code_type = $2 AND is_used = false 
+                {lease_condition}
+                ORDER BY code_number LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *''',
+        bot_id, code_type, user_id
+    )
+
+class QrKeyLeasePool:
+    '''Блоки свободных QR-ключей, заранее арендованные воркером и выдаваемые без поиска по таблице'''
+    
+    def __init__(self, block_size: int = 20, lease_ttl: float = 60.0):
+        self.block_size = block_size
+        self.lease_ttl = lease_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._blocks: Dict[Tuple[int, str], Dict[str, Any]] = {}
+        self._locks: Dict[Tuple[int, str], asyncio.Lock] = {}
+        self.stats = {'leased_blocks': 0, 'leased_keys': 0, 'issued': 0, 'lost_leases': 0, 'expired_blocks': 0, 'fallbacks': 0}
+    
+    @property
+    def enabled(self) -> bool:
+        return self.block_size > 0
+    
+    async def _lease_block(self, bot_id: int, code_type: str) -> None:
+        rows = await db.fetch(
+            '''UPDATE t_p5255237_telegram_bot_service.qr_codes 
+               SET lease_owner = $3, lease_expires_at = CURRENT_TIMESTAMP + $4 * INTERVAL '1 second'
+               WHERE id IN (
+                   SELECT id FROM t_p5255237_telegram_bot_service.qr_codes 
+                   WHERE bot_id = $1 AND code_type = $2 AND is_used = false 
+                   AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP OR lease_owner = $3)
+                   ORDER BY code_number LIMIT $5
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING id, code_number''',
+            bot_id, code_type, self.owner, self.lease_ttl, self.block_size
+        )
+        self.stats['leased_blocks'] += 1
+        self.stats['leased_keys'] += len(rows)
+        # Локальный срок чуть короче серверного, чтобы не выдавать ключи на границе аренды
+        self._blocks[(bot_id, code_type)] = {
+            'ids': deque(row['id'] for row in sorted(rows, key=lambda row: row['code_number'])),
+            'expires_at': time.monotonic() + self.lease_ttl * 0.9
+        }
+    
+    def _pop_leased_id(self, key: Tuple[int, str]) -> Optional[int]:
+        block = self._blocks.get(key)
+        if not block:
+            return None
+        if time.monotonic() >= block['expires_at']:
+            # Невыданные ключи вернутся в общий пул сами: просроченная аренда для выборки не считается
+            self.stats['expired_blocks'] += 1
+            del self._blocks[key]
+            return None
+        if not block['ids']:
+            return None
+        return block['ids'].popleft()
+    
+    def _has_leased(self, key: Tuple[int, str]) -> bool:
+        block = self._blocks.get(key)
+        return bool(block and block['ids'] and time.monotonic() < block['expires_at'])
+    
+    async def issue(self, bot_id: int, code_type: str, user_id: Optional[int]) -> Optional[Dict]:
+        '''Выдать ключ из арендованного блока, при необходимости арендовав новый'''
+        key = (bot_id, code_type)
+        refilled = False
+        while True:
+            code_id = self._pop_leased_id(key)
+            if code_id is None:
+                if refilled:
+                    # Свободных неарендованных ключей нет, но они могут оставаться в блоках других воркеров
+                    self.stats['fallbacks'] += 1
+                    qr_code = await allocate_qr_key(bot_id, code_type, user_id, respect_leases=False)
+                    if qr_code:
+                        self.stats['issued'] += 1
+                    return qr_code
+                lock = self._locks.setdefault(key, asyncio.Lock())
+                async with lock:
+                    # Пока ждали блокировку, блок мог арендовать соседний запрос
+                    if self._has_leased(key):
+                        continue
+                    await self._lease_block(bot_id, code_type)
+                refilled = True
+                continue
+            
+            qr_code = await db.fetchrow(
+                '''UPDATE t_p5255237_telegram_bot_service.qr_codes 
+                   SET is_used = true, used_by_user_id = $2, used_at = CURRENT_TIMESTAMP,
+                       lease_owner = NULL, lease_expires_at = NULL
+                   WHERE id = $1 AND lease_owner = $3 AND is_used = false
+                   RETURNING *''',
+                code_id, user_id, self.owner
+            )
+            if qr_code:
+                self.stats['issued'] += 1
+                return qr_code
+            # Аренда истекла и ключ забрал другой воркер - берем следующий
+            self.stats['lost_leases'] += 1
+    
+    async def release_all(self) -> None:
+        '''Вернуть в общий пул все невыданные ключи этого воркера'''
+        self._blocks.clear()
+        await db.execute(
+            '''UPDATE t_p5255237_telegram_bot_service.qr_codes 
+               SET lease_owner = NULL, lease_expires_at = NULL
+               WHERE lease_owner = $1 AND is_used = false''',
+            self.owner
+        )
+
+qr_leases = QrKeyLeasePool(
+    block_size=int(os.environ.get('QR_LEASE_BLOCK_SIZE', '20')),
+    lease_ttl=float(os.environ.get('QR_LEASE_TTL', '60'))
+)
+
+async def _take_qr_key(bot_id: int, user_id: int, code_type: str, is_user_admin: bool) -> Optional[Dict]:
+    '''Выдать QR-ключ указанного типа (админу - первый по номеру, без пометки использованным)'''
+    if is_user_admin:
+        return await db.fetchrow(
+            '''SELECT * FROM t_p5255237_telegram_bot_service.qr_codes 
+               WHERE bot_id = $1 AND code_type = $2
+               ORDER BY code_number LIMIT 1''',
+            bot_id, code_type
+        )
+    if qr_leases.enabled:
+        return await qr_leases.issue(bot_id, code_type, user_id)
+    return await allocate_qr_key(bot_id, code_type, user_id)
+
+async def get_free_qr_key(bot_id: int, user_id: int, is_user_admin: bool = False) -> Optional[Dict]:
     '''Получить свободный бесплатный QR-ключ'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    return await _take_qr_key(bot_id, user_id, 'free', is_user_admin)
+
+async def save_payment_to_db(bot_id: int, telegram_user_id: int, order_id: str, payment_id: str, 
+                             payment_url: str, amount: int, phone: str, first_name: str, last_name: str) -> bool:
+    '''Сохранить платёж в БД'''
+    try:
+        await db.execute(
+            '''INSERT INTO t_p5255237_telegram_bot_service.payments 
+               (bot_id, telegram_user_id, order_id, payment_id, payment_url, amount, status, 
+                customer_phone, customer_first_name, customer_last_name, created_at)
+               VALUES ($1, $2, $3, $4, $5, $6, 'NEW', $7, $8, $9, CURRENT_TIMESTAMP)''',
+            bot_id, telegram_user_id, order_id, str(payment_id), payment_url, Decimal(str(amount)),
+            phone, first_name, last_name
+        )
+        return True
+    except Exception:
+        return False
+
+# Статус платежа приходит уведомлением T-Bank, опрос - страховка: первая проверка через минуту,
+# следующие планирует job-worker
+PAYMENT_CHECK_FIRST_DELAY = int(os.environ.get('PAYMENT_CHECK_FIRST_DELAY', '60'))
+
+async def enqueue_job(job_type: str, payload: Dict, delay_seconds: int = 0,
+                      dedup_key: Optional[str] = None, max_attempts: int = 5) -> None:
+    '''Поставить задачу в очередь job-worker; повтор с тем же dedup_key игнорируется'''
+    await db.execute(
+        '''INSERT INTO t_p5255237_telegram_bot_service.jobs 
+           (job_type, payload, run_at, max_attempts, dedup_key)
+           VALUES ($1, $2, CURRENT_TIMESTAMP + $3 * INTERVAL '1 second', $4, $5)
+           ON CONFLICT (dedup_key) DO NOTHING''',
+        job_type, payload, delay_seconds, max_attempts, dedup_key
+    )
+
+# Копия блока отрисовки и кэша QR из job-worker/index.py (функции деплоятся по отдельности): ключи кэша
+# и PNG должны совпадать с job-worker, иначе заранее отрисованные файлы не находятся (сверяет test_engine.py)
+QR_RENDER_VERSION = 1
+
+def render_qr_png(payload: str, variant: str) -> bytes:
+    '''Отрисовывает QR-код как PNG: free - только код, vip - код на VIP обложке'''
+    import qrcode
+    from PIL import Image, ImageDraw
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill_color="black", back_color="white")
     
-    is_user_admin = is_admin(bot_id, telegram_user_id) if telegram_user_id else False
+    if variant != 'vip':
+        bio = BytesIO()
+        qr_img.save(bio, 'PNG')
+        return bio.getvalue()
     
-    if is_user_admin:
-        query = f'''SELECT * FROM t_p5255237_telegram_bot_service.qr_codes 
-                   WHERE bot_id = {bot_id} AND code_type = 'free'
-                   ORDER BY code_number LIMIT 1'''
-    else:
-        query = f'''SELECT * FROM t_p5255237_telegram_bot_service.qr_codes 
-                   WHERE bot_id = {bot_id} AND code_type = 'free' AND is_used = false 
-                   ORDER BY code_number LIMIT 1'''
+    qr_size = qr_img.size[0]
+    cover_width = qr_size
+    cover_height = int(qr_size * 1.4)
+    
+    cover = Image.new('RGB', (cover_width, cover_height), color='#E8F5E9')
+    draw = ImageDraw.Draw(cover, 'RGBA')
     
-    cursor.execute(query)
-    qr_code = cursor.fetchone()
+    watermark_color = (129, 199, 132, 40)
     
-    if qr_code and not is_user_admin:
-        update_query = f'''UPDATE t_p5255237_telegram_bot_service.qr_codes 
-                          SET is_used = true, used_by_user_id = {user_id}, used_at = CURRENT_TIMESTAMP 
-                          WHERE id = {qr_code['id']}'''
-        cursor.execute(update_query)
-        conn.commit()
+    for i in range(-2, 6):
+        y_pos = i * 80
+        draw.text((20, y_pos), 'VIP', fill=watermark_color, font=None)
+        draw.text((cover_width - 80, y_pos + 40), 'VIP', fill=watermark_color, font=None)
     
-    cursor.close()
-    conn.close()
-    return dict(qr_code) if qr_code else None
+    title_y = 20
+    draw.text((cover_width // 2 - 50, title_y), '💎 VIP ACCESS', fill='#2E7D32', font=None)
+    
+    qr_y = 80
+    cover.paste(qr_img, (0, qr_y))
+    
+    bio = BytesIO()
+    cover.save(bio, 'PNG')
+    return bio.getvalue()
+
+class LruCache:
+    '''Словарь не больше max_items элементов: при переполнении вытесняется давно не использованный'''
+    
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: OrderedDict = OrderedDict()
+    
+    def get(self, key: Any) -> Any:
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+    
+    def put(self, key: Any, value: Any) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+    
+    def pop(self, key: Any) -> None:
+        self._items.pop(key, None)
 
-def get_vip_qr_key(bot_id: int, user_id: int, telegram_user_id: int = None) -> Optional[Dict]:
-    '''Получить свободный VIP QR-ключ'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+class QrImageCache:
+    '''Готовые PNG QR-кодов ключей по (code_number, variant): LRU в памяти процесса и content-addressed каталог на диске'''
     
-    is_user_admin = is_admin(bot_id, telegram_user_id) if telegram_user_id else False
+    def __init__(self, directory: str, max_items: int = 256):
+        self.directory = directory
+        self._memory = LruCache(max_items)
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'renders': 0, 'disk_errors': 0}
     
-    if is_user_admin:
-        query = f'''SELECT * FROM t_p5255237_telegram_bot_service.qr_codes 
-                   WHERE bot_id = {bot_id} AND code_type = 'paid'
-                   ORDER BY code_number LIMIT 1'''
-    else:
-        query = f'''SELECT * FROM t_p5255237_telegram_bot_service.qr_codes 
-                   WHERE bot_id = {bot_id} AND code_type = 'paid' AND is_used = false 
-                   ORDER BY code_number LIMIT 1'''
-    
-    cursor.execute(query)
-    qr_code = cursor.fetchone()
-    
-    if qr_code and not is_user_admin:
-        update_query = f'''UPDATE t_p5255237_telegram_bot_service.qr_codes 
-                          SET is_used = true, used_by_user_id = {user_id}, used_at = CURRENT_TIMESTAMP 
-                          WHERE id = {qr_code['id']}'''
-        cursor.execute(update_query)
-        conn.commit()
-    
-    cursor.close()
-    conn.close()
-    return dict(qr_code) if qr_code else None
-
-def save_payment_to_db(bot_id: int, telegram_user_id: int, order_id: str, payment_id: str, 
-                       payment_url: str, amount: int, phone: str, first_name: str, last_name: str) -> bool:
-    '''Сохранить платёж в БД'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    @staticmethod
+    def payload(code_number: int) -> str:
+        return f'POLYTOPE_KEY_{code_number}'
     
-    phone_escaped = phone.replace("'", "''")
-    first_name_escaped = first_name.replace("'", "''")
-    last_name_escaped = last_name.replace("'", "''")
-    order_id_escaped = order_id.replace("'", "''")
-    payment_id_escaped = payment_id.replace("'", "''")
-    payment_url_escaped = payment_url.replace("'", "''")
+    @staticmethod
+    def key(code_number: int, variant: str) -> str:
+        payload = QrImageCache.payload(code_number)
+        return hashlib.sha256(f'{QR_RENDER_VERSION}:{variant}:{payload}'.encode('utf-8')).hexdigest()
     
-    query = f'''INSERT INTO t_p5255237_telegram_bot_service.payments 
-               (bot_id, telegram_user_id, order_id, payment_id, payment_url, amount, status, 
-                customer_phone, customer_first_name, customer_last_name, created_at)
-               VALUES ({bot_id}, {telegram_user_id}, '{order_id_escaped}', '{payment_id_escaped}', 
-                       '{payment_url_escaped}', {amount}, 'NEW', '{phone_escaped}', 
-                       '{first_name_escaped}', '{last_name_escaped}', CURRENT_TIMESTAMP)'''
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f'{key}.png')
     
-    try:
-        cursor.execute(query)
-        conn.commit()
-        cursor.close()
-        conn.close()
+    def _read(self, key: str) -> Optional[bytes]:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError:
+            self.stats['disk_errors'] += 1
+            return None
+    
+    def _write(self, key: str, image: bytes) -> None:
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(image)
+            os.replace(tmp_path, path)
+        except OSError:
+            self.stats['disk_errors'] += 1
+    
+    def _render(self, code_number: int, variant: str, key: str) -> bytes:
+        image = render_qr_png(self.payload(code_number), variant)
+        self.stats['renders'] += 1
+        self._write(key, image)
+        return image
+    
+    def get(self, code_number: int, variant: str) -> bytes:
+        key = self.key(code_number, variant)
+        with self._lock:
+            image = self._memory.get(key)
+        if image is not None:
+            self.stats['memory_hits'] += 1
+            return image
+        
+        image = self._read(key)
+        if image is not None:
+            self.stats['disk_hits'] += 1
+        else:
+            image = self._render(code_number, variant, key)
+        with self._lock:
+            self._memory.put(key, image)
+        return image
+    
+    def prerender(self, code_number: int, variant: str) -> bool:
+        '''Отрисовать в дисковый кэш, не вытесняя LRU; False - файл уже был'''
+        key = self.key(code_number, variant)
+        if self.directory and os.path.exists(self._path(key)):
+            return False
+        self._render(code_number, variant, key)
         return True
-    except:
-        cursor.close()
-        conn.close()
-        return False
 
-def generate_qr_image(code_number: int) -> BytesIO:
-    '''Генерирует QR-код как изображение'''
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(f'POLYTOPE_KEY_{code_number}')
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    bio = BytesIO()
-    img.save(bio, 'PNG')
-    bio.seek(0)
-    return bio
-
-def get_bot_settings(bot_id: int) -> Optional[Dict]:
-    '''Получить настройки бота'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = f'SELECT * FROM t_p5255237_telegram_bot_service.bots WHERE id = {bot_id}'
-    cursor.execute(query)
-    bot = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return dict(bot) if bot else None
-
-def is_admin(bot_id: int, telegram_user_id: int) -> bool:
-    '''Проверка является ли пользователь администратором бота'''
-    bot_settings = get_bot_settings(bot_id)
-    if not bot_settings:
-        return False
-    admin_ids = bot_settings.get('admin_telegram_ids', [])
-    return telegram_user_id in admin_ids
+qr_image_cache = QrImageCache(
+    directory=os.environ.get('QR_CACHE_DIR', '/tmp/qr-cache'),
+    max_items=int(os.environ.get('QR_CACHE_MAX_ITEMS', '256'))
+)
 
-def save_privacy_consent(bot_id: int, user_id: int, telegram_user_id: int, consent_text: str, unique_code: str) -> bool:
-    '''Сохранить согласие на обработку персональных данных'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+def generate_qr_image(code_number: int, variant: str = 'free') -> bytes:
+    '''PNG QR-кода ключа (free или vip) из кэша; отрисовывается при первом обращении'''
+    return qr_image_cache.get(code_number, variant)
+
+def qr_asset_key(code_number: int, variant: str) -> str:
+    '''Ключ картинки QR-кода для кэша file_id (совпадает с ключом дискового кэша отрисовки)'''
+    return f"qr:{QrImageCache.key(code_number, variant)}"
+
+
+def url_asset_key(url: str) -> str:
+    return f"url:{hashlib.sha256(url.encode('utf-8')).hexdigest()}"
+
+class TelegramFileCache:
+    '''file_id уже загруженных в Telegram картинок по (bot_id, asset_key): LRU в памяти и таблица telegram_file_ids'''
+    
+    def __init__(self, max_items: int = 2048):
+        self._memory = LruCache(max_items)
+        self.stats = {'hits': 0, 'db_hits': 0, 'uploads': 0, 'invalidated': 0}
+    
+    async def get(self, bot_id: int, asset_key: str) -> Optional[str]:
+        file_id = self._memory.get((bot_id, asset_key))
+        if file_id is not None:
+            self.stats['hits'] += 1
+            return file_id
+        file_id = await db.fetchval(
+            '''SELECT file_id FROM t_p5255237_telegram_bot_service.telegram_file_ids 
+               WHERE bot_id = $1 AND asset_key = $2''',
+            bot_id, asset_key
+        )
+        if file_id is not None:
+            self.stats['db_hits'] += 1
+            self._memory.put((bot_id, asset_key), file_id)
+        return file_id
+    
+    async def put(self, bot_id: int, asset_key: str, file_id: str) -> None:
+        self._memory.put((bot_id, asset_key), file_id)
+        await db.execute(
+            '''INSERT INTO t_p5255237_telegram_bot_service.telegram_file_ids (bot_id, asset_key, file_id)
+               VALUES ($1, $2, $3)
+               ON CONFLICT (bot_id, asset_key) DO UPDATE 
+               SET file_id = EXCLUDED.file_id, updated_at = CURRENT_TIMESTAMP''',
+            bot_id, asset_key, file_id
+        )
     
-    consent_text_escaped = consent_text.replace("'", "''")
-    unique_code_escaped = unique_code.replace("'", "''")
+    async def forget(self, bot_id: int, asset_key: str) -> None:
+        self.stats['invalidated'] += 1
+        self._memory.pop((bot_id, asset_key))
+        await db.execute(
+            '''DELETE FROM t_p5255237_telegram_bot_service.telegram_file_ids 
+               WHERE bot_id = $1 AND asset_key = $2''',
+            bot_id, asset_key
+        )
     
-    query = f'''INSERT INTO t_p5255237_telegram_bot_service.privacy_consents 
+    async def send_photo(self, bot_id: int, asset_key: str, send: Callable[[Any], Awaitable[types.Message]],
+                         photo: Callable[[], Any]) -> types.Message:
+        '''Отправить картинку по сохраненному file_id; при первой отправке загрузить photo() и запомнить file_id'''
+        file_id = await self.get(bot_id, asset_key)
+        if file_id is not None:
+            try:
+                return await send(file_id)
+            except TelegramBadRequest as e:
+                # file_id мог стать недействительным - загружаем файл заново
+                if 'file' not in e.message.lower():
+                    raise
+                await self.forget(bot_id, asset_key)
+        
+        sent = await send(photo())
+        self.stats['uploads'] += 1
+        if sent.photo:
+            # Фото уже доставлено: ошибка записи кэша не должна превращать Update в повторную доставку
+            try:
+                await self.put(bot_id, asset_key, sent.photo[-1].file_id)
+            except Exception as e:
+                print(f"[WARN] file_id for bot {bot_id} not saved: {e}")
+        return sent
+
+telegram_file_cache = TelegramFileCache(max_items=int(os.environ.get('TELEGRAM_FILE_CACHE_MAX_ITEMS', '2048')))
+
+class BotConfigCache:
+    '''Кэш настроек ботов в памяти процесса с инвалидацией по config_version'''
+    
+    def __init__(self, ttl: float = 300.0, version_check_interval: float = 5.0):
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self._by_id: Dict[int, Dict[str, Any]] = {}
+        self._id_by_token_hash: Dict[str, int] = {}
+        self.stats = {'hits': 0, 'version_checks': 0, 'loads': 0}
+    
+    @staticmethod
+    def token_hash(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+    
+    def _store(self, bot: Optional[Dict]) -> Optional[Dict]:
+        if not bot:
+            return None
+        bot = dict(bot)
+        now = time.monotonic()
+        self._by_id[bot['id']] = {'bot': bot, 'loaded_at': now, 'checked_at': now}
+        self._id_by_token_hash[self.token_hash(bot['telegram_token'])] = bot['id']
+        return bot
+    
+    async def _load_by_id(self, bot_id: int) -> Optional[Dict]:
+        self.stats['loads'] += 1
+        bot = await db.fetchrow('SELECT * FROM t_p5255237_telegram_bot_service.bots WHERE id = $1', bot_id)
+        if not bot:
+            self._by_id.pop(bot_id, None)
+        return self._store(bot)
+    
+    async def _load_by_token(self, token: str) -> Optional[Dict]:
+        self.stats['loads'] += 1
+        bot = await db.fetchrow(
+            '''SELECT * FROM t_p5255237_telegram_bot_service.bots 
+               WHERE telegram_token = $1 
+               ORDER BY (status = 'active' AND moderation_status = 'approved') DESC, id
+               LIMIT 1''',
+            token
+        )
+        return self._store(bot)
+    
+    async def _fetch_version(self, bot_id: int) -> Optional[int]:
+        self.stats['version_checks'] += 1
+        return await db.fetchval('SELECT config_version FROM t_p5255237_telegram_bot_service.bots WHERE id = $1', bot_id)
+    
+    async def get(self, bot_id: int) -> Optional[Dict]:
+        '''Настройки бота по id; в Postgres идем только если версия изменилась или истек TTL'''
+        entry = self._by_id.get(bot_id)
+        now = time.monotonic()
+        if entry and now - entry['loaded_at'] < self.ttl:
+            if now - entry['checked_at'] < self.version_check_interval:
+                self.stats['hits'] += 1
+                return entry['bot']
+            version = await self._fetch_version(bot_id)
+            entry['checked_at'] = now
+            if version is not None and version == entry['bot'].get('config_version'):
+                self.stats['hits'] += 1
+                return entry['bot']
+        return await self._load_by_id(bot_id)
+    
+    async def get_by_token(self, token: str) -> Optional[Dict]:
+        '''Настройки бота по токену (ключ кэша - хэш токена)'''
+        bot_id = self._id_by_token_hash.get(self.token_hash(token))
+        if bot_id is not None:
+            bot = await self.get(bot_id)
+            if bot and bot['telegram_token'] == token:
+                return bot
+            self._id_by_token_hash.pop(self.token_hash(token), None)
+        return await self._load_by_token(token)
+
+bot_config_cache = BotConfigCache(
+    ttl=float(os.environ.get('BOT_CONFIG_CACHE_TTL', '300')),
+    version_check_interval=float(os.environ.get('BOT_CONFIG_VERSION_CHECK_INTERVAL', '5'))
+)
+
+async def get_bot_settings(bot_id: int) -> Optional[Dict]:
+    '''Получить настройки бота (из кэша; возвращаемый словарь нельзя изменять)'''
+    return await bot_config_cache.get(bot_id)
+
+async def is_bot_active(bot_id: int) -> bool:
+    '''Проверить, что бот запущен и одобрен модерацией (поиск по первичному ключу через кэш)'''
+    bot = await get_bot_settings(bot_id)
+    return bool(bot) and bot['status'] == 'active' and bot['moderation_status'] == 'approved'
+
+class BotContext:
+    '''Данные одного Update, загружаемые один раз и общие для всех обработчиков'''
+    
+    def __init__(self, bot_id: int, bot_settings: Dict, from_user: Optional[types.User]):
+        self.bot_id = bot_id
+        self.bot_settings = bot_settings
+        self.admin_ids = set(bot_settings.get('admin_telegram_ids') or [])
+        self.from_user = from_user
+        self._user_id: Optional[int] = None
+        self._has_consent: Optional[bool] = None
+    
+    @property
+    def telegram_user_id(self) -> Optional[int]:
+        return self.from_user.id if self.from_user else None
+    
+    @property
+    def is_admin(self) -> bool:
+        '''Является ли пользователь администратором бота'''
+        return self.telegram_user_id in self.admin_ids
+    
+    async def get_user_id(self) -> int:
+        '''Id пользователя в bot_users, регистрирует его при первом обращении'''
+        if self._user_id is None:
+            self._user_id = await register_telegram_user(self.bot_id, self.from_user)
+        return self._user_id
+    
+    async def has_consent(self) -> bool:
+        '''Принял ли пользователь согласие на обработку данных'''
+        if self._has_consent is None:
+            self._has_consent = await check_privacy_consent(self.bot_id, await self.get_user_id())
+        return self._has_consent
+    
+    def set_consent(self, value: bool) -> None:
+        self._has_consent = value
+
+async def save_privacy_consent(bot_id: int, user_id: int, telegram_user_id: int, consent_text: str, unique_code: str) -> bool:
+    '''Сохранить согласие на обработку персональных данных'''
+    try:
+        await db.execute(
+            '''INSERT INTO t_p5255237_telegram_bot_service.privacy_consents 
                (bot_id, user_id, telegram_user_id, consent_text, user_unique_code, accepted_at)
-               VALUES ({bot_id}, {user_id}, {telegram_user_id}, '{consent_text_escaped}', '{unique_code_escaped}', CURRENT_TIMESTAMP)
+               VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
                ON CONFLICT (bot_id, user_id) DO UPDATE 
-               SET accepted_at = CURRENT_TIMESTAMP, consent_text = '{consent_text_escaped}' '''
-    
-    try:
-        cursor.execute(query)
-        conn.commit()
-        cursor.close()
-        conn.close()
+               SET accepted_at = CURRENT_TIMESTAMP, consent_text = EXCLUDED.consent_text''',
+            bot_id, user_id, telegram_user_id, consent_text, unique_code
+        )
         return True
     except Exception as e:
-        cursor.close()
-        conn.close()
         return False
 
-def check_privacy_consent(bot_id: int, user_id: int) -> bool:
+async def check_privacy_consent(bot_id: int, user_id: int) -> bool:
     '''Проверить, принял ли пользователь согласие'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = f'''SELECT id FROM t_p5255237_telegram_bot_service.privacy_consents 
-               WHERE bot_id = {bot_id} AND user_id = {user_id}'''
-    cursor.execute(query)
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return result is not None
-
-def get_shop_categories(bot_id: int) -> list:
+    consent_id = await db.fetchval(
+        '''SELECT id FROM t_p5255237_telegram_bot_service.privacy_consents 
+           WHERE bot_id = $1 AND user_id = $2''',
+        bot_id, user_id
+    )
+    return consent_id is not None
+
+async def get_shop_categories(bot_id: int) -> list:
     '''Получить категории товаров магазина'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = f'''SELECT * FROM t_p5255237_telegram_bot_service.shop_categories 
-               WHERE bot_id = {bot_id} AND is_active = true 
-               ORDER BY sort_order, name'''
-    cursor.execute(query)
-    categories = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [dict(cat) for cat in categories]
-
-def get_shop_products(bot_id: int, category_id: int = None) -> list:
+    return await db.fetch(
+        '''SELECT * FROM t_p5255237_telegram_bot_service.shop_categories 
+           WHERE bot_id = $1 AND is_active = true 
+           ORDER BY sort_order, name''',
+        bot_id
+    )
+
+async def get_shop_products(bot_id: int, category_id: int = None) -> list:
     '''Получить товары магазина, опционально по категории'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
     if category_id:
-        query = f'''SELECT * FROM t_p5255237_telegram_bot_service.shop_products 
-                   WHERE bot_id = {bot_id} AND category_id = {category_id} AND is_available = true 
-                   ORDER BY sort_order, name'''
-    else:
-        query = f'''SELECT * FROM t_p5255237_telegram_bot_service.shop_products 
-                   WHERE bot_id = {bot_id} AND is_available = true 
-                   ORDER BY sort_order, name'''
-    cursor.execute(query)
-    products = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [dict(prod) for prod in products]
-
-def add_to_cart(bot_id: int, user_id: int, product_id: int, quantity: int = 1) -> bool:
+        return await db.fetch(
+            '''SELECT * FROM t_p5255237_telegram_bot_service.shop_products 
+               WHERE bot_id = $1 AND category_id = $2 AND is_available = true 
+               ORDER BY sort_order, name''',
+            bot_id, category_id
+        )
+    return await db.fetch(
+        '''SELECT * FROM t_p5255237_telegram_bot_service.shop_products 
+           WHERE bot_id = $1 AND is_available = true 
+           ORDER BY sort_order, name''',
+        bot_id
+    )
+
+async def add_to_cart(bot_id: int, user_id: int, product_id: int, quantity: int = 1) -> bool:
     '''Добавить товар в корзину пользователя'''
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = f'''INSERT INTO t_p5255237_telegram_bot_service.shop_carts 
-               (bot_id, user_id, product_id, quantity) 
-               VALUES ({bot_id}, {user_id}, {product_id}, {quantity})
-               ON CONFLICT (user_id, product_id) 
-               DO UPDATE SET quantity = shop_carts.quantity + {quantity}'''
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-    conn.close()
+    await db.execute(
+        '''INSERT INTO t_p5255237_telegram_bot_service.shop_carts 
+           (bot_id, user_id, product_id, quantity) 
+           VALUES ($1, $2, $3, $4)
+           ON CONFLICT (user_id, product_id) 
+           DO UPDATE SET quantity = shop_carts.quantity + EXCLUDED.quantity''',
+        bot_id, user_id, product_id, quantity
+    )
     return True
 
-def get_user_cart(bot_id: int, user_id: int) -> list:
+async def get_user_cart(bot_id: int, user_id: int) -> list:
     '''Получить корзину пользователя с товарами'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = f'''SELECT c.id, c.quantity, p.id as product_id, p.name, p.price, p.image_url
-               FROM t_p5255237_telegram_bot_service.shop_carts c
-               JOIN t_p5255237_telegram_bot_service.shop_products p ON c.product_id = p.id
-               WHERE c.bot_id = {bot_id} AND c.user_id = {user_id} AND c.quantity > 0'''
-    cursor.execute(query)
-    cart_items = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [dict(item) for item in cart_items]
-
-def clear_user_cart(bot_id: int, user_id: int):
+    return await db.fetch(
+        '''SELECT c.id, c.quantity, p.id as product_id, p.name, p.price, p.image_url
+           FROM t_p5255237_telegram_bot_service.shop_carts c
+           JOIN t_p5255237_telegram_bot_service.shop_products p ON c.product_id = p.id
+           WHERE c.bot_id = $1 AND c.user_id = $2 AND c.quantity > 0''',
+        bot_id, user_id
+    )
+
+async def clear_user_cart(bot_id: int, user_id: int):
     '''Очистить корзину пользователя после заказа'''
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = f'''UPDATE t_p5255237_telegram_bot_service.shop_carts 
-               SET quantity = 0 
-               WHERE bot_id = {bot_id} AND user_id = {user_id}'''
-    cursor.execute(query)
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-def get_warehouse_schedule(bot_id: int) -> Optional[Dict]:
+    await db.execute(
+        '''UPDATE t_p5255237_telegram_bot_service.shop_carts 
+           SET quantity = 0 
+           WHERE bot_id = $1 AND user_id = $2''',
+        bot_id, user_id
+    )
+
+async def get_warehouse_schedule(bot_id: int) -> Optional[Dict]:
     '''Получить расписание работы склада'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = f'''SELECT * FROM t_p5255237_telegram_bot_service.warehouse_schedule 
-               WHERE bot_id = {bot_id}'''
-    cursor.execute(query)
-    schedule = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    schedule = await db.fetchrow(
+        '''SELECT * FROM t_p5255237_telegram_bot_service.warehouse_schedule 
+           WHERE bot_id = $1''',
+        bot_id
+    )
     if schedule:
-        return dict(schedule)
+        return schedule
     return {
         'work_start_time': '08:00:00',
         'work_end_time': '18:00:00',
@@ -401,10 +818,10 @@ def get_warehouse_schedule(bot_id: int) -> Optional[Dict]:
         'work_days': '1,2,3,4,5'
     }
 
-def get_available_dates(bot_id: int, days_ahead: int = 60) -> list:
+async def get_available_dates(bot_id: int, days_ahead: int = 60) -> list:
     '''Получить доступные даты для бронирования (только будущие рабочие дни)'''
     from datetime import datetime, timedelta
-    schedule = get_warehouse_schedule(bot_id)
+    schedule = await get_warehouse_schedule(bot_id)
     work_days = [int(d) for d in schedule['work_days'].split(',')]
     
     available_dates = []
@@ -417,22 +834,22 @@ def get_available_dates(bot_id: int, days_ahead: int = 60) -> list:
     
     return available_dates
 
-def get_booked_slots(bot_id: int, date) -> list:
+async def get_booked_slots(bot_id: int, date) -> list:
     '''Получить занятые слоты на конкретную дату'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = f'''SELECT booking_time FROM t_p5255237_telegram_bot_service.warehouse_bookings 
-               WHERE bot_id = {bot_id} AND booking_date = '{date}' AND status = 'active' '''
-    cursor.execute(query)
-    bookings = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    bookings = await db.fetch(
+        '''SELECT booking_time FROM t_p5255237_telegram_bot_service.warehouse_bookings 
+           WHERE bot_id = $1 AND booking_date = $2 AND status = 'active' ''',
+        bot_id, date
+    )
     return [str(b['booking_time'])[:5] for b in bookings]
 
-def get_available_time_slots(bot_id: int, date) -> list:
+async def get_available_time_slots(bot_id: int, date) -> list:
     '''Получить свободные временные слоты на дату'''
     from datetime import datetime, timedelta
-    schedule = get_warehouse_schedule(bot_id)
+    schedule, booked_slots = await asyncio.gather(
+        get_warehouse_schedule(bot_id),
+        get_booked_slots(bot_id, date)
+    )
     
     start_time_str = str(schedule['work_start_time'])[:5]
     end_time_str = str(schedule['work_end_time'])[:5]
@@ -444,8 +861,6 @@ def get_available_time_slots(bot_id: int, date) -> list:
     start_time = datetime.combine(date, datetime.min.time().replace(hour=start_hour, minute=start_minute))
     end_time = datetime.combine(date, datetime.min.time().replace(hour=end_hour, minute=end_minute))
     
-    booked_slots = get_booked_slots(bot_id, date)
-    
     available_slots = []
     current_time = start_time
     
@@ -457,71 +872,58 @@ def get_available_time_slots(bot_id: int, date) -> list:
     
     return available_slots
 
-def create_warehouse_booking(bot_id: int, telegram_user_id: int, username: str, 
-                             phone: str, company: str, date, time_str: str,
-                             vehicle_type: str, cargo_desc: str) -> bool:
+async def create_warehouse_booking(bot_id: int, telegram_user_id: int, username: str, 
+                                   phone: str, company: str, date, time_str: str,
+                                   vehicle_type: str, cargo_desc: str) -> bool:
     '''Создать бронирование склада'''
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    username_escaped = username.replace("'", "''")
-    phone_escaped = phone.replace("'", "''")
-    company_escaped = company.replace("'", "''")
-    vehicle_escaped = vehicle_type.replace("'", "''")
-    cargo_escaped = cargo_desc.replace("'", "''")
-    
-    query = f'''INSERT INTO t_p5255237_telegram_bot_service.warehouse_bookings 
+    from datetime import datetime
+    try:
+        if isinstance(date, str):
+            date = datetime.strptime(date, '%Y-%m-%d').date()
+        booking_time = datetime.strptime(time_str[:5], '%H:%M').time()
+        await db.execute(
+            '''INSERT INTO t_p5255237_telegram_bot_service.warehouse_bookings 
                (bot_id, telegram_user_id, telegram_username, user_phone, user_company,
                 booking_date, booking_time, vehicle_type, cargo_description, status)
-               VALUES ({bot_id}, {telegram_user_id}, '{username_escaped}', '{phone_escaped}', 
-                       '{company_escaped}', '{date}', '{time_str}', '{vehicle_escaped}', 
-                       '{cargo_escaped}', 'active')'''
-    
-    try:
-        cursor.execute(query)
-        conn.commit()
-        cursor.close()
-        conn.close()
+               VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, 'active')''',
+            bot_id, telegram_user_id, username, phone, company,
+            date, booking_time, vehicle_type, cargo_desc
+        )
         return True
-    except:
-        cursor.close()
-        conn.close()
+    except Exception:
         return False
 
-def get_user_bookings(bot_id: int, telegram_user_id: int) -> list:
+async def get_user_bookings(bot_id: int, telegram_user_id: int) -> list:
     '''Получить активные бронирования пользователя'''
     from datetime import datetime
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
     today = datetime.now().date()
-    query = f'''SELECT * FROM t_p5255237_telegram_bot_service.warehouse_bookings 
-               WHERE bot_id = {bot_id} AND telegram_user_id = {telegram_user_id} 
-               AND status = 'active' AND booking_date >= '{today}' 
-               ORDER BY booking_date, booking_time'''
-    cursor.execute(query)
-    bookings = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [dict(b) for b in bookings]
-
-def cancel_warehouse_booking(booking_id: int, reason: str = 'Отменено пользователем') -> bool:
+    return await db.fetch(
+        '''SELECT * FROM t_p5255237_telegram_bot_service.warehouse_bookings 
+           WHERE bot_id = $1 AND telegram_user_id = $2 
+           AND status = 'active' AND booking_date >= $3 
+           ORDER BY booking_date, booking_time''',
+        bot_id, telegram_user_id, today
+    )
+
+async def get_warehouse_booking(booking_id: int) -> Optional[Dict]:
+    '''Получить бронирование по id'''
+    return await db.fetchrow(
+        'SELECT * FROM t_p5255237_telegram_bot_service.warehouse_bookings WHERE id = $1',
+        booking_id
+    )
+
+async def cancel_warehouse_booking(booking_id: int, reason: str = 'Отменено пользователем') -> bool:
     '''Отменить бронирование'''
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    reason_escaped = reason.replace("'", "''")
-    query = f'''UPDATE t_p5255237_telegram_bot_service.warehouse_bookings 
-               SET status = 'cancelled', cancelled_at = CURRENT_TIMESTAMP, 
-               cancellation_reason = '{reason_escaped}' 
-               WHERE id = {booking_id}'''
     try:
-        cursor.execute(query)
-        conn.commit()
-        cursor.close()
-        conn.close()
+        await db.execute(
+            '''UPDATE t_p5255237_telegram_bot_service.warehouse_bookings 
+               SET status = 'cancelled', cancelled_at = CURRENT_TIMESTAMP, 
+               cancellation_reason = $1 
+               WHERE id = $2''',
+            reason, booking_id
+        )
         return True
-    except:
-        cursor.close()
-        conn.close()
+    except Exception:
         return False
 
 def create_main_menu_keyboard(payment_enabled: bool = True, button_texts: dict = None) -> ReplyKeyboardMarkup:
@@ -562,11 +964,12 @@ def create_main_menu_keyboard(payment_enabled: bool = True, button_texts: dict =
     )
     return keyboard
 
-async def cmd_start(message: types.Message, bot_id: int):
+async def cmd_start(message: types.Message, ctx: BotContext):
     '''Обработка команды /start'''
-    user_id = register_telegram_user(bot_id, message.from_user)
+    bot_id = ctx.bot_id
+    await ctx.get_user_id()  # регистрируем пользователя
     
-    bot_settings = get_bot_settings(bot_id)
+    bot_settings = ctx.bot_settings
     payment_enabled = bot_settings.get('payment_enabled', True) if bot_settings else True
     message_texts = bot_settings.get('message_texts', {}) if bot_settings else {}
     button_texts = bot_settings.get('button_texts', {}) if bot_settings else {}
@@ -623,13 +1026,12 @@ async def cmd_start(message: types.Message, bot_id: int):
     
     await message.answer(welcome_text, reply_markup=create_main_menu_keyboard(payment_enabled, button_texts))
 
-async def handle_free_key(message: types.Message, bot_id: int):
+async def handle_free_key(message: types.Message, ctx: BotContext):
     '''Обработка запроса бесплатного ключа (только для шаблона keys)'''
-    user_id = register_telegram_user(bot_id, message.from_user)
-    telegram_user_id = message.from_user.id
-    qr_key = get_free_qr_key(bot_id, user_id, telegram_user_id)
+    bot_id = ctx.bot_id
+    qr_key = await get_free_qr_key(bot_id, await ctx.get_user_id(), ctx.is_admin)
     
-    bot_settings = get_bot_settings(bot_id)
+    bot_settings = ctx.bot_settings
     message_texts = bot_settings.get('message_texts', {}) if bot_settings else {}
     bot_template = bot_settings.get('template', 'keys') if bot_settings else 'keys'
     payment_enabled = bot_settings.get('payment_enabled', True) if bot_settings else True
@@ -638,12 +1040,10 @@ async def handle_free_key(message: types.Message, bot_id: int):
     print(f"[DEBUG] Bot {bot_id} template: {bot_template}")
     
     admin_note = ""
-    if is_admin(bot_id, telegram_user_id):
+    if ctx.is_admin:
         admin_note = "\n\n🔧 Режим администратора: ключ НЕ помечен как использованный"
     
     if qr_key:
-        qr_image = generate_qr_image(qr_key['code_number'])
-        
         text_template = message_texts.get('free_key_success', 
             "✅ Ваш бесплатный ключ №{code_number}\n\n"
             "Покажите этот QR-код на кассе:\n"
@@ -662,17 +1062,12 @@ async def handle_free_key(message: types.Message, bot_id: int):
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons) if keyboard_buttons else None
         
-        if keyboard:
-            await message.answer_photo(
-                photo=types.BufferedInputFile(qr_image.read(), filename=f"key_{qr_key['code_number']}.png"),
-                caption=text,
-                reply_markup=keyboard
-            )
-        else:
-            await message.answer_photo(
-                photo=types.BufferedInputFile(qr_image.read(), filename=f"key_{qr_key['code_number']}.png"),
-                caption=text
-            )
+        # Админ получает один и тот же первый ключ: картинка уходит по file_id без повторной загрузки
+        await telegram_file_cache.send_photo(
+            bot_id, qr_asset_key(qr_key['code_number'], 'free'),
+            lambda photo: message.answer_photo(photo=photo, caption=text, reply_markup=keyboard),
+            lambda: types.BufferedInputFile(generate_qr_image(qr_key['code_number'], 'free'), filename=f"key_{qr_key['code_number']}.png")
+        )
     else:
         text = message_texts.get('free_key_empty',
             "😔 Бесплатные ключи на сегодня закончились.\n\n"
@@ -690,23 +1085,9 @@ async def handle_free_key(message: types.Message, bot_id: int):
         else:
             await message.answer(text)
 
-async def handle_secret_shop(message: types.Message, bot_id: int = None):
+async def handle_secret_shop(message: types.Message, ctx: BotContext):
     '''Информация о Тайной витрине'''
-    
-    custom_text = None
-    if bot_id:
-        try:
-            conn = get_db_connection()
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            query = f"SELECT secret_shop_text FROM t_p5255237_telegram_bot_service.bots WHERE id = {bot_id}"
-            cursor.execute(query)
-            bot_data = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            if bot_data and bot_data.get('secret_shop_text'):
-                custom_text = bot_data['secret_shop_text']
-        except:
-            pass
+    custom_text = ctx.bot_settings.get('secret_shop_text')
     
     text = custom_text or (
         "🔐 Тайная витрина — это эксклюзивная закрытая распродажа!\n\n"
@@ -729,120 +1110,72 @@ async def handle_secret_shop(message: types.Message, bot_id: int = None):
     
     await message.answer(text, reply_markup=keyboard)
 
-async def handle_buy_vip(message: types.Message, bot_id: int, state: FSMContext, bot: Bot):
+async def handle_buy_vip(message: types.Message, ctx: BotContext, state: FSMContext, bot: Bot):
     '''Обработка покупки VIP-ключа - показывает информацию и запускает форму'''
-    
-    telegram_user_id = message.from_user.id
-    user_id = register_telegram_user(bot_id, message.from_user)
-    
-    # Проверяем есть ли у пользователя платёж со статусом NEW или в процессе
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    payment_check_query = f'''SELECT order_id, status FROM t_p5255237_telegram_bot_service.payments 
-                              WHERE bot_id = {bot_id} AND telegram_user_id = {telegram_user_id}
-                              AND status IN ('NEW', 'AUTHORIZED', 'CONFIRMED')
-                              ORDER BY created_at DESC LIMIT 1'''
-    cursor.execute(payment_check_query)
-    existing_payment = cursor.fetchone()
+    bot_id = ctx.bot_id
+    
+    # Статус платежа обновляют уведомления T-Bank и страховочная проверка job-worker, здесь он только читается
+    existing_payment = await db.fetchrow(
+        '''SELECT p.order_id, p.status, p.payment_url, qr.code_number AS vip_code_number
+           FROM t_p5255237_telegram_bot_service.payments p
+           LEFT JOIN t_p5255237_telegram_bot_service.qr_codes qr ON qr.id = p.vip_qr_code_id
+           WHERE p.bot_id = $1 AND p.telegram_user_id = $2
+           AND p.status IN ('NEW', 'AUTHORIZED', 'CONFIRMED')
+           ORDER BY p.created_at DESC LIMIT 1''',
+        bot_id, ctx.telegram_user_id
+    )
     
     if existing_payment:
         order_id = existing_payment['order_id']
-        status = existing_payment['status']
         
-        if status == 'CONFIRMED':
-            # Платёж уже подтверждён, выдаём ключ если ещё не выдан
-            qr_key = get_vip_qr_key(bot_id, user_id, telegram_user_id)
-            
-            if qr_key:
-                qr_image = generate_qr_image(qr_key['code_number'])
-                
-                bot_settings = get_bot_settings(bot_id)
-                success_message_template = bot_settings.get('vip_success_message') if bot_settings else None
-                
-                if success_message_template:
-                    text = success_message_template.format(code_number=qr_key['code_number'])
-                else:
-                    text = (
-                        f"✅ Ключ оплачен! Спасибо за покупку!\n\n"
-                        f"💎 Ваш VIP QR-код №{qr_key['code_number']}\n\n"
-                        f"Покажите этот код на кассе для получения доступа к VIP-товарам"
-                    )
-                
-                await message.answer_photo(
-                    photo=types.BufferedInputFile(qr_image.read(), filename=f"vip_key_{qr_key['code_number']}.png"),
-                    caption=text
-                )
-            else:
-                await message.answer("✅ У вас уже есть оплаченный VIP-ключ!")
-            
-            cursor.close()
-            conn.close()
+        if existing_payment['status'] != 'CONFIRMED':
+            keyboard = None
+            if existing_payment['payment_url']:
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="💳 Оплатить", url=existing_payment['payment_url'])]
+                ])
+            await message.answer(
+                "⏳ Ваш платёж ещё обрабатывается.\n\n"
+                "VIP-ключ придёт в этот чат автоматически, как только банк подтвердит оплату.",
+                reply_markup=keyboard
+            )
             return
         
-        # Проверяем статус платежа в T-Bank
-        await message.answer("⏳ Проверяю статус вашего платежа...")
-        
-        try:
-            import urllib.request
-            
-            req = urllib.request.Request(
-                'https://functions.poehali.dev/b4079ccb-abcb-4171-b656-2462d93e1ac9',
-                data=json.dumps({'order_id': order_id}).encode('utf-8'),
-                headers={'Content-Type': 'application/json'},
-                method='POST'
+        code_number = existing_payment['vip_code_number']
+        if code_number is None:
+            # Ключ за платежом еще не закреплен: выдачу делает та же задача, что ставит уведомление T-Bank
+            await enqueue_job(
+                'deliver_vip_key',
+                {
+                    'bot_id': bot_id,
+                    'chat_id': message.chat.id,
+                    'order_id': order_id,
+                    'user_id': await ctx.get_user_id(),
+                    'is_admin': ctx.is_admin
+                },
+                dedup_key=f'deliver_vip_key:{order_id}'
             )
-            
-            with urllib.request.urlopen(req, timeout=10) as response:
-                result = json.loads(response.read().decode('utf-8'))
-                
-                if result.get('confirmed'):
-                    # Платёж подтверждён! Выдаём VIP-ключ
-                    qr_key = get_vip_qr_key(bot_id, user_id, telegram_user_id)
-                    
-                    if qr_key:
-                        qr_image = generate_qr_image(qr_key['code_number'])
-                        
-                        bot_settings = get_bot_settings(bot_id)
-                        success_message_template = bot_settings.get('vip_success_message') if bot_settings else None
-                        
-                        if success_message_template:
-                            text = success_message_template.format(code_number=qr_key['code_number'])
-                        else:
-                            text = (
-                                f"✅ Ключ оплачен! Спасибо за покупку!\n\n"
-                                f"💎 Ваш VIP QR-код №{qr_key['code_number']}\n\n"
-                                f"Покажите этот код на кассе для получения доступа к VIP-товарам"
-                            )
-                        
-                        await message.answer_photo(
-                            photo=types.BufferedInputFile(qr_image.read(), filename=f"vip_key_{qr_key['code_number']}.png"),
-                            caption=text
-                        )
-                        cursor.close()
-                        conn.close()
-                        return
-                    
-        except:
-            pass
+            await message.answer("✅ Оплата подтверждена! VIP-ключ будет отправлен в этот чат.")
+            return
         
-        # Закрываем соединение после проверки существующих платежей
-        cursor.close()
-        conn.close()
-    
-    # Открываем новое соединение для получения данных бота
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # Получаем данные бота из БД
-    query = f'''SELECT payment_enabled, vip_price, tbank_terminal_key, tbank_password,
-                       vip_promo_enabled, vip_promo_start_date, vip_promo_end_date,
-                       vip_purchase_message
-                FROM t_p5255237_telegram_bot_service.bots WHERE id = {bot_id}'''
-    cursor.execute(query)
-    bot_data = cursor.fetchone()
-    cursor.close()
-    conn.close()
+        # Повторное нажатие присылает уже закрепленный за платежом ключ, новый не выдается
+        success_message_template = ctx.bot_settings.get('vip_success_message')
+        if success_message_template:
+            text = success_message_template.format(code_number=code_number)
+        else:
+            text = (
+                f"✅ Ключ оплачен! Спасибо за покупку!\n\n"
+                f"💎 Ваш VIP QR-код №{code_number}\n\n"
+                f"Покажите этот код на кассе для получения доступа к VIP-товарам"
+            )
+        await telegram_file_cache.send_photo(
+            bot_id, qr_asset_key(code_number, 'vip'),
+            lambda photo: message.answer_photo(photo=photo, caption=text),
+            lambda: types.BufferedInputFile(generate_qr_image(code_number, 'vip'), filename=f"vip_key_{code_number}.png")
+        )
+        return
+    
+    bot_data = ctx.bot_settings
     
     if not bot_data or not bot_data.get('payment_enabled'):
         text = (
@@ -899,12 +1232,9 @@ async def handle_buy_vip(message: types.Message, bot_id: int, state: FSMContext,
     
     await message.answer(text, reply_markup=keyboard)
 
-async def handle_privacy_policy(message: types.Message, bot_id: int):
+async def handle_privacy_policy(message: types.Message, ctx: BotContext):
     '''Показать политику конфиденциальности'''
-    bot_settings = get_bot_settings(bot_id)
-    user_id = register_telegram_user(bot_id, message.from_user)
-    
-    privacy_text = bot_settings.get('privacy_policy_text') if bot_settings else None
+    privacy_text = ctx.bot_settings.get('privacy_policy_text')
     if not privacy_text:
         privacy_text = (
             "📄 Политика конфиденциальности и обработки персональных данных\n\n"
@@ -923,9 +1253,7 @@ async def handle_privacy_policy(message: types.Message, bot_id: int):
             "Используя бота, вы соглашаетесь с данной политикой конфиденциальности."
         )
     
-    has_consent = check_privacy_consent(bot_id, user_id)
-    
-    if has_consent:
+    if await ctx.has_consent():
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="✅ Согласие уже принято", callback_data="consent_accepted")],
             [InlineKeyboardButton(text="🔙 В главное меню", callback_data="main_menu")]
@@ -938,12 +1266,13 @@ async def handle_privacy_policy(message: types.Message, bot_id: int):
     
     await message.answer(privacy_text, reply_markup=keyboard)
 
-async def handle_accept_privacy(callback: types.CallbackQuery, bot_id: int, bot: Bot):
+async def handle_accept_privacy(callback: types.CallbackQuery, ctx: BotContext, bot: Bot):
     '''Обработка принятия соглашения'''
-    user_id = register_telegram_user(bot_id, callback.from_user)
-    telegram_user_id = callback.from_user.id
+    bot_id = ctx.bot_id
+    user_id = await ctx.get_user_id()
+    telegram_user_id = ctx.telegram_user_id
     
-    bot_settings = get_bot_settings(bot_id)
+    bot_settings = ctx.bot_settings
     privacy_text = bot_settings.get('privacy_policy_text', 'Согласие на обработку персональных данных')
     bot_template = bot_settings.get('template', 'keys') if bot_settings else 'keys'
     message_texts = bot_settings.get('message_texts', {}) if bot_settings else {}
@@ -952,9 +1281,10 @@ async def handle_accept_privacy(callback: types.CallbackQuery, bot_id: int, bot:
     
     unique_code = f"USER_{telegram_user_id}_{bot_id}"
     
-    success = save_privacy_consent(bot_id, user_id, telegram_user_id, privacy_text, unique_code)
+    success = await save_privacy_consent(bot_id, user_id, telegram_user_id, privacy_text, unique_code)
     
     if success:
+        ctx.set_consent(True)
         await callback.message.edit_text(
             "✅ Спасибо! Ваше согласие принято и сохранено.\n\n"
             f"Ваш уникальный код: {unique_code}"
@@ -1041,19 +1371,21 @@ async def handle_accept_privacy(callback: types.CallbackQuery, bot_id: int, bot:
     
     await callback.answer()
 
-async def handle_accept_privacy_payment(callback: types.CallbackQuery, bot_id: int, bot: Bot, state: FSMContext):
+async def handle_accept_privacy_payment(callback: types.CallbackQuery, ctx: BotContext, bot: Bot, state: FSMContext):
     '''Обработка принятия согласия при оплате'''
-    user_id = register_telegram_user(bot_id, callback.from_user)
-    telegram_user_id = callback.from_user.id
+    bot_id = ctx.bot_id
+    user_id = await ctx.get_user_id()
+    telegram_user_id = ctx.telegram_user_id
     
-    bot_settings = get_bot_settings(bot_id)
+    bot_settings = ctx.bot_settings
     privacy_text = bot_settings.get('privacy_policy_text', 'Согласие на обработку персональных данных')
     
     unique_code = f"USER_{telegram_user_id}_{bot_id}"
     
-    success = save_privacy_consent(bot_id, user_id, telegram_user_id, privacy_text, unique_code)
+    success = await save_privacy_consent(bot_id, user_id, telegram_user_id, privacy_text, unique_code)
     
     if success:
+        ctx.set_consent(True)
         owner_telegram_id = 718091347
         admin_telegram_id = 500136108
         
@@ -1099,7 +1431,7 @@ async def handle_help(message: types.Message):
 
 async def handle_shop_catalog(message: types.Message, bot_id: int):
     '''Показать каталог магазина с категориями'''
-    categories = get_shop_categories(bot_id)
+    categories = await get_shop_categories(bot_id)
     
     if not categories:
         await message.answer(
@@ -1124,13 +1456,13 @@ async def handle_shop_catalog(message: types.Message, bot_id: int):
 
 async def handle_category_products(message: types.Message, bot_id: int, category_name: str):
     '''Показать товары в категории'''
-    categories = get_shop_categories(bot_id)
+    categories = await get_shop_categories(bot_id)
     category = next((c for c in categories if c['name'] in message.text), None)
     
     if not category:
         return
     
-    products = get_shop_products(bot_id, category['id'])
+    products = await get_shop_products(bot_id, category['id'])
     
     if not products:
         await message.answer(f"В категории '{category['name']}' пока нет товаров.")
@@ -1152,21 +1484,20 @@ async def handle_category_products(message: types.Message, bot_id: int, category
         
         if product.get('image_url'):
             try:
-                await message.answer_photo(
-                    photo=product['image_url'],
-                    caption=text,
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
+                # Telegram скачивает картинку по URL только при первом показе, дальше фото уходит по file_id
+                await telegram_file_cache.send_photo(
+                    bot_id, url_asset_key(product['image_url']),
+                    lambda photo: message.answer_photo(photo=photo, caption=text, reply_markup=keyboard, parse_mode="Markdown"),
+                    lambda: product['image_url']
                 )
             except:
                 await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
         else:
             await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
 
-async def handle_view_cart(message: types.Message, bot_id: int):
+async def handle_view_cart(message: types.Message, ctx: BotContext):
     '''Показать корзину пользователя'''
-    user_id = register_telegram_user(bot_id, message.from_user)
-    cart_items = get_user_cart(bot_id, user_id)
+    cart_items = await get_user_cart(ctx.bot_id, await ctx.get_user_id())
     
     if not cart_items:
         await message.answer(
@@ -1196,7 +1527,7 @@ async def handle_view_cart(message: types.Message, bot_id: int):
 async def handle_warehouse_booking_start(message: types.Message, bot_id: int, state: FSMContext):
     '''Начало процесса бронирования - выбор даты'''
     from datetime import datetime
-    available_dates = get_available_dates(bot_id, days_ahead=14)
+    available_dates = await get_available_dates(bot_id, days_ahead=14)
     
     if not available_dates:
         await message.answer("К сожалению, нет доступных дат для бронирования.")
@@ -1233,7 +1564,7 @@ async def handle_warehouse_date_selected(callback: types.CallbackQuery, bot_id:
     date_str = callback.data.split(':')[1]
     selected_date = datetime.strptime(date_str, '%Y-%m-%d').date()
     
-    available_slots = get_available_time_slots(bot_id, selected_date)
+    available_slots = await get_available_time_slots(bot_id, selected_date)
     
     if not available_slots:
         await callback.message.edit_text(
@@ -1298,7 +1629,7 @@ async def process_warehouse_vehicle(message: types.Message, state: FSMContext):
     await message.answer("📦 Введите *описание груза* (например: Стройматериалы, 5 паллет):", parse_mode="Markdown")
     await state.set_state(BotStates.warehouse_entering_cargo)
 
-async def process_warehouse_cargo_and_confirm(message: types.Message, state: FSMContext, bot: Bot):
+async def process_warehouse_cargo_and_confirm(message: types.Message, state: FSMContext, bot: Bot, ctx: BotContext):
     '''Обработка описания груза и создание бронирования'''
     from datetime import datetime
     user_data = await state.get_data()
@@ -1313,7 +1644,7 @@ async def process_warehouse_cargo_and_confirm(message: types.Message, state: FSM
     telegram_user_id = message.from_user.id
     username = message.from_user.username or 'без username'
     
-    success = create_warehouse_booking(
+    success = await create_warehouse_booking(
         bot_id, telegram_user_id, username, phone, company,
         date_str, time_str, vehicle, cargo
     )
@@ -1333,8 +1664,7 @@ async def process_warehouse_cargo_and_confirm(message: types.Message, state: FSM
         await message.answer(text, parse_mode="Markdown")
         
         # Отправить уведомление администраторам о новом бронировании
-        bot_settings = get_bot_settings(bot_id)
-        admin_ids = bot_settings.get('admin_telegram_ids', []) if bot_settings else []
+        admin_ids = ctx.admin_ids
         
         admin_notification = (
             f"🔔 *Новое бронирование склада*\n\n"
@@ -1366,7 +1696,7 @@ async def handle_warehouse_my_bookings(message: types.Message, bot_id: int):
     '''Показать бронирования пользователя'''
     from datetime import datetime
     telegram_user_id = message.from_user.id
-    bookings = get_user_bookings(bot_id, telegram_user_id)
+    bookings = await get_user_bookings(bot_id, telegram_user_id)
     
     if not bookings:
         await message.answer(
@@ -1399,7 +1729,7 @@ async def handle_warehouse_my_bookings(message: types.Message, bot_id: int):
 
 async def handle_warehouse_info(message: types.Message, bot_id: int):
     '''Информация о складе'''
-    schedule = get_warehouse_schedule(bot_id)
+    schedule = await get_warehouse_schedule(bot_id)
     
     work_days_map = {1: 'Пн', 2: 'Вт', 3: 'Ср', 4: 'Чт', 5: 'Пт', 6: 'Сб', 7: 'Вс'}
     work_days = [int(d) for d in schedule['work_days'].split(',')]
@@ -1424,26 +1754,12 @@ async def handle_warehouse_info(message: types.Message, bot_id: int):
     
     await message.answer(text, parse_mode="Markdown")
 
-async def start_payment_form(callback: types.CallbackQuery, state: FSMContext):
+async def start_payment_form(callback: types.CallbackQuery, state: FSMContext, ctx: BotContext):
     '''Начало заполнения формы для оплаты'''
-    user_data = await state.get_data()
-    bot_id = user_data.get('bot_id')
-    telegram_user_id = callback.from_user.id
+    bot_settings = ctx.bot_settings
     
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    query = f"SELECT require_privacy_consent, privacy_policy_text FROM t_p5255237_telegram_bot_service.bots WHERE id = {bot_id}"
-    cursor.execute(query)
-    bot_settings = cursor.fetchone()
-    
-    if bot_settings and bot_settings.get('require_privacy_consent'):
-        consent_query = f"""SELECT id FROM t_p5255237_telegram_bot_service.privacy_consents 
-                           WHERE bot_id = {bot_id} AND telegram_user_id = {telegram_user_id}"""
-        cursor.execute(consent_query)
-        consent = cursor.fetchone()
-        
-        if not consent:
+    if bot_settings.get('require_privacy_consent'):
+        if not await ctx.has_consent():
             privacy_text = bot_settings.get('privacy_policy_text') or 'Политика конфиденциальности не указана'
             
             max_length = 3500
@@ -1461,14 +1777,9 @@ async def start_payment_form(callback: types.CallbackQuery, state: FSMContext):
                 parse_mode='Markdown',
                 reply_markup=keyboard
             )
-            cursor.close()
-            conn.close()
             await callback.answer()
             return
     
-    cursor.close()
-    conn.close()
-    
     await callback.message.answer("📝 Введите вашу *Фамилию*:", parse_mode='Markdown')
     await state.set_state(BotStates.waiting_for_last_name)
     await callback.answer()
@@ -1485,7 +1796,7 @@ async def process_first_name(message: types.Message, state: FSMContext):
     await message.answer("📝 Введите ваш *Телефон*:", parse_mode='Markdown')
     await state.set_state(BotStates.waiting_for_phone)
 
-async def process_phone_and_create_payment(message: types.Message, state: FSMContext, bot: Bot):
+async def process_phone_and_create_payment(message: types.Message, state: FSMContext, bot: Bot, ctx: BotContext):
     '''Обработка телефона и создание платежа'''
     user_data = await state.get_data()
     last_name = user_data.get('last_name')
@@ -1532,7 +1843,7 @@ async def process_phone_and_create_payment(message: types.Message, state: FSMCon
                 payment_id = result.get('payment_id', order_id)
                 
                 # Сохраняем платёж в БД
-                save_payment_to_db(bot_id, telegram_user_id, order_id, payment_id, 
+                await save_payment_to_db(bot_id, telegram_user_id, order_id, payment_id, 
                                   payment_url, vip_price, phone, first_name, last_name)
                 
                 text = (
@@ -1551,11 +1862,20 @@ async def process_phone_and_create_payment(message: types.Message, state: FSMCon
                 # Отправляем сообщение о проверке статуса
                 await message.answer("⏳ Статус: на проверке...")
                 
-                # Запускаем проверку статуса платежа
-                user_id = register_telegram_user(bot_id, message.from_user)
-                asyncio.create_task(check_payment_status_loop(
-                    bot, message.chat.id, order_id, bot_id, telegram_user_id, user_id
-                ))
+                # Проверку статуса и выдачу ключа выполнит job-worker, webhook не ждет оплаты
+                await enqueue_job(
+                    'check_payment',
+                    {
+                        'bot_id': bot_id,
+                        'chat_id': message.chat.id,
+                        'order_id': order_id,
+                        'user_id': await ctx.get_user_id(),
+                        'is_admin': ctx.is_admin,
+                        'step': 0
+                    },
+                    delay_seconds=PAYMENT_CHECK_FIRST_DELAY,
+                    dedup_key=f'check_payment:{order_id}:0'
+                )
                 
                 await state.clear()
             else:
@@ -1567,92 +1887,32 @@ async def process_phone_and_create_payment(message: types.Message, state: FSMCon
         await message.answer(f"⚠️ Ошибка при создании платежа: {str(e)}")
         await state.clear()
 
-async def check_payment_status_loop(bot: Bot, chat_id: int, order_id: str, bot_id: int, telegram_user_id: int, user_id: int):
-    '''Проверка статуса платежа с несколькими попытками: 5 сек, 10 сек, 60 сек'''
-    delays = [5, 10, 60]  # Задержки между проверками
-    
-    for delay in delays:
-        await asyncio.sleep(delay)
-        
-        # Проверяем статус через API
-        try:
-            import urllib.request
-            
-            req = urllib.request.Request(
-                'https://functions.poehali.dev/b4079ccb-abcb-4171-b656-2462d93e1ac9',
-                data=json.dumps({'order_id': order_id}).encode('utf-8'),
-                headers={'Content-Type': 'application/json'},
-                method='POST'
-            )
-            
-            with urllib.request.urlopen(req, timeout=10) as response:
-                result = json.loads(response.read().decode('utf-8'))
-                
-                if result.get('confirmed'):
-                    # Платёж подтверждён! Выдаём VIP-ключ
-                    qr_key = get_vip_qr_key(bot_id, user_id, telegram_user_id)
-                    
-                    if qr_key:
-                        qr_image = generate_qr_image(qr_key['code_number'])
-                        
-                        bot_settings = get_bot_settings(bot_id)
-                        success_message_template = bot_settings.get('vip_success_message') if bot_settings else None
-                        
-                        if success_message_template:
-                            text = success_message_template.format(code_number=qr_key['code_number'])
-                        else:
-                            text = (
-                                f"✅ Ключ оплачен! Спасибо за покупку!\n\n"
-                                f"💎 Ваш VIP QR-код №{qr_key['code_number']}\n\n"
-                                f"Покажите этот код на кассе для получения доступа к VIP-товарам"
-                            )
-                        
-                        await bot.send_photo(
-                            chat_id=chat_id,
-                            photo=types.BufferedInputFile(qr_image.read(), filename=f"vip_key_{qr_key['code_number']}.png"),
-                            caption=text
-                        )
-                    else:
-                        await bot.send_message(chat_id, "✅ Оплата подтверждена! Но VIP-ключи закончились. Обратитесь к администратору.")
-                    
-                    return  # Выходим из цикла
-                    
-        except:
-            pass  # Игнорируем ошибки проверки
-    
-    # Если после всех попыток платёж не подтверждён
-    await bot.send_message(
-        chat_id,
-        "⏱ Время проверки истекло. Если вы оплатили заказ, нажмите 'Купить VIP-ключ' снова для проверки статуса."
-    )
-
-async def callback_handler(callback: types.CallbackQuery, bot_id: int, state: FSMContext, bot: Bot):
+async def callback_handler(callback: types.CallbackQuery, ctx: BotContext, state: FSMContext, bot: Bot):
     '''Обработчик inline кнопок'''
+    bot_id = ctx.bot_id
     if callback.data == "secret_shop":
-        await handle_secret_shop(callback.message, bot_id)
+        await handle_secret_shop(callback.message, ctx)
     elif callback.data == "buy_vip":
-        await handle_buy_vip(callback.message, bot_id, state, bot)
+        await handle_buy_vip(callback.message, ctx, state, bot)
     elif callback.data == "start_payment_form":
-        await start_payment_form(callback, state)
+        await start_payment_form(callback, state, ctx)
     elif callback.data == "accept_privacy":
-        await handle_accept_privacy(callback, bot_id, bot)
+        await handle_accept_privacy(callback, ctx, bot)
     elif callback.data == "accept_privacy_payment":
-        await handle_accept_privacy_payment(callback, bot_id, bot, state)
+        await handle_accept_privacy_payment(callback, ctx, bot, state)
     elif callback.data == "consent_accepted":
         await callback.answer("Вы уже приняли соглашение ранее", show_alert=True)
     elif callback.data.startswith("add_to_cart:"):
         product_id = int(callback.data.split(":")[1])
-        user_id = register_telegram_user(bot_id, callback.from_user)
-        add_to_cart(bot_id, user_id, product_id, 1)
+        await add_to_cart(bot_id, await ctx.get_user_id(), product_id, 1)
         await callback.answer("✅ Товар добавлен в корзину!", show_alert=True)
     elif callback.data == "checkout":
         await callback.message.answer("🚧 Оформление заказа находится в разработке. Свяжитесь с администратором для оформления.")
         await callback.answer()
     elif callback.data == "clear_cart":
-        user_id = register_telegram_user(bot_id, callback.from_user)
-        clear_user_cart(bot_id, user_id)
+        await clear_user_cart(bot_id, await ctx.get_user_id())
         await callback.answer("🗑 Корзина очищена")
-        await handle_view_cart(callback.message, bot_id)
+        await handle_view_cart(callback.message, ctx)
     elif callback.data == "warehouse_booking":
         await handle_warehouse_booking_start(callback.message, bot_id, state)
         await callback.answer()
@@ -1664,23 +1924,15 @@ async def callback_handler(callback: types.CallbackQuery, bot_id: int, state: FS
         booking_id = int(callback.data.split(":")[1])
         
         # Получить информацию о бронировании перед отменой
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        query = f'''SELECT * FROM t_p5255237_telegram_bot_service.warehouse_bookings 
-                   WHERE id = {booking_id}'''
-        cursor.execute(query)
-        booking = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        booking = await get_warehouse_booking(booking_id)
         
-        success = cancel_warehouse_booking(booking_id)
+        success = await cancel_warehouse_booking(booking_id)
         if success:
             await callback.answer("✅ Бронирование отменено", show_alert=True)
             
             # Уведомить администраторов об отмене
             if booking:
-                bot_settings = get_bot_settings(bot_id)
-                admin_ids = bot_settings.get('admin_telegram_ids', []) if bot_settings else []
+                admin_ids = ctx.admin_ids
                 
                 date_str = booking['booking_date'].strftime('%d.%m.%Y')
                 time_str = str(booking['booking_time'])[:5]
@@ -1698,36 +1950,308 @@ async def callback_handler(callback: types.CallbackQuery, bot_id: int, state: FS
                     f"📦 Груз: {booking['cargo_description']}"
                 )
                 
-                for admin_id in admin_ids:
-                    try:
-                        await bot.send_message(admin_id, admin_notification, parse_mode='Markdown')
-                    except:
-                        pass
+                await asyncio.gather(
+                    *(bot.send_message(admin_id, admin_notification, parse_mode='Markdown') for admin_id in admin_ids),
+                    return_exceptions=True
+                )
             
             await handle_warehouse_my_bookings(callback.message, bot_id)
         else:
             await callback.answer("❌ Ошибка при отмене", show_alert=True)
     elif callback.data == "main_menu":
-        await cmd_start(callback.message, bot_id)
+        await cmd_start(callback.message, ctx)
         await state.clear()
     await callback.answer()
 
-async def process_update(bot_id: int, update_data: Dict[str, Any]) -> None:
-    '''Обрабатывает один Update от Telegram webhook'''
-    # Получаем данные бота
-    bot_settings = get_bot_settings(bot_id)
-    if not bot_settings:
-        print(f"[ERROR] Bot {bot_id} not found")
-        return
+class EventLoopRunner:
+    '''Один event loop на весь контейнер: живет между тёплыми вызовами функции'''
+    
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop
+    
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+    
+    def shutdown(self) -> None:
+        if self._loop is None or self._loop.is_closed():
+            return
+        pending = [t for t in asyncio.all_tasks(self._loop) if not t.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self._loop.close()
+
+class TelegramSessionManager:
+    '''HTTP-сессии к api.telegram.org по токену бота: keep-alive соединения переживают вызовы'''
+    
+    def __init__(self, idle_ttl: float = 300.0, middlewares: Optional[list] = None):
+        self.idle_ttl = idle_ttl
+        self.middlewares = middlewares or []
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0}
+    
+    async def acquire(self, token: str) -> AiohttpSession:
+        '''Сессия для токена; заодно закрывает сессии, простаивающие дольше idle_ttl'''
+        await self.evict_idle()
+        key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        entry = self._sessions.get(key)
+        if entry:
+            self.stats['reused'] += 1
+        else:
+            self.stats['created'] += 1
+            session = AiohttpSession()
+            for middleware in self.middlewares:
+                session.middleware(middleware)
+            entry = {'session': session}
+            self._sessions[key] = entry
+        entry['last_used'] = time.monotonic()
+        return entry['session']
+    
+    async def evict_idle(self) -> None:
+        now = time.monotonic()
+        for key, entry in list(self._sessions.items()):
+            if now - entry['last_used'] >= self.idle_ttl:
+                del self._sessions[key]
+                self.stats['evicted'] += 1
+                await entry['session'].close()
+    
+    async def close_all(self) -> None:
+        for entry in self._sessions.values():
+            await entry['session'].close()
+        self._sessions.clear()
+
+# Отвечать на webhook вызовом Bot API в теле ответа (экономит отдельный HTTPS-запрос к Telegram)
+WEBHOOK_REPLY_ENABLED = os.environ.get('WEBHOOK_REPLY_ENABLED', 'true').lower() == 'true'
+
+class WebhookReply:
+    '''Первый подходящий вызов Bot API за Update, который уходит в теле ответа на webhook'''
+    
+    ELIGIBLE = (SendMessage, EditMessageText, AnswerCallbackQuery)
+    
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.method: Optional[TelegramMethod] = None
+        self.make_request = None
+        self.closed = False
+    
+    def can_defer(self, method: TelegramMethod) -> bool:
+        if self.closed or self.method is not None or not isinstance(method, self.ELIGIBLE):
+            return False
+        # Заглушку Message можем собрать только для личного чата с числовым id
+        return not isinstance(method, SendMessage) or isinstance(method.chat_id, int)
+    
+    def defer(self, method: TelegramMethod, make_request) -> Any:
+        '''Отложить вызов до ответа на webhook и вернуть заглушку результата'''
+        from datetime import datetime
+        self.method = method
+        self.make_request = make_request
+        if isinstance(method, SendMessage):
+            return types.Message(
+                message_id=0,
+                date=datetime.now(),
+                chat=types.Chat(id=method.chat_id, type='private'),
+                text=method.text
+            )
+        return True
+    
+    async def flush(self) -> None:
+        '''Отправить отложенный вызов обычным запросом (нужно, чтобы не нарушить порядок сообщений)'''
+        method, self.method = self.method, None
+        if method is not None:
+            await self.make_request(self.bot, method)
+    
+    async def take(self) -> Optional[Dict[str, Any]]:
+        '''Забрать отложенный вызов в виде тела ответа на webhook'''
+        self.closed = True
+        if self.method is None:
+            return None
+        files: Dict[str, Any] = {}
+        payload = {'method': self.method.__api_method__}
+        try:
+            for key, value in self.method.model_dump(warnings=False).items():
+                value = self.bot.session.prepare_value(value, bot=self.bot, files=files, _dumps_json=False)
+                if value is not None:
+                    payload[key] = value
+        except Exception as e:
+            print(f"[WARN] Webhook reply serialization failed, sending as a regular request: {e}")
+            await self.flush()
+            return None
+        if files:
+            await self.flush()
+            return None
+        self.method = None
+        return payload
+
+_webhook_reply: ContextVar[Optional[WebhookReply]] = ContextVar('webhook_reply', default=None)
+
+async def webhook_reply_middleware(make_request, bot: Bot, method: TelegramMethod):
+    '''Middleware сессии: откладывает первый вызов за Update, остальные отправляет как обычно'''
+    reply = _webhook_reply.get()
+    if reply is None or reply.closed or reply.bot is not bot:
+        return await make_request(bot, method)
+    
+    if reply.method is not None:
+        # answerCallbackQuery не зависит от порядка, остальные вызовы должны идти после отложенного
+        if isinstance(method, AnswerCallbackQuery):
+            return await make_request(bot, method)
+        await reply.flush()
+    
+    if reply.can_defer(method):
+        return reply.defer(method, make_request)
+    return await make_request(bot, method)
+
+class TokenBucket:
+    '''Корзина токенов; токены можно занимать в долг - долг и есть очередь ожидающих отправок'''
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self) -> float:
+        '''Занять токен и вернуть, сколько секунд ждать его появления (FIFO без блокировок)'''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def is_idle(self) -> bool:
+        '''Корзина снова полная - ее можно выбросить без потери ограничения'''
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class TelegramRateLimiter:
+    '''Ограничение исходящих сообщений по лимитам Telegram: на бота, на личный чат и на группу; 429 ждем retry_after'''
+    
+    # Методы, которые Telegram считает отправкой сообщения в чат
+    LIMITED_PREFIXES = ('send', 'copy', 'forward')
+    
+    def __init__(self, bot_rate: float = 30.0, chat_rate: float = 1.0, group_rate: float = 20 / 60,
+                 max_retries: int = 3, max_wait: float = 30.0):
+        self.bot_rate = bot_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self._bot_buckets: Dict[int, TokenBucket] = {}
+        self._chat_buckets: Dict[Tuple[int, Any], TokenBucket] = {}
+        # Бот получил 429: до этого момента его отправки ждут
+        self._paused_until: Dict[int, float] = {}
+        self.waiting = 0
+        self.stats = {'queued': 0, 'sent': 0, 'throttled': 0, 'dropped': 0}
+    
+    def _chat_bucket(self, bot_id: int, chat_id: Any) -> TokenBucket:
+        key = (bot_id, chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_idle()}
+            # Отрицательный chat_id и @username - группы и каналы, у них лимит ниже
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = TokenBucket(rate, 1 if is_group else 3)
+            self._chat_buckets[key] = bucket
+        return bucket
+    
+    def _reserve(self, bot_id: int, chat_id: Any) -> float:
+        bot_bucket = self._bot_buckets.get(bot_id)
+        if bot_bucket is None:
+            bot_bucket = self._bot_buckets[bot_id] = TokenBucket(self.bot_rate, self.bot_rate)
+        delay = bot_bucket.reserve()
+        if chat_id is not None:
+            delay = max(delay, self._chat_bucket(bot_id, chat_id).reserve())
+        return max(delay, self._paused_until.get(bot_id, 0.0) - time.monotonic())
+    
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        if not method.__api_method__.startswith(self.LIMITED_PREFIXES):
+            return await make_request(bot, method)
+        
+        chat_id = getattr(method, 'chat_id', None)
+        for attempt in range(self.max_retries + 1):
+            delay = self._reserve(bot.id, chat_id)
+            if delay > 0:
+                self.stats['queued'] += 1
+                self.waiting += 1
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    self.waiting -= 1
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats['throttled'] += 1
+                self._paused_until[bot.id] = max(self._paused_until.get(bot.id, 0.0), time.monotonic() + e.retry_after)
+                if attempt == self.max_retries or e.retry_after > self.max_wait:
+                    self.stats['dropped'] += 1
+                    print(f"[WARN] Telegram flood control for bot {bot.id}: {method.__api_method__} to {chat_id} dropped, retry_after={e.retry_after}")
+                    raise
+                continue
+            self.stats['sent'] += 1
+            return result
+
+telegram_rate_limiter = TelegramRateLimiter(
+    bot_rate=float(os.environ.get('TELEGRAM_BOT_RATE', '30')),
+    chat_rate=float(os.environ.get('TELEGRAM_CHAT_RATE', '1')),
+    group_rate=float(os.environ.get('TELEGRAM_GROUP_RATE', str(20 / 60))),
+    max_wait=float(os.environ.get('TELEGRAM_MAX_RETRY_WAIT', '30'))
+)
+
+loop_runner = EventLoopRunner()
+telegram_sessions = TelegramSessionManager(
+    idle_ttl=float(os.environ.get('TELEGRAM_SESSION_IDLE_TTL', '300')),
+    middlewares=[webhook_reply_middleware, telegram_rate_limiter]
+)
+
+def _shutdown_runtime() -> None:
+    '''Закрыть сессии, пул БД и event loop при остановке контейнера'''
+    try:
+        if loop_runner._loop is not None and not loop_runner._loop.is_closed():
+            loop_runner.run(telegram_sessions.close_all())
+            loop_runner.run(qr_leases.release_all())
+            loop_runner.run(db.close())
+            loop_runner.run(chat_lock_db.close())
+        loop_runner.shutdown()
+    except Exception as e:
+        print(f"[ERROR] Runtime shutdown failed: {e}")
+
+atexit.register(_shutdown_runtime)
+
+# Кэш диспетчеров между вызовами в одном контейнере: bot_id -> {'version', 'bot', 'dp'}
+_dispatchers: Dict[int, Dict[str, Any]] = {}
+
+def get_settings_version(bot_settings: Dict) -> tuple:
+    '''Версия настроек бота, при смене которой диспетчер пересобирается'''
+    return (bot_settings.get('telegram_token'), bot_settings.get('config_version'))
+
+def get_dispatcher(bot_id: int, bot_settings: Dict) -> Tuple[Bot, Dispatcher]:
+    '''Получить Bot и Dispatcher из кэша или собрать их заново'''
+    version = get_settings_version(bot_settings)
+    cached = _dispatchers.get(bot_id)
+    if cached and cached['version'] == version:
+        return cached['bot'], cached['dp']
     
     bot = Bot(token=bot_settings['telegram_token'])
+    dp = build_dispatcher(bot_id)
+    _dispatchers[bot_id] = {'version': version, 'bot': bot, 'dp': dp}
+    return bot, dp
+
+def build_dispatcher(bot_id: int) -> Dispatcher:
+    '''Создает Dispatcher и регистрирует все обработчики бота'''
     storage = PostgresStorage()
     dp = Dispatcher(storage=storage)
     
-    # Регистрируем все обработчики (копия из run_bot)
     @dp.message(Command("start"))
-    async def start_handler(message: types.Message, state: FSMContext):
-        await cmd_start(message, bot_id)
+    async def start_handler(message: types.Message, state: FSMContext, ctx: BotContext):
+        await cmd_start(message, ctx)
         await state.clear()
     
     @dp.message(BotStates.waiting_for_last_name)
@@ -1739,8 +2263,8 @@ async def process_update(bot_id: int, update_data: Dict[str, Any]) -> None:
         await process_first_name(message, state)
     
     @dp.message(BotStates.waiting_for_phone)
-    async def phone_handler(message: types.Message, state: FSMContext):
-        await process_phone_and_create_payment(message, state, bot)
+    async def phone_handler(message: types.Message, state: FSMContext, bot: Bot, ctx: BotContext):
+        await process_phone_and_create_payment(message, state, bot, ctx)
     
     @dp.message(BotStates.warehouse_entering_phone)
     async def warehouse_phone_handler(message: types.Message, state: FSMContext):
@@ -1755,15 +2279,15 @@ async def process_update(bot_id: int, update_data: Dict[str, Any]) -> None:
         await process_warehouse_vehicle(message, state)
     
     @dp.message(BotStates.warehouse_entering_cargo)
-    async def warehouse_cargo_handler(message: types.Message, state: FSMContext):
-        await process_warehouse_cargo_and_confirm(message, state, bot)
+    async def warehouse_cargo_handler(message: types.Message, state: FSMContext, bot: Bot, ctx: BotContext):
+        await process_warehouse_cargo_and_confirm(message, state, bot, ctx)
     
     @dp.message(F.text)
-    async def text_handler(message: types.Message, state: FSMContext):
-        bot_settings = get_bot_settings(bot_id)
-        payment_enabled = bot_settings.get('payment_enabled', True) if bot_settings else True
-        button_texts = bot_settings.get('button_texts', {}) if bot_settings else {}
-        bot_template = bot_settings.get('template', 'keys') if bot_settings else 'keys'
+    async def text_handler(message: types.Message, state: FSMContext, bot: Bot, ctx: BotContext):
+        bot_settings = ctx.bot_settings
+        payment_enabled = bot_settings.get('payment_enabled', True)
+        button_texts = bot_settings.get('button_texts', {})
+        bot_template = bot_settings.get('template', 'keys')
         
         text = message.text
         
@@ -1775,23 +2299,23 @@ async def process_update(bot_id: int, update_data: Dict[str, Any]) -> None:
         if bot_template == 'keys':
             free_key_text = button_texts.get('free_key', '🎁 Получить бесплатный ключ')
             if text == free_key_text or text == '🎁 Получить бесплатный ключ':
-                await handle_free_key(message, bot_id)
+                await handle_free_key(message, ctx)
                 return
             
             if payment_enabled:
                 secret_shop_text = button_texts.get('secret_shop', '🔐 Узнать про Тайную витрину')
                 if text == secret_shop_text or text == '🔐 Узнать про Тайную витрину':
-                    await handle_secret_shop(message, bot_id)
+                    await handle_secret_shop(message, ctx)
                     return
                 
                 buy_vip_text = button_texts.get('buy_vip', '💎 Купить VIP-ключ')
                 if text == buy_vip_text or text == '💎 Купить VIP-ключ':
-                    await handle_buy_vip(message, bot_id, state, bot)
+                    await handle_buy_vip(message, ctx, state, bot)
                     return
             
             privacy_text = button_texts.get('privacy', '📄 Согласие на обработку данных')
             if text == privacy_text or text == '📄 Согласие на обработку данных':
-                await handle_privacy_policy(message, bot_id)
+                await handle_privacy_policy(message, ctx)
                 return
             
             help_text = button_texts.get('help', '❓ Помощь')
@@ -1805,14 +2329,14 @@ async def process_update(bot_id: int, update_data: Dict[str, Any]) -> None:
                 return
             
             if text == '🛒 Корзина':
-                await handle_view_cart(message, bot_id)
+                await handle_view_cart(message, ctx)
                 return
             
             if text == '⬅ Главное меню':
-                await cmd_start(message, bot_id)
+                await cmd_start(message, ctx)
                 return
             
-            categories = get_shop_categories(bot_id)
+            categories = await get_shop_categories(bot_id)
             for cat in categories:
                 emoji = cat.get('emoji', '📦')
                 button_text = f"{emoji} {cat['name']}"
@@ -1834,12 +2358,195 @@ async def process_update(bot_id: int, update_data: Dict[str, Any]) -> None:
                 return
     
     @dp.callback_query()
-    async def callback_handler_wrapper(callback: types.CallbackQuery, state: FSMContext):
-        await callback_handler(callback, bot_id, state, bot)
+    async def callback_handler_wrapper(callback: types.CallbackQuery, state: FSMContext, bot: Bot, ctx: BotContext):
+        await callback_handler(callback, ctx, state, bot)
+    
+    return dp
+
+class UpdateDeduplicator:
+    '''Защита от повторной доставки webhook: LRU в памяти перед таблицей processed_updates'''
+    
+    def __init__(self, max_size: int = 10000, ttl_hours: int = 24, cleanup_interval: float = 600.0):
+        self.max_size = max_size
+        self.ttl_hours = ttl_hours
+        self.cleanup_interval = cleanup_interval
+        self._seen: OrderedDict = OrderedDict()
+        self._last_cleanup = 0.0
+        self.stats = {'claimed': 0, 'memory_duplicates': 0, 'db_duplicates': 0, 'released': 0, 'cleaned': 0}
+    
+    def _remember(self, key: Tuple[int, int]) -> None:
+        self._seen[key] = True
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+    
+    async def claim(self, bot_id: int, update_id: int) -> bool:
+        '''True - Update новый и его нужно обработать; False - повтор, отвечаем сразу'''
+        key = (bot_id, update_id)
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            self.stats['memory_duplicates'] += 1
+            return False
+        await self._cleanup_if_due()
+        inserted = await db.fetchval(
+            '''INSERT INTO t_p5255237_telegram_bot_service.processed_updates (bot_id, update_id)
+               VALUES ($1, $2) ON CONFLICT DO NOTHING RETURNING TRUE''',
+            bot_id, update_id
+        )
+        self._remember(key)
+        if not inserted:
+            self.stats['db_duplicates'] += 1
+            return False
+        self.stats['claimed'] += 1
+        return True
+    
+    async def release(self, bot_id: int, update_id: int) -> None:
+        '''Обработка упала: снять отметку, чтобы повторная доставка Telegram обработала Update заново'''
+        self._seen.pop((bot_id, update_id), None)
+        self.stats['released'] += 1
+        await db.execute(
+            '''DELETE FROM t_p5255237_telegram_bot_service.processed_updates 
+               WHERE bot_id = $1 AND update_id = $2''',
+            bot_id, update_id
+        )
+    
+    async def _cleanup_if_due(self) -> None:
+        now = time.monotonic()
+        if now - self._last_cleanup < self.cleanup_interval:
+            return
+        self._last_cleanup = now
+        result = await db.execute(
+            '''DELETE FROM t_p5255237_telegram_bot_service.processed_updates 
+               WHERE processed_at < CURRENT_TIMESTAMP - INTERVAL '1 hour' * $1''',
+            self.ttl_hours
+        )
+        self.stats['cleaned'] += int(result.split()[-1])
+
+update_dedup = UpdateDeduplicator(
+    max_size=int(os.environ.get('UPDATE_DEDUP_CACHE_SIZE', '10000')),
+    ttl_hours=int(os.environ.get('UPDATE_DEDUP_TTL_HOURS', '24'))
+)
+
+# Update одного чата обрабатываются по очереди (иначе шаги формы оплаты перезаписывают состояние друг друга)
+CHAT_ADVISORY_LOCKS = os.environ.get('CHAT_ADVISORY_LOCKS', 'true').lower() == 'true'
+CHAT_LOCK_TIMEOUT_MS = int(os.environ.get('CHAT_LOCK_TIMEOUT_MS', '10000'))
+
+def advisory_lock_key(chat_id: int) -> int:
+    '''chat_id в диапазоне int4 для pg_advisory_lock(int, int); совпадение ключей лишь упорядочит два чата'''
+    return (chat_id + 2 ** 31) % 2 ** 32 - 2 ** 31
+
+class ChatSerializer:
+    '''Очередь на чат: asyncio.Lock внутри контейнера и advisory lock Postgres между контейнерами'''
+    
+    def __init__(self, lock_db: AsyncDatabase, advisory: bool = True, lock_timeout_ms: int = 10000):
+        self.lock_db = lock_db
+        self.advisory = advisory
+        self.lock_timeout_ms = lock_timeout_ms
+        # (bot_id, chat_id) -> [asyncio.Lock, число ожидающих]; запись удаляется, когда чат свободен
+        self._locks: Dict[Tuple[int, int], list] = {}
+        self.stats = {'acquired': 0, 'waited_local': 0, 'timeouts': 0}
+    
+    @contextlib.asynccontextmanager
+    async def hold(self, bot_id: int, chat_id: Optional[int]):
+        if chat_id is None:
+            yield
+            return
+        key = (bot_id, chat_id)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.stats['waited_local'] += 1
+            async with entry[0]:
+                self.stats['acquired'] += 1
+                if not self.advisory:
+                    yield
+                else:
+                    async with self.lock_db.acquire() as conn:
+                        locked = await self._lock(conn, bot_id, chat_id)
+                        try:
+                            yield
+                        finally:
+                            if locked:
+                                await conn.execute('SELECT pg_advisory_unlock($1, $2)', bot_id, advisory_lock_key(chat_id))
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+    
+    async def _lock(self, conn: asyncpg.Connection, bot_id: int, chat_id: int) -> bool:
+        '''Ждать advisory lock не дольше lock_timeout; по таймауту обрабатываем без него, как раньше'''
+        try:
+            await conn.execute(
+                "SELECT set_config('lock_timeout', $3, true), pg_advisory_lock($1, $2)",
+                bot_id, advisory_lock_key(chat_id), f'{self.lock_timeout_ms}ms'
+            )
+            return True
+        except asyncpg.exceptions.LockNotAvailableError:
+            self.stats['timeouts'] += 1
+            print(f"[WARN Bot {bot_id}] Chat {chat_id} lock wait exceeded {self.lock_timeout_ms} ms, processing without it")
+            return False
+
+# Соединения под advisory lock держатся всю обработку Update, поэтому у них отдельный пул
+chat_lock_db = AsyncDatabase(
+    max_size=int(os.environ.get('CHAT_LOCK_POOL_SIZE', '5')),
+    statement_cache_size=int(os.environ.get('DB_STATEMENT_CACHE_SIZE', '100'))
+)
+chat_serializer = ChatSerializer(chat_lock_db, advisory=CHAT_ADVISORY_LOCKS, lock_timeout_ms=CHAT_LOCK_TIMEOUT_MS)
+
+def get_update_chat_id(update_data: Dict[str, Any]) -> Optional[int]:
+    '''Чат, к которому относится Update (для callback_query - чат сообщения с кнопкой)'''
+    for event_type in ('message', 'edited_message', 'callback_query'):
+        event = update_data.get(event_type)
+        if not event:
+            continue
+        chat = (event.get('message') or {}).get('chat') if event_type == 'callback_query' else event.get('chat')
+        return (chat or {}).get('id') or (event.get('from') or {}).get('id')
+    return None
+
+async def process_update(bot_id: int, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''Обрабатывает один Update от Telegram webhook; возвращает вызов Bot API для ответа на webhook'''
+    # Очередь чата занимается до первого await: Update одного чата, запущенные подряд, идут в том же порядке
+    async with chat_serializer.hold(bot_id, get_update_chat_id(update_data)):
+        # Telegram повторяет доставку, если ответ задержался: такой Update уже обработан
+        update_id = update_data.get('update_id')
+        if update_id is not None and not await update_dedup.claim(bot_id, update_id):
+            print(f"[DEDUP Bot {bot_id}] Update {update_id} already processed, skipping")
+            return None
+        try:
+            return await _process_new_update(bot_id, update_data)
+        except Exception:
+            if update_id is not None:
+                await update_dedup.release(bot_id, update_id)
+            raise
+
+async def _process_new_update(bot_id: int, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Получаем данные бота
+    bot_settings = await get_bot_settings(bot_id)
+    if not bot_settings:
+        print(f"[ERROR] Bot {bot_id} not found")
+        return None
+    
+    bot, dp = get_dispatcher(bot_id, bot_settings)
+    bot.session = await telegram_sessions.acquire(bot_settings['telegram_token'])
     
     # Обрабатываем Update
     update = types.Update(**update_data)
-    await dp.feed_update(bot, update)
+    event = update.message or update.callback_query
+    ctx = BotContext(bot_id, bot_settings, event.from_user if event else None)
+    reply = WebhookReply(bot) if WEBHOOK_REPLY_ENABLED else None
+    reply_token = _webhook_reply.set(reply)
+    try:
+        await dp.feed_update(bot, update, ctx=ctx)
+    except Exception:
+        if reply:
+            await reply.flush()
+            reply.closed = True
+        raise
+    finally:
+        _webhook_reply.reset(reply_token)
+    
+    return await reply.take() if reply else None
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -1864,7 +2571,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     if method == 'GET':
-        active_bots = get_active_bots()
+        active_bots = loop_runner.run(get_active_bots())
         return {
             'statusCode': 200,
             'headers': {
@@ -1873,7 +2580,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             },
             'body': json.dumps({
                 'active_bots': len(active_bots),
-                'bots': [{'id': b['id'], 'name': b['name']} for b in active_bots]
+                'bots': [{'id': b['id'], 'name': b['name']} for b in active_bots],
+                'db': db.stats,
+                'qr_leases': qr_leases.stats,
+                'qr_image_cache': qr_image_cache.stats,
+                'telegram_file_cache': telegram_file_cache.stats,
+                'bot_config_cache': bot_config_cache.stats,
+                'telegram_sessions': telegram_sessions.stats,
+                'update_dedup': update_dedup.stats,
+                'chat_serializer': chat_serializer.stats,
+                'telegram_rate_limiter': {**telegram_rate_limiter.stats, 'waiting': telegram_rate_limiter.waiting}
             }),
             'isBase64Encoded': False
         }
@@ -1907,10 +2623,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         update_data = json.loads(body_str) if body_str else {}
         
         # Проверяем что бот активен
-        active_bots = get_active_bots()
-        bot_data = next((b for b in active_bots if b['id'] == bot_id), None)
-        
-        if not bot_data:
+        if not loop_runner.run(is_bot_active(bot_id)):
             return {
                 'statusCode': 404,
                 'headers': {
@@ -1923,10 +2636,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         # Обрабатываем Update
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(process_update(bot_id, update_data))
-            loop.close()
+            webhook_reply = loop_runner.run(process_update(bot_id, update_data))
             
             return {
                 'statusCode': 200,
@@ -1934,7 +2644,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'Content-Type': 'application/json',
                     'Access-Control-Allow-Origin': '*'
                 },
-                'body': json.dumps({'ok': True}),
+                'body': json.dumps(webhook_reply or {'ok': True}),
                 'isBase64Encoded': False
             }
         except Exception as e:
@@ -1950,6 +2660,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'body': json.dumps({'error': str(e)}),
                 'isBase64Encoded': False
             }
+        finally:
+            print(f"[DB] {db.stats}")
     
     return {
         'statusCode': 405,
@@ -0,0 +1,331 @@
+'''
+Долгоживущий режим движка для собственного сервера: все активные боты в одном asyncio-процессе.
+
+Обработка Update та же, что в облачной функции (index.process_update), но без холодного старта:
+пул БД, HTTP-сессии к Telegram, кэш настроек и диспетчеры живут все время работы процесса.
+
+Режимы:
+  polling - getUpdates long polling по каждому боту; webhook бота при запуске снимается
+  webhook - aiohttp-сервер принимает POST /bot/<bot_id>; вебхуки ботов ставятся на --public-url
+            (ответ на webhook по-прежнему может нести вызов Bot API)
+
+Список ботов перечитывается каждые --refresh-interval секунд: боты, запущенные или остановленные
+через bot-runner, подключаются и отключаются на ходу, смена токена перезапускает бота.
+SIGTERM/SIGINT: прием новых Update прекращается, начатые дорабатываются, затем закрываются пулы.
+
+Вернуть боты в облачный режим после остановки - функция set-bot-webhook.
+
+Запуск:
+  DATABASE_URL=... python runner.py
+  DATABASE_URL=... RUNNER_WEBHOOK_SECRET=... python runner.py --mode webhook --public-url https://bots.example.com --port 8080
+'''
+import argparse
+import asyncio
+import hashlib
+import os
+import signal
+import sys
+import time
+from typing import Any, Callable, Dict, Optional, Set
+
+import aiohttp
+from aiohttp import web
+
+import index
+
+# Те же типы Update, что подписывает set-bot-webhook
+ALLOWED_UPDATES = ['message', 'callback_query']
+POLL_ERROR_DELAY = 5.0
+
+class BotRunner:
+    '''Хост активных ботов: подключение и отключение на ходу, общий лимит одновременно обрабатываемых Update'''
+    
+    def __init__(self, mode: str = 'polling', refresh_interval: float = 15.0, poll_timeout: int = 30,
+                 max_concurrency: int = 100, shutdown_grace: float = 30.0, public_url: str = '',
+                 webhook_secret: str = '', owns: Optional[Callable[[int], bool]] = None):
+        self.mode = mode
+        self.refresh_interval = refresh_interval
+        self.poll_timeout = poll_timeout
+        self.max_concurrency = max_concurrency
+        self.shutdown_grace = shutdown_grace
+        self.public_url = public_url.rstrip('/')
+        self.webhook_secret = webhook_secret
+        # Какие из активных ботов достаются этому процессу (supervisor делит ботов между процессами)
+        self.owns = owns or (lambda bot_id: True)
+        self._tokens: Dict[int, str] = {}
+        # Токены, на которые Telegram ответил 401: повторно не запускаем, пока токен в БД не сменится
+        self._revoked: Dict[int, str] = {}
+        self._pollers: Dict[int, asyncio.Task] = {}
+        self._inflight: Set[asyncio.Task] = set()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._http: Optional[aiohttp.ClientSession] = None
+        self.started_at = time.monotonic()
+        self.stats = {'updates': 0, 'errors': 0, 'bots_added': 0, 'bots_removed': 0, 'poll_errors': 0}
+    
+    @property
+    def bot_ids(self) -> list:
+        return sorted(self._tokens)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        '''Метрики процесса для логов и /health'''
+        return {
+            'mode': self.mode,
+            'bots': len(self._tokens),
+            'inflight': len(self._inflight),
+            'uptime': round(time.monotonic() - self.started_at),
+            **self.stats,
+            'db': index.db.stats,
+            'telegram_sessions': index.telegram_sessions.stats,
+            'telegram_rate_limiter': index.telegram_rate_limiter.stats,
+            'update_dedup': index.update_dedup.stats,
+            'chat_serializer': index.chat_serializer.stats
+        }
+    
+    def secret_for(self, bot_id: int) -> Optional[str]:
+        if not self.webhook_secret:
+            return None
+        return hashlib.sha256(f'{self.webhook_secret}:{bot_id}'.encode('utf-8')).hexdigest()
+    
+    async def call_api(self, token: str, api_method: str, data: Dict[str, Any], timeout: float = 10.0) -> Dict[str, Any]:
+        '''Сырой вызов Bot API: getUpdates отдает Update тем же JSON, что приходит на webhook'''
+        payload = {key: value for key, value in data.items() if value is not None}
+        async with self._http.post(
+            f'https://api.telegram.org/bot{token}/{api_method}',
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            return await response.json()
+    
+    async def sync_bots(self) -> None:
+        '''Привести набор запущенных ботов к списку активных в БД'''
+        active_ids = {bot['id'] for bot in await index.get_active_bots() if self.owns(bot['id'])}
+        for bot_id in list(self._tokens):
+            if bot_id not in active_ids:
+                await self.remove_bot(bot_id)
+        for bot_id in sorted(active_ids):
+            bot_settings = await index.get_bot_settings(bot_id)
+            if not bot_settings:
+                continue
+            token = bot_settings['telegram_token']
+            if self._tokens.get(bot_id) == token or self._revoked.get(bot_id) == token:
+                continue
+            if bot_id in self._tokens:
+                print(f"[RUNNER] Bot {bot_id} token changed, restarting")
+                await self.remove_bot(bot_id)
+            await self.add_bot(bot_id, token)
+    
+    async def add_bot(self, bot_id: int, token: str) -> None:
+        try:
+            if self.mode == 'webhook':
+                result = await self.call_api(token, 'setWebhook', {
+                    'url': f'{self.public_url}/bot/{bot_id}',
+                    'allowed_updates': ALLOWED_UPDATES,
+                    'secret_token': self.secret_for(bot_id)
+                })
+                if not result.get('ok'):
+                    print(f"[RUNNER] Bot {bot_id} setWebhook failed: {result.get('description')}")
+                    return
+            else:
+                # getUpdates не работает, пока у бота установлен webhook
+                await self.call_api(token, 'deleteWebhook', {'drop_pending_updates': False})
+                self._pollers[bot_id] = asyncio.create_task(self._poll(bot_id, token))
+        except Exception as e:
+            print(f"[RUNNER] Bot {bot_id} start failed: {e}")
+            return
+        self._tokens[bot_id] = token
+        self.stats['bots_added'] += 1
+        print(f"[RUNNER] Bot {bot_id} started ({self.mode})")
+    
+    async def remove_bot(self, bot_id: int) -> None:
+        self._tokens.pop(bot_id, None)
+        poller = self._pollers.pop(bot_id, None)
+        if poller:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        self.stats['bots_removed'] += 1
+        print(f"[RUNNER] Bot {bot_id} stopped")
+    
+    async def _poll(self, bot_id: int, token: str) -> None:
+        '''Цикл getUpdates одного бота; полученные Update подтверждаются offset следующего запроса'''
+        offset = None
+        while not self._stopping.is_set():
+            try:
+                result = await self.call_api(token, 'getUpdates', {
+                    'offset': offset,
+                    'timeout': self.poll_timeout,
+                    'allowed_updates': ALLOWED_UPDATES
+                }, timeout=self.poll_timeout + 10)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats['poll_errors'] += 1
+                print(f"[RUNNER] Bot {bot_id} getUpdates error: {e}")
+                await asyncio.sleep(POLL_ERROR_DELAY)
+                continue
+            
+            if not result.get('ok'):
+                self.stats['poll_errors'] += 1
+                error_code = result.get('error_code')
+                print(f"[RUNNER] Bot {bot_id} getUpdates failed: {error_code} {result.get('description')}")
+                if error_code == 401:
+                    # Токен отозван: бот вернется, когда в БД появится новый токен
+                    self._revoked[bot_id] = token
+                    self._tokens.pop(bot_id, None)
+                    self._pollers.pop(bot_id, None)
+                    return
+                if error_code == 409:
+                    # Кто-то снова поставил webhook (например, set-bot-webhook)
+                    await self.call_api(token, 'deleteWebhook', {'drop_pending_updates': False})
+                retry_after = (result.get('parameters') or {}).get('retry_after')
+                await asyncio.sleep(retry_after or POLL_ERROR_DELAY)
+                continue
+            
+            for update in result['result']:
+                offset = update['update_id'] + 1
+                # Свободный слот ждем до запуска задачи: при перегрузке следующий getUpdates откладывается
+                await self._slots.acquire()
+                self._spawn(bot_id, update)
+    
+    def _spawn(self, bot_id: int, update: Dict[str, Any]) -> None:
+        task = asyncio.create_task(self._process(bot_id, update))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+    
+    async def _process(self, bot_id: int, update: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        '''Обработать Update; слот семафора уже занят вызывающим'''
+        try:
+            reply = await index.process_update(bot_id, update)
+            self.stats['updates'] += 1
+            return reply
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"[RUNNER] Bot {bot_id} update {update.get('update_id')} failed: {e}")
+            return None
+        finally:
+            self._slots.release()
+    
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        try:
+            bot_id = int(request.match_info['bot_id'])
+        except ValueError:
+            return web.json_response({'error': 'Bad bot id'}, status=404)
+        if bot_id not in self._tokens or self._stopping.is_set():
+            return web.json_response({'error': 'Bot not found or inactive'}, status=404)
+        secret = self.secret_for(bot_id)
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.json_response({'error': 'Forbidden'}, status=403)
+        
+        update = await request.json()
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(bot_id, update))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+        # Вызов Bot API в теле ответа экономит отдельный запрос к Telegram
+        reply = await task
+        return web.json_response(reply or {'ok': True})
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.snapshot())
+    
+    def stop(self) -> None:
+        if self._stopping and not self._stopping.is_set():
+            print("[RUNNER] Shutdown requested")
+            self._stopping.set()
+    
+    async def run(self, host: str = '0.0.0.0', port: int = 8080) -> None:
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        # Бот обслуживает ровно один процесс (единственный runner или свой шард supervisor), поэтому
+        # очередь чата держит asyncio.Lock; advisory lock занимал бы соединение на каждый Update в обработке
+        index.chat_serializer.advisory = False
+        self._stopping = asyncio.Event()
+        # У каждого опрашиваемого бота висит свой long polling запрос, поэтому без лимита соединений
+        self._http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        # В polling ответа на webhook нет: все вызовы Bot API уходят обычными запросами
+        index.WEBHOOK_REPLY_ENABLED = self.mode == 'webhook'
+        
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        
+        web_runner = None
+        if self.mode == 'webhook':
+            app = web.Application()
+            app.router.add_post('/bot/{bot_id}', self.handle_webhook)
+            app.router.add_get('/health', self.handle_health)
+            web_runner = web.AppRunner(app)
+            await web_runner.setup()
+            await web.TCPSite(web_runner, host, port).start()
+            print(f"[RUNNER] Listening on {host}:{port}")
+        
+        try:
+            while not self._stopping.is_set():
+                try:
+                    await self.sync_bots()
+                except Exception as e:
+                    print(f"[RUNNER] Bot list refresh failed: {e}")
+                print(f"[RUNNER] {self.snapshot()}")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.refresh_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.shutdown(web_runner)
+    
+    async def shutdown(self, web_runner: Optional[web.AppRunner]) -> None:
+        '''Остановить прием, дождаться начатых Update и закрыть общие ресурсы'''
+        for poller in self._pollers.values():
+            poller.cancel()
+        await asyncio.gather(*self._pollers.values(), return_exceptions=True)
+        self._pollers.clear()
+        
+        if self._inflight:
+            print(f"[RUNNER] Waiting for {len(self._inflight)} updates in progress")
+            _, pending = await asyncio.wait(set(self._inflight), timeout=self.shutdown_grace)
+            for task in pending:
+                task.cancel()
+        if web_runner:
+            await web_runner.cleanup()
+        
+        await self._http.close()
+        await index.telegram_sessions.close_all()
+        await index.qr_leases.release_all()
+        await index.chat_lock_db.close()
+        await index.db.close()
+        print(f"[RUNNER] Stopped: {self.stats}")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Long-running multi-bot engine')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default=os.environ.get('RUNNER_MODE', 'polling'))
+    parser.add_argument('--refresh-interval', type=float, default=float(os.environ.get('RUNNER_REFRESH_INTERVAL', '15')))
+    parser.add_argument('--poll-timeout', type=int, default=int(os.environ.get('RUNNER_POLL_TIMEOUT', '30')))
+    parser.add_argument('--max-concurrency', type=int, default=int(os.environ.get('RUNNER_MAX_CONCURRENCY', '100')))
+    parser.add_argument('--shutdown-grace', type=float, default=float(os.environ.get('RUNNER_SHUTDOWN_GRACE', '30')))
+    parser.add_argument('--public-url', default=os.environ.get('RUNNER_PUBLIC_URL', ''))
+    parser.add_argument('--host', default=os.environ.get('RUNNER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('RUNNER_PORT', '8080')))
+    return parser
+
+def main() -> int:
+    args = build_parser().parse_args()
+    if args.mode == 'webhook' and not args.public_url:
+        print("--public-url is required in webhook mode")
+        return 2
+    
+    # Пул БД рассчитан на параллельную обработку, а не на один Update за вызов функции
+    index.db.max_size = max(index.db.max_size, int(os.environ.get('RUNNER_DB_POOL_SIZE', '20')))
+    
+    runner = BotRunner(
+        mode=args.mode,
+        refresh_interval=args.refresh_interval,
+        poll_timeout=args.poll_timeout,
+        max_concurrency=args.max_concurrency,
+        shutdown_grace=args.shutdown_grace,
+        public_url=args.public_url,
+        webhook_secret=os.environ.get('RUNNER_WEBHOOK_SECRET', '')
+    )
+    index.loop_runner.run(runner.run(args.host, args.port))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
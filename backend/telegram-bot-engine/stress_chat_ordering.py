@@ -0,0 +1,127 @@
+'''
+Нагрузочная проверка упорядоченной обработки Update внутри чата (ChatSerializer).
+
+Несколько процессов (как несколько контейнеров функции) одновременно обрабатывают пачки "Update" для
+нескольких тестовых чатов. Каждый "Update" читает FSM-данные чата через PostgresStorage, имитирует
+работу обработчика и дописывает свою метку - ровно то чтение-изменение-запись, на котором гонялись
+шаги формы оплаты. Проверяется, что:
+  - ни одна запись не потеряна (в чате ровно processes * updates меток);
+  - внутри процесса метки чата идут в порядке поступления Update;
+  - разные чаты обрабатываются параллельно (ускорение относительно полностью последовательной обработки).
+
+С --no-locks тот же сценарий идет без блокировок и показывает потерянные записи.
+Тестовые чаты создаются в bot_fsm_states с chat_id от 9000000000 и удаляются после проверки.
+
+Запуск: DATABASE_URL=... python stress_chat_ordering.py --processes 4 --chats 20 --updates 10 --work-ms 20
+'''
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import sys
+import time
+
+import index
+
+TEST_CHAT_BASE = 9_000_000_000
+
+def storage_key(bot_id: int, chat_id: int) -> index.StorageKey:
+    return index.StorageKey(bot_id=bot_id, chat_id=chat_id, user_id=chat_id)
+
+async def handle_update(storage: index.PostgresStorage, bot_id: int, chat_id: int, mark: str,
+                        work: float, use_locks: bool) -> None:
+    hold = index.chat_serializer.hold(bot_id, chat_id) if use_locks else contextlib.nullcontext()
+    async with hold:
+        key = storage_key(bot_id, chat_id)
+        data = await storage.get_data(key)
+        await asyncio.sleep(work)
+        await storage.set_data(key, {'marks': data.get('marks', []) + [mark]})
+
+async def run_worker(worker: int, bot_id: int, chats: int, updates: int, work: float, use_locks: bool) -> None:
+    storage = index.PostgresStorage()
+    try:
+        # Update одного чата приходят по порядку n = 0..updates-1, чаты перемешаны
+        await asyncio.gather(*(
+            handle_update(storage, bot_id, TEST_CHAT_BASE + chat, f'{worker}:{n}', work, use_locks)
+            for n in range(updates)
+            for chat in range(chats)
+        ))
+    finally:
+        await index.chat_lock_db.close()
+        await index.db.close()
+
+def worker_main(worker: int, bot_id: int, chats: int, updates: int, work: float, use_locks: bool) -> None:
+    index.chat_lock_db.max_size = chats
+    index.db.max_size = chats
+    index.loop_runner.run(run_worker(worker, bot_id, chats, updates, work, use_locks))
+
+async def cleanup(bot_id: int, chats: int) -> None:
+    await index.db.execute(
+        '''DELETE FROM t_p5255237_telegram_bot_service.bot_fsm_states
+           WHERE bot_id = $1 AND chat_id >= $2 AND chat_id < $3''',
+        bot_id, TEST_CHAT_BASE, TEST_CHAT_BASE + chats
+    )
+
+async def verify(bot_id: int, chats: int, processes: int, updates: int) -> bool:
+    storage = index.PostgresStorage()
+    ok = True
+    lost_total = 0
+    for chat in range(chats):
+        marks = (await storage.get_data(storage_key(bot_id, TEST_CHAT_BASE + chat))).get('marks', [])
+        lost = processes * updates - len(marks)
+        lost_total += lost
+        for worker in range(processes):
+            sequence = [int(mark.split(':')[1]) for mark in marks if mark.split(':')[0] == str(worker)]
+            if sequence != sorted(sequence):
+                print(f"chat {chat}: worker {worker} updates out of order: {sequence}")
+                ok = False
+        if lost:
+            ok = False
+    print(f"lost updates: {lost_total} of {chats * processes * updates}")
+    return ok
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Per-chat ordering stress test')
+    parser.add_argument('--bot-id', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--updates', type=int, default=10)
+    parser.add_argument('--work-ms', type=float, default=20)
+    parser.add_argument('--no-locks', action='store_true')
+    args = parser.parse_args()
+    use_locks = not args.no_locks
+    work = args.work_ms / 1000
+    
+    index.loop_runner.run(cleanup(args.bot_id, args.chats))
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=worker_main, args=(w, args.bot_id, args.chats, args.updates, work, use_locks))
+        for w in range(args.processes)
+    ]
+    started = time.perf_counter()
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    elapsed = time.perf_counter() - started
+    
+    try:
+        ok = index.loop_runner.run(verify(args.bot_id, args.chats, args.processes, args.updates))
+    finally:
+        index.loop_runner.run(cleanup(args.bot_id, args.chats))
+        index.loop_runner.run(index.db.close())
+    
+    # Нижняя граница при строгом порядке в чате: все Update одного чата подряд
+    per_chat_serial = args.processes * args.updates * work
+    fully_serial = per_chat_serial * args.chats
+    print(f"locks={'on' if use_locks else 'off'} processes={args.processes} chats={args.chats} updates={args.updates}")
+    print(f"elapsed {elapsed:.2f}s, per-chat serial bound {per_chat_serial:.2f}s, "
+          f"speedup vs fully serial {fully_serial / elapsed:.1f}x")
+    if ok:
+        print("OK")
+        return 0
+    print("FAIL")
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
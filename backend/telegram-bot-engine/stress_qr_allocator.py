@@ -0,0 +1,97 @@
+'''
+Нагрузочная проверка выдачи QR-ключей на отсутствие дублей и сравнение пропускной способности.
+
+Для каждого режима создает для бота временную партию ключей с отдельным code_type, разбирает ее
+большим числом конкурентных запросов, проверяет, что каждый ключ выдан ровно один раз, и удаляет
+партию. Рабочие ключи бота не затрагиваются.
+
+Режимы:
+  allocate - атомарный UPDATE ... FOR UPDATE SKIP LOCKED на каждый запрос (allocate_qr_key)
+  lease    - выдача из заранее арендованных блоков (QrKeyLeasePool)
+
+Запуск: DATABASE_URL=... python stress_qr_allocator.py --bot-id 1 --codes 500 --requests 800 --concurrency 50
+'''
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+
+import index
+
+STRESS_CODE_TYPE = 'stress_test'
+
+async def create_batch(bot_id: int, codes: int) -> None:
+    max_number = await index.db.fetchval(
+        'SELECT COALESCE(MAX(code_number), 0) FROM t_p5255237_telegram_bot_service.qr_codes WHERE bot_id = $1',
+        bot_id
+    )
+    await index.db.execute(
+        '''INSERT INTO t_p5255237_telegram_bot_service.qr_codes (bot_id, code_number, code_type, is_used)
+           SELECT $1, n, $2, false FROM generate_series($3::int, $4::int) AS n''',
+        bot_id, STRESS_CODE_TYPE, max_number + 1, max_number + codes
+    )
+
+async def delete_batch(bot_id: int) -> None:
+    await index.db.execute(
+        'DELETE FROM t_p5255237_telegram_bot_service.qr_codes WHERE bot_id = $1 AND code_type = $2',
+        bot_id, STRESS_CODE_TYPE
+    )
+
+async def run_mode(mode: str, bot_id: int, codes: int, requests: int, concurrency: int) -> bool:
+    await create_batch(bot_id, codes)
+    leases = index.QrKeyLeasePool(block_size=index.qr_leases.block_size or 20, lease_ttl=index.qr_leases.lease_ttl)
+    try:
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def issue() -> int:
+            async with semaphore:
+                if mode == 'lease':
+                    qr_code = await leases.issue(bot_id, STRESS_CODE_TYPE, None)
+                else:
+                    qr_code = await index.allocate_qr_key(bot_id, STRESS_CODE_TYPE, None)
+                return qr_code['id'] if qr_code else None
+        
+        started = time.perf_counter()
+        results = await asyncio.gather(*(issue() for _ in range(requests)))
+        elapsed = time.perf_counter() - started
+        
+        issued = [code_id for code_id in results if code_id is not None]
+        duplicates = {code_id: count for code_id, count in Counter(issued).items() if count > 1}
+        expected = min(codes, requests)
+        
+        print(f"[{mode}] issued={len(issued)} (expected {expected}), exhausted={requests - len(issued)}, duplicates={len(duplicates)}")
+        print(f"[{mode}] throughput: {len(issued) / elapsed:.1f} keys/s")
+        if mode == 'lease':
+            print(f"[{mode}] lease stats: {leases.stats}")
+        
+        if duplicates or len(issued) != expected:
+            print(f"[{mode}] FAIL: duplicate ids {sorted(duplicates)[:20]}")
+            return False
+        return True
+    finally:
+        await leases.release_all()
+        await delete_batch(bot_id)
+
+async def run(modes: list, bot_id: int, codes: int, requests: int, concurrency: int) -> int:
+    print(f"requests={requests} codes={codes} concurrency={concurrency} pool_max_size={index.db.max_size}")
+    try:
+        results = [await run_mode(mode, bot_id, codes, requests, concurrency) for mode in modes]
+    finally:
+        await index.db.close()
+    if all(results):
+        print("OK")
+        return 0
+    return 1
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='QR key allocator stress test')
+    parser.add_argument('--bot-id', type=int, required=True)
+    parser.add_argument('--codes', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=800)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--mode', choices=['allocate', 'lease', 'both'], default='both')
+    args = parser.parse_args()
+    index.db.max_size = args.concurrency
+    modes = ['allocate', 'lease'] if args.mode == 'both' else [args.mode]
+    sys.exit(index.loop_runner.run(run(modes, args.bot_id, args.codes, args.requests, args.concurrency)))
@@ -0,0 +1,262 @@
+'''
+Supervisor для размещения сотен ботов на всех ядрах одной машины.
+
+Запускает N процессов-воркеров; каждый - BotRunner в режиме polling со своими диспетчерами, кэшами
+и пулами соединений. Боты делятся между воркерами консистентным хешированием bot_id: каждый воркер
+сам перечитывает список активных ботов и берет только свои, поэтому запуск и остановка бота через
+bot-runner затрагивает только один шард, а смена числа воркеров переносит примерно 1/N ботов.
+
+Упавший воркер перезапускается с экспоненциальной задержкой. Воркеры раз в --report-interval
+присылают метрики (ботов, Update в работе, обработано, ошибки, обращения к БД); supervisor отдает
+их по HTTP GET /metrics на --metrics-port и печатает сводку в лог.
+
+Запуск: DATABASE_URL=... python supervisor.py --workers 8 --db-connections 80 --metrics-port 9100
+'''
+import argparse
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+class HashRing:
+    '''Консистентное хеширование bot_id по шардам с виртуальными узлами для равномерности'''
+    
+    def __init__(self, shards: int, vnodes: int = 128):
+        self.shards = shards
+        points = sorted(
+            (self._hash(f'shard-{shard}-{vnode}'), shard)
+            for shard in range(shards)
+            for vnode in range(vnodes)
+        )
+        self._keys = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+    
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+    
+    def shard_for(self, bot_id: int) -> int:
+        position = bisect.bisect(self._keys, self._hash(f'bot-{bot_id}')) % len(self._keys)
+        return self._shards[position]
+
+def worker_main(shard: int, shards: int, vnodes: int, db_pool_size: int, options: Dict[str, Any],
+                metrics: multiprocessing.Queue, report_interval: float) -> None:
+    '''Точка входа процесса-воркера: BotRunner только для ботов своего шарда'''
+    import asyncio
+    import index
+    import runner
+    
+    ring = HashRing(shards, vnodes)
+    index.db.max_size = db_pool_size
+    bot_runner = runner.BotRunner(owns=lambda bot_id: ring.shard_for(bot_id) == shard, **options)
+    
+    async def report() -> None:
+        while True:
+            await asyncio.sleep(report_interval)
+            snapshot = bot_runner.snapshot()
+            try:
+                metrics.put_nowait({
+                    'shard': shard,
+                    'pid': os.getpid(),
+                    'bot_ids': bot_runner.bot_ids,
+                    'reported_at': time.time(),
+                    **{key: snapshot[key] for key in ('bots', 'inflight', 'uptime', 'updates', 'errors', 'poll_errors')},
+                    'db_queries': snapshot['db']['queries'],
+                    'telegram_throttled': snapshot['telegram_rate_limiter']['throttled']
+                })
+            except queue.Full:
+                pass
+    
+    async def main() -> None:
+        reporter = asyncio.create_task(report())
+        try:
+            await bot_runner.run()
+        finally:
+            reporter.cancel()
+    
+    index.loop_runner.run(main())
+
+class Supervisor:
+    '''Держит N воркеров живыми и собирает их метрики'''
+    
+    def __init__(self, workers: int, vnodes: int, db_connections: int, options: Dict[str, Any],
+                 report_interval: float = 10.0, max_restart_delay: float = 60.0):
+        self.workers = workers
+        self.vnodes = vnodes
+        self.db_pool_size = max(2, db_connections // workers)
+        self.options = options
+        self.report_interval = report_interval
+        self.max_restart_delay = max_restart_delay
+        self._context = multiprocessing.get_context('spawn')
+        self._metrics_queue = self._context.Queue(maxsize=workers * 100)
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        # Перезапуски подряд без периода стабильной работы: растет задержка следующего
+        self._crashes = [0] * workers
+        self._restart_at = [0.0] * workers
+        self._started_at = [0.0] * workers
+        self.metrics: Dict[int, Dict[str, Any]] = {}
+        self.restarts = [0] * workers
+        self._stopping = False
+    
+    def _start(self, shard: int) -> None:
+        process = self._context.Process(
+            target=worker_main,
+            args=(shard, self.workers, self.vnodes, self.db_pool_size, self.options,
+                  self._metrics_queue, self.report_interval),
+            name=f'bot-shard-{shard}'
+        )
+        process.start()
+        self._processes[shard] = process
+        self._started_at[shard] = time.monotonic()
+        print(f"[SUPERVISOR] Shard {shard} started, pid {process.pid}")
+    
+    def _check_workers(self) -> None:
+        now = time.monotonic()
+        for shard, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                # Проработал дольше максимальной задержки - считаем, что цепочка падений закончилась
+                if self._crashes[shard] and now - self._started_at[shard] > self.max_restart_delay:
+                    self._crashes[shard] = 0
+                continue
+            if process is not None:
+                process.join(0)
+                self._processes[shard] = None
+                self._crashes[shard] += 1
+                self.restarts[shard] += 1
+                delay = min(2 ** (self._crashes[shard] - 1), self.max_restart_delay)
+                self._restart_at[shard] = now + delay
+                self.metrics.pop(shard, None)
+                print(f"[SUPERVISOR] Shard {shard} exited with code {process.exitcode}, restart in {delay:.0f}s")
+            if now >= self._restart_at[shard]:
+                self._start(shard)
+    
+    def _drain_metrics(self) -> None:
+        while True:
+            try:
+                report = self._metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            process = self._processes[report['shard']]
+            # Отчет мог прийти от уже замененного процесса
+            if process is not None and process.pid == report['pid']:
+                self.metrics[report['shard']] = report
+    
+    def summary(self) -> Dict[str, Any]:
+        shards = []
+        for shard in range(self.workers):
+            report = self.metrics.get(shard, {})
+            process = self._processes[shard]
+            shards.append({
+                'shard': shard,
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'restarts': self.restarts[shard],
+                **{key: value for key, value in report.items() if key not in ('shard', 'pid')}
+            })
+        return {
+            'workers': self.workers,
+            'bots': sum(s.get('bots', 0) for s in shards),
+            'inflight': sum(s.get('inflight', 0) for s in shards),
+            'updates': sum(s.get('updates', 0) for s in shards),
+            'shards': shards
+        }
+    
+    def serve_metrics(self, port: int) -> None:
+        supervisor = self
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = json.dumps(supervisor.summary()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"[SUPERVISOR] Metrics on :{port}/metrics")
+    
+    def stop(self, *_) -> None:
+        self._stopping = True
+    
+    def run(self, metrics_port: int = 0, shutdown_timeout: float = 40.0) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if metrics_port:
+            self.serve_metrics(metrics_port)
+        
+        last_summary = 0.0
+        while not self._stopping:
+            self._check_workers()
+            self._drain_metrics()
+            if time.monotonic() - last_summary >= self.report_interval:
+                last_summary = time.monotonic()
+                summary = self.summary()
+                loads = ', '.join(
+                    f"{s['shard']}:{s.get('bots', 0)}b/{s.get('inflight', 0)}i/{s.get('updates', 0)}u"
+                    for s in summary['shards']
+                )
+                print(f"[SUPERVISOR] bots={summary['bots']} inflight={summary['inflight']} shards [{loads}]")
+            time.sleep(0.5)
+        
+        # Воркеры по SIGTERM дорабатывают начатые Update и закрывают пулы
+        print("[SUPERVISOR] Stopping workers")
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + shutdown_timeout
+        for process in self._processes:
+            if process is not None:
+                process.join(max(0.0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.kill()
+        print("[SUPERVISOR] Stopped")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Sharded multi-process bot host')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SUPERVISOR_WORKERS', str(os.cpu_count() or 1))))
+    parser.add_argument('--vnodes', type=int, default=128)
+    parser.add_argument('--db-connections', type=int, default=int(os.environ.get('SUPERVISOR_DB_CONNECTIONS', '80')),
+                        help='общий бюджет соединений с БД на все воркеры')
+    parser.add_argument('--metrics-port', type=int, default=int(os.environ.get('SUPERVISOR_METRICS_PORT', '0')))
+    parser.add_argument('--report-interval', type=float, default=10.0)
+    parser.add_argument('--refresh-interval', type=float, default=float(os.environ.get('RUNNER_REFRESH_INTERVAL', '15')))
+    parser.add_argument('--poll-timeout', type=int, default=int(os.environ.get('RUNNER_POLL_TIMEOUT', '30')))
+    parser.add_argument('--max-concurrency', type=int, default=int(os.environ.get('RUNNER_MAX_CONCURRENCY', '100')))
+    parser.add_argument('--shutdown-grace', type=float, default=float(os.environ.get('RUNNER_SHUTDOWN_GRACE', '30')))
+    args = parser.parse_args()
+    
+    supervisor = Supervisor(
+        workers=args.workers,
+        vnodes=args.vnodes,
+        db_connections=args.db_connections,
+        options={
+            'mode': 'polling',
+            'refresh_interval': args.refresh_interval,
+            'poll_timeout': args.poll_timeout,
+            'max_concurrency': args.max_concurrency,
+            'shutdown_grace': args.shutdown_grace
+        },
+        report_interval=args.report_interval
+    )
+    supervisor.run(metrics_port=args.metrics_port, shutdown_timeout=args.shutdown_grace + 10)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+'''
+Тесты обработчиков telegram-bot-engine без Postgres и Telegram.
+
+FakeDatabase подменяет index.db: отвечает на запросы по подстроке SQL и записывает каждый запрос,
+поэтому тесты проверяют и результат, и то, какие обращения к БД сделал обработчик.
+HandlerRoundTripBudgetTest следит, чтобы обработчики не превышали свой бюджет обращений к БД на один Update.
+
+Запуск: python -m unittest test_engine (из каталога функции, с установленными requirements.txt)
+'''
+import ast
+import asyncio
+import contextlib
+import os
+import unittest
+from contextvars import ContextVar
+from datetime import date
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from unittest import mock
+
+import index
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Запросы текущего Update: у каждой задачи asyncio своя копия контекста, поэтому параллельные Update
+# не смешивают счетчики (общий stats['queries'] считает все Update сразу)
+update_queries: ContextVar[Optional[List[str]]] = ContextVar('update_queries', default=None)
+
+class FakeDatabase:
+    '''Замена AsyncDatabase: ответы задаются списком (подстрока SQL, результат), запросы записываются'''
+    
+    def __init__(self, responses: Optional[List[Tuple[str, Any]]] = None):
+        self.responses = responses or []
+        self.queries: List[str] = []
+        self.stats = {'queries': 0, 'pools_created': 0}
+    
+    def _answer(self, query: str, args: tuple, default: Any) -> Any:
+        self.queries.append(query)
+        self.stats['queries'] += 1
+        current = update_queries.get()
+        if current is not None:
+            current.append(query)
+        for fragment, result in self.responses:
+            if fragment in query:
+                return result(*args) if callable(result) else result
+        return default
+    
+    async def fetch(self, query: str, *args) -> List[Dict]:
+        return self._answer(query, args, [])
+    
+    async def fetchrow(self, query: str, *args) -> Optional[Dict]:
+        return self._answer(query, args, None)
+    
+    async def fetchval(self, query: str, *args) -> Any:
+        return self._answer(query, args, None)
+    
+    async def execute(self, query: str, *args) -> str:
+        return self._answer(query, args, 'OK')
+    
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self
+    
+    def transaction(self):
+        return contextlib.nullcontext()
+    
+    async def close(self) -> None:
+        pass
+
+async def run_update(handler: Callable[[], Awaitable[Any]]) -> List[str]:
+    '''Выполнить обработчик как отдельный Update и вернуть запросы к БД, сделанные именно им'''
+    async def update() -> List[str]:
+        queries: List[str] = []
+        update_queries.set(queries)
+        await handler()
+        return queries
+    return await asyncio.create_task(update())
+
+def make_message(text: str = '', telegram_user_id: int = 100) -> mock.MagicMock:
+    message = mock.MagicMock()
+    message.text = text
+    message.from_user = index.types.User(id=telegram_user_id, is_bot=False, first_name='Test')
+    message.answer = mock.AsyncMock()
+    message.answer_photo = mock.AsyncMock()
+    return message
+
+class WarehouseSlotsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_booked_slots_are_excluded_from_schedule(self):
+        fake_db = FakeDatabase([
+            ('warehouse_schedule', {'work_start_time': '09:00:00', 'work_end_time': '13:00:00',
+                                    'slot_duration_minutes': 60, 'work_days': '1,2,3,4,5'}),
+            ('warehouse_bookings', [{'booking_time': '10:00:00'}, {'booking_time': '12:00:00'}])
+        ])
+        with mock.patch.object(index, 'db', fake_db):
+            slots = await index.get_available_time_slots(1, date(2026, 1, 5))
+        self.assertEqual(slots, ['09:00', '11:00'])
+        self.assertEqual(len(fake_db.queries), 2)
+    
+    async def test_default_schedule_when_not_configured(self):
+        fake_db = FakeDatabase()
+        with mock.patch.object(index, 'db', fake_db):
+            slots = await index.get_available_time_slots(1, date(2026, 1, 5))
+        self.assertEqual(slots[0], '08:00')
+        self.assertEqual(slots[-1], '17:00')
+        self.assertEqual(len(slots), 10)
+
+class QrKeyLeasePoolTest(unittest.IsolatedAsyncioTestCase):
+    async def test_falls_back_to_direct_allocation_when_block_is_empty(self):
+        # Все свободные ключи арендованы другим воркером: блок пустой, но ключ все равно выдается
+        fake_db = FakeDatabase([
+            ('SET lease_owner = $3', []),
+            ('SET is_used = true, used_by_user_id = $3', {'id': 7, 'code_number': 42})
+        ])
+        pool = index.QrKeyLeasePool(block_size=5)
+        with mock.patch.object(index, 'db', fake_db):
+            qr_code = await pool.issue(1, 'free', 10)
+        self.assertEqual(qr_code['code_number'], 42)
+        self.assertEqual(pool.stats['fallbacks'], 1)
+        self.assertNotIn('lease_expires_at < CURRENT_TIMESTAMP', fake_db.queries[-1])
+    
+    async def test_lease_includes_own_expired_block(self):
+        fake_db = FakeDatabase([('SET lease_owner = $3', [])])
+        pool = index.QrKeyLeasePool(block_size=5)
+        with mock.patch.object(index, 'db', fake_db):
+            await pool._lease_block(1, 'free')
+        self.assertIn('OR lease_owner = $3', fake_db.queries[0])
+
+class HandlerRoundTripBudgetTest(unittest.IsolatedAsyncioTestCase):
+    '''Новый пользователь, холодный кэш file_id и пустой блок арендованных ключей - самый дорогой случай'''
+    ADMIN_ID = 999
+    SETTINGS = {
+        'id': 1, 'template': 'keys', 'payment_enabled': True, 'button_texts': {}, 'message_texts': {},
+        'admin_telegram_ids': [ADMIN_ID], 'tbank_terminal_key': 'terminal', 'tbank_password': 'password'
+    }
+    
+    def setUp(self):
+        self.fake_db = FakeDatabase([
+            ('INSERT INTO t_p5255237_telegram_bot_service.bot_users', 55),
+            ('SET lease_owner = $3', [{'id': 7, 'code_number': 42}]),
+            ('used_by_user_id = $2', {'id': 7, 'code_number': 42}),
+            ('SELECT * FROM t_p5255237_telegram_bot_service.qr_codes', {'id': 1, 'code_number': 1})
+        ])
+        for target, value in (('db', self.fake_db), ('telegram_file_cache', index.TelegramFileCache()),
+                              ('qr_leases', index.QrKeyLeasePool()), ('generate_qr_image', lambda *args: b'png')):
+            patcher = mock.patch.object(index, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def context(self, message: mock.MagicMock, **settings) -> index.BotContext:
+        return index.BotContext(1, {**self.SETTINGS, **settings}, message.from_user)
+    
+    async def assert_budget(self, budget: int, handler: Callable[[mock.MagicMock], Awaitable[Any]],
+                            message: Optional[mock.MagicMock] = None) -> None:
+        message = message or make_message()
+        queries = await run_update(lambda: handler(message))
+        self.assertLessEqual(len(queries), budget, '\n'.join(queries))
+        self.assertTrue(message.answer.await_count or message.answer_photo.await_count)
+    
+    async def test_start(self):
+        await self.assert_budget(2, lambda message: index.cmd_start(message, self.context(message)))
+    
+    async def test_free_key(self):
+        await self.assert_budget(6, lambda message: index.handle_free_key(message, self.context(message)))
+    
+    async def test_free_key_for_admin(self):
+        await self.assert_budget(5, lambda message: index.handle_free_key(message, self.context(message)),
+                                 make_message(telegram_user_id=self.ADMIN_ID))
+    
+    async def test_secret_shop(self):
+        await self.assert_budget(0, lambda message: index.handle_secret_shop(message, self.context(message)))
+    
+    async def test_buy_vip(self):
+        await self.assert_budget(1, lambda message: index.handle_buy_vip(
+            message, self.context(message), mock.AsyncMock(), mock.MagicMock()))
+    
+    async def test_privacy_policy(self):
+        await self.assert_budget(3, lambda message: index.handle_privacy_policy(message, self.context(message)))
+    
+    async def test_help(self):
+        await self.assert_budget(0, index.handle_help)
+    
+    async def test_shop_catalog(self):
+        await self.assert_budget(1, lambda message: index.handle_shop_catalog(message, 1))
+    
+    async def test_view_cart(self):
+        await self.assert_budget(3, lambda message: index.handle_view_cart(message, self.context(message, template='shop')))
+    
+    async def test_warehouse_my_bookings(self):
+        await self.assert_budget(1, lambda message: index.handle_warehouse_my_bookings(message, 1))
+    
+    async def test_warehouse_info(self):
+        await self.assert_budget(1, lambda message: index.handle_warehouse_info(message, 1))
+    
+    async def test_parallel_updates_are_counted_separately(self):
+        messages = [make_message(telegram_user_id=100 + i) for i in range(3)]
+        counts = await asyncio.gather(
+            run_update(lambda: index.handle_help(messages[0])),
+            run_update(lambda: index.cmd_start(messages[1], self.context(messages[1]))),
+            run_update(lambda: index.handle_free_key(messages[2], self.context(messages[2])))
+        )
+        self.assertEqual([len(queries) for queries in counts], [0, 2, 6])
+        self.assertEqual(self.fake_db.stats['queries'], 8)
+
+class BuyVipPaymentStatusTest(unittest.IsolatedAsyncioTestCase):
+    '''Повторное нажатие "Купить VIP" читает статус платежа из БД и не выдает второй ключ'''
+    
+    async def press(self, payment: Dict) -> Tuple[mock.MagicMock, FakeDatabase]:
+        self.jobs: List[tuple] = []
+        fake_db = FakeDatabase([
+            ('FROM t_p5255237_telegram_bot_service.payments p', payment),
+            ('INSERT INTO t_p5255237_telegram_bot_service.jobs', lambda *args: self.jobs.append(args))
+        ])
+        message = make_message()
+        ctx = index.BotContext(1, {'id': 1, 'admin_telegram_ids': []}, message.from_user)
+        with mock.patch.object(index, 'db', fake_db), \
+                mock.patch.object(index, 'telegram_file_cache', index.TelegramFileCache()), \
+                mock.patch.object(index, 'generate_qr_image', lambda *args: b'png'):
+            await index.handle_buy_vip(message, ctx, mock.AsyncMock(), mock.MagicMock())
+        return message, fake_db
+    
+    async def test_confirmed_payment_resends_pinned_key(self):
+        message, fake_db = await self.press({'order_id': 'o1', 'status': 'CONFIRMED', 'payment_url': None, 'vip_code_number': 501})
+        self.assertEqual(message.answer_photo.await_count, 1)
+        self.assertFalse(any('qr_codes' in query and 'SET is_used' in query for query in fake_db.queries))
+        self.assertEqual(self.jobs, [])
+    
+    async def test_confirmed_payment_without_key_enqueues_delivery(self):
+        message, fake_db = await self.press({'order_id': 'o1', 'status': 'CONFIRMED', 'payment_url': None, 'vip_code_number': None})
+        self.assertEqual([(job[0], job[-1]) for job in self.jobs], [('deliver_vip_key', 'deliver_vip_key:o1')])
+        self.assertEqual(message.answer_photo.await_count, 0)
+        self.assertEqual(message.answer.await_count, 1)
+    
+    async def test_pending_payment_is_not_polled(self):
+        message, fake_db = await self.press({'order_id': 'o1', 'status': 'NEW', 'payment_url': 'https://pay', 'vip_code_number': None})
+        self.assertEqual(len(fake_db.queries), 1)
+        self.assertIn('обрабатывается', message.answer.await_args.args[0])
+
+def copied_block(function: str, names: Tuple[str, ...]) -> Dict[str, str]:
+    '''AST верхнеуровневых определений с заданными именами из index.py функции'''
+    with open(os.path.join(BACKEND_DIR, function, 'index.py'), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    block = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            node_names = [node.name]
+        else:
+            node_names = [target.id for target in getattr(node, 'targets', []) if isinstance(target, ast.Name)]
+        for name in node_names:
+            if name in names:
+                block[name] = ast.dump(node)
+    return block
+
+class QrRenderCopiesTest(unittest.TestCase):
+    '''Копии отрисовки и кэша QR в engine и webhook должны совпадать с job-worker, который рисует заранее'''
+    NAMES = ('QR_RENDER_VERSION', 'render_qr_png', 'LruCache', 'QrImageCache', 'qr_image_cache',
+             'generate_qr_image', 'qr_asset_key')
+    
+    def test_copies_match_job_worker(self):
+        expected = copied_block('job-worker', self.NAMES)
+        self.assertEqual(sorted(expected), sorted(self.NAMES))
+        for function in ('telegram-bot-engine', 'telegram-webhook'):
+            with self.subTest(function=function):
+                self.assertEqual(copied_block(function, self.NAMES), expected)
+
+class ConnectionPoolCopiesTest(unittest.TestCase):
+    '''Копии пула соединений psycopg2 во всех функциях должны совпадать с generate-qr-codes'''
+    NAMES = ('PooledConnection', 'ConnectionPool', 'db_pool', 'get_db_connection')
+    FUNCTIONS = ('telegram-webhook', 'broadcasts', 'job-worker', 'payment-reconciler', 'tbank-notification',
+                 'check-payment-status', 'rotate-qr-codes', 'sync-bot-stats', 'warehouse-reminder')
+    
+    def test_copies_match_generate_qr_codes(self):
+        expected = copied_block('generate-qr-codes', self.NAMES)
+        self.assertEqual(sorted(expected), sorted(self.NAMES))
+        for function in self.FUNCTIONS:
+            with self.subTest(function=function):
+                self.assertEqual(copied_block(function, self.NAMES), expected)
+
+class TelegramRuntimeCopiesTest(unittest.TestCase):
+    '''warehouse-reminder шлет через aiogram так же, как engine: лимитер, сессии и цикл событий - дословные копии'''
+    NAMES = ('TokenBucket', 'TelegramRateLimiter', 'telegram_rate_limiter', 'EventLoopRunner', 'loop_runner',
+             'TelegramSessionManager')
+    
+    def test_warehouse_reminder_matches_engine(self):
+        expected = copied_block('telegram-bot-engine', self.NAMES)
+        self.assertEqual(sorted(expected), sorted(self.NAMES))
+        self.assertEqual(copied_block('warehouse-reminder', self.NAMES), expected)
+    
+    def test_token_bucket_matches_engine(self):
+        # Лимитеры broadcasts и webhook намеренно отличаются (см. комментарии над ними), корзина у всех общая
+        expected = copied_block('telegram-bot-engine', ('TokenBucket',))
+        for function in ('broadcasts', 'telegram-webhook'):
+            with self.subTest(function=function):
+                self.assertEqual(copied_block(function, ('TokenBucket',)), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+'''
+Замер времени статистики администратора (handle_stats) на больших данных.
+
+Создает в БД отдельного тестового бота и наполняет его пользователями, ключами и платежами в объеме
+крупного бота, затем несколько раз выполняет запросы статистики: прежний вариант (десять отдельных
+COUNT/SUM подряд и LEFT JOIN по четырем таблицам) и текущий (fetch_stats_counters и первая страница
+fetch_stats_users).
+Проверяется, что счетчики совпадают, а медиана текущего варианта укладывается в --max-ms.
+Тестовые данные удаляются после замера (--keep оставляет их для ручного EXPLAIN).
+
+Запуск: DATABASE_URL=... python bench_stats.py --users 200000 --keys 300000 --payments 100000 --max-ms 500
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+import index
+
+SCHEMA = 't_p5255237_telegram_bot_service'
+FIXTURE_TELEGRAM_ID = 9_000_000_000
+
+LEGACY_COUNTERS = [
+    ('free_total', "SELECT COUNT(*) as v FROM {s}.qr_codes WHERE bot_id = {b} AND code_type = 'free'"),
+    ('free_used', "SELECT COUNT(*) as v FROM {s}.qr_codes WHERE bot_id = {b} AND code_type = 'free' AND is_used = true"),
+    ('vip_total', "SELECT COUNT(*) as v FROM {s}.qr_codes WHERE bot_id = {b} AND code_type = 'vip'"),
+    ('vip_used', "SELECT COUNT(*) as v FROM {s}.qr_codes WHERE bot_id = {b} AND code_type = 'vip' AND is_used = true"),
+    ('users_total', "SELECT COUNT(*) as v FROM {s}.bot_users WHERE bot_id = {b}"),
+    ('users_with_free', "SELECT COUNT(*) as v FROM {s}.bot_users WHERE bot_id = {b} AND received_free_qr = true"),
+    ('users_with_vip', "SELECT COUNT(*) as v FROM {s}.bot_users WHERE bot_id = {b} AND received_vip_qr = true"),
+    ('payments_total', "SELECT COUNT(*) as v FROM {s}.payments WHERE bot_id = {b}"),
+    ('payments_confirmed', "SELECT COUNT(*) as v FROM {s}.payments WHERE bot_id = {b} AND status = 'CONFIRMED'"),
+    ('payments_today', "SELECT COUNT(*) as v FROM {s}.payments WHERE bot_id = {b} AND created_at >= CURRENT_DATE")
+]
+
+LEGACY_USERS = '''SELECT bu.first_name, bu.last_name, bu.username, bu.received_free_qr, bu.received_vip_qr,
+        p.customer_phone, free_qr.code_number as free_qr_number, vip_qr.code_number as vip_qr_number
+    FROM {s}.bot_users bu
+    LEFT JOIN {s}.payments p ON bu.telegram_user_id = p.telegram_user_id AND bu.bot_id = p.bot_id AND p.status = 'CONFIRMED'
+    LEFT JOIN {s}.qr_codes free_qr ON free_qr.used_by_user_id = bu.id AND free_qr.code_type = 'free'
+    LEFT JOIN {s}.qr_codes vip_qr ON vip_qr.used_by_user_id = bu.id AND vip_qr.code_type = 'vip'
+    WHERE bu.bot_id = {b} AND (bu.received_free_qr = true OR bu.received_vip_qr = true)
+    ORDER BY bu.id'''
+
+def seed(cursor, users: int, keys: int, payments: int) -> int:
+    cursor.execute(f'''INSERT INTO {SCHEMA}.users (telegram_id, username) VALUES ({FIXTURE_TELEGRAM_ID}, 'stats-bench')
+                       ON CONFLICT (telegram_id) DO UPDATE SET username = EXCLUDED.username RETURNING id''')
+    owner_id = cursor.fetchone()['id']
+    cursor.execute(f'''INSERT INTO {SCHEMA}.bots (user_id, name, telegram_token)
+                       VALUES ({owner_id}, 'stats-bench', 'stats-bench:{time.time_ns()}') RETURNING id''')
+    bot_id = cursor.fetchone()['id']
+    
+    # Каждый третий получил бесплатный ключ, каждый двадцатый - VIP
+    cursor.execute(f'''INSERT INTO {SCHEMA}.bot_users (bot_id, telegram_user_id, first_name, received_free_qr, received_vip_qr)
+                       SELECT {bot_id}, g, 'User ' || g, g % 3 = 0, g % 20 = 0 FROM generate_series(1, {users}) g''')
+    vip_keys = max(1, keys // 10)
+    for code_type, flag, offset, count in (('free', 'received_free_qr', 0, keys - vip_keys), ('vip', 'received_vip_qr', keys, vip_keys)):
+        cursor.execute(f'''WITH recipients AS (
+                               SELECT id, row_number() OVER (ORDER BY id) as rn FROM {SCHEMA}.bot_users
+                               WHERE bot_id = {bot_id} AND {flag} = true
+                           )
+                           INSERT INTO {SCHEMA}.qr_codes (bot_id, code_number, code_type, is_used, used_by_user_id, used_at)
+                           SELECT {bot_id}, {offset} + g, '{code_type}', r.id IS NOT NULL, r.id,
+                                  CASE WHEN r.id IS NOT NULL THEN CURRENT_TIMESTAMP END
+                           FROM generate_series(1, {count}) g LEFT JOIN recipients r ON r.rn = g''')
+    cursor.execute(f'''INSERT INTO {SCHEMA}.payments (bot_id, user_id, telegram_user_id, order_id, amount, status, customer_phone, created_at)
+                       SELECT {bot_id}, bu.id, bu.telegram_user_id, 'stats-bench-{bot_id}-' || g, 500,
+                              CASE WHEN g % 4 = 0 THEN 'CONFIRMED' ELSE 'NEW' END, '+7900' || g,
+                              CURRENT_TIMESTAMP - (g % 30) * INTERVAL '1 day'
+                       FROM generate_series(1, {payments}) g
+                       JOIN {SCHEMA}.bot_users bu ON bu.bot_id = {bot_id} AND bu.telegram_user_id = g % {users} + 1''')
+    for table in ('bot_users', 'qr_codes', 'payments'):
+        cursor.execute(f'ANALYZE {SCHEMA}.{table}')
+    return bot_id
+
+def cleanup(cursor, bot_id: int) -> None:
+    for table in ('payments', 'qr_codes', 'bot_users'):
+        cursor.execute(f'DELETE FROM {SCHEMA}.{table} WHERE bot_id = {bot_id}')
+    cursor.execute(f'DELETE FROM {SCHEMA}.bots WHERE id = {bot_id}')
+
+def timed(fn, runs: int):
+    timings = []
+    result = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), result
+
+def legacy_stats(cursor, bot_id: int):
+    counters = {}
+    for name, query in LEGACY_COUNTERS:
+        cursor.execute(query.format(s=SCHEMA, b=bot_id))
+        counters[name] = cursor.fetchone()['v']
+    cursor.execute(LEGACY_USERS.format(s=SCHEMA, b=bot_id))
+    return counters, cursor.fetchall()
+
+def current_stats(cursor, bot_id: int):
+    return index.fetch_stats_counters(cursor, bot_id), index.fetch_stats_users(cursor, bot_id)[0]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='handle_stats timing on large fixture data')
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--keys', type=int, default=300000)
+    parser.add_argument('--payments', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=500)
+    parser.add_argument('--keep', action='store_true', help='не удалять тестового бота после замера')
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    started = time.perf_counter()
+    bot_id = seed(cursor, args.users, args.keys, args.payments)
+    print(f"seeded bot {bot_id}: {args.users} users, {args.keys} keys, {args.payments} payments "
+          f"in {time.perf_counter() - started:.1f}s")
+    
+    try:
+        legacy_ms, (legacy_counters, legacy_users) = timed(lambda: legacy_stats(cursor, bot_id), args.runs)
+        current_ms, (counters, users) = timed(lambda: current_stats(cursor, bot_id), args.runs)
+    finally:
+        if not args.keep:
+            cleanup(cursor, bot_id)
+        conn.close()
+    
+    ok = True
+    for name, value in legacy_counters.items():
+        if counters[name] != value:
+            print(f"counter {name} mismatch: legacy {value}, current {counters[name]}")
+            ok = False
+    print(f"legacy:  {legacy_ms:.1f} ms, {len(legacy_users)} user rows")
+    print(f"current: {current_ms:.1f} ms, {len(users)} user rows (budget {args.max_ms} ms)")
+    if current_ms > args.max_ms:
+        ok = False
+    print('OK' if ok else 'FAIL')
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,231 @@
 import json
 import os
-from typing import Dict, Any, Optional
+import time
+import hashlib
+import threading
+import contextlib
+import html
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Tuple, Callable, Union
 import psycopg2
+import psycopg2.errors
 from psycopg2.extras import RealDictCursor
-import qrcode
 from io import BytesIO
-import base64
-import requests
-from PIL import Image, ImageDraw, ImageFont
 
-def get_db_connection():
-    '''Создает подключение к базе данных'''
-    database_url = os.environ.get('DATABASE_URL', '')
-    if not database_url:
-        raise ValueError('DATABASE_URL not configured')
-    return psycopg2.connect(database_url)
+if TYPE_CHECKING:
+    import requests
+
+class PooledConnection:
+    '''Соединение, выданное пулом: close() возвращает его в пул вместо закрытия'''
+    
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            self._pool.putconn(self)
+            self._conn = None
+
+class ConnectionPool:
+    '''Пул соединений с PostgreSQL, который переживает тёплые вызовы функции'''
+    
+    def __init__(self, max_size: int = 5, health_check_after: float = 30.0):
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._in_use: Dict[int, PooledConnection] = {}
+        self._lock = threading.Lock()
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0, 'health_checks': 0}
+    
+    def _connect(self):
+        database_url = os.environ.get('DATABASE_URL', '')
+        if not database_url:
+            raise ValueError('DATABASE_URL not configured')
+        self.stats['connects'] += 1
+        return psycopg2.connect(database_url)
+    
+    def _discard(self, conn) -> None:
+        self.stats['discards'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        self.stats['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self) -> PooledConnection:
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if self._is_healthy(conn, released_at):
+                    self.stats['reuses'] += 1
+                    pooled = PooledConnection(self, conn)
+                    self._in_use[id(conn)] = pooled
+                    return pooled
+                self._discard(conn)
+            
+            if len(self._in_use) >= self.max_size:
+                raise Exception(f'Connection pool exhausted (max_size={self.max_size})')
+            
+            conn = self._connect()
+            pooled = PooledConnection(self, conn)
+            self._in_use[id(conn)] = pooled
+            return pooled
+    
+    def putconn(self, pooled: PooledConnection) -> None:
+        conn = pooled._conn
+        with self._lock:
+            if self._in_use.get(id(conn)) is not pooled:
+                return
+            del self._in_use[id(conn)]
+            try:
+                # Завершаем незакрытую транзакцию, чтобы следующий запрос начал с чистого состояния
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            if conn.closed or len(self._idle) >= self.max_size:
+                self._discard(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+    
+    def release_all(self) -> None:
+        '''Вернуть в пул соединения, которые не были закрыты в ходе запроса'''
+        for pooled in list(self._in_use.values()):
+            pooled.close()
+
+db_pool = ConnectionPool(max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')))
+
+def get_db_connection() -> PooledConnection:
+    '''Выдает подключение к базе данных из пула'''
+    return db_pool.getconn()
+
+class UpdateDeduplicator:
+    '''Защита от повторной доставки webhook: LRU в памяти перед таблицей processed_updates'''
+    
+    def __init__(self, max_size: int = 10000, ttl_hours: int = 24, cleanup_interval: float = 600.0):
+        self.max_size = max_size
+        self.ttl_hours = ttl_hours
+        self.cleanup_interval = cleanup_interval
+        self._seen: OrderedDict = OrderedDict()
+        self._last_cleanup = 0.0
+        self.stats = {'claimed': 0, 'memory_duplicates': 0, 'db_duplicates': 0, 'released': 0}
+    
+    def _remember(self, key: Tuple[int, int]) -> None:
+        self._seen[key] = True
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+    
+    def claim(self, bot_id: int, update_id: int) -> bool:
+        '''True - Update новый и его нужно обработать; False - повтор, отвечаем сразу'''
+        key = (bot_id, update_id)
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            self.stats['memory_duplicates'] += 1
+            return False
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if time.monotonic() - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = time.monotonic()
+            cursor.execute(f'''DELETE FROM t_p5255237_telegram_bot_service.processed_updates 
+                              WHERE processed_at < CURRENT_TIMESTAMP - INTERVAL '{int(self.ttl_hours)} hours' ''')
+        cursor.execute(f'''INSERT INTO t_p5255237_telegram_bot_service.processed_updates (bot_id, update_id)
+                          VALUES ({int(bot_id)}, {int(update_id)}) ON CONFLICT DO NOTHING RETURNING TRUE''')
+        inserted = cursor.fetchone() is not None
+        conn.commit()
+        cursor.close()
+        conn.close()
+        self._remember(key)
+        if not inserted:
+            self.stats['db_duplicates'] += 1
+            return False
+        self.stats['claimed'] += 1
+        return True
+    
+    def release(self, bot_id: int, update_id: int) -> None:
+        '''Обработка упала: снять отметку, чтобы повторная доставка Telegram обработала Update заново'''
+        self._seen.pop((bot_id, update_id), None)
+        self.stats['released'] += 1
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''DELETE FROM t_p5255237_telegram_bot_service.processed_updates 
+                          WHERE bot_id = {int(bot_id)} AND update_id = {int(update_id)}''')
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+update_dedup = UpdateDeduplicator(
+    max_size=int(os.environ.get('UPDATE_DEDUP_CACHE_SIZE', '10000')),
+    ttl_hours=int(os.environ.get('UPDATE_DEDUP_TTL_HOURS', '24'))
+)
+
+# Update одного чата обрабатываются по очереди (иначе шаги формы оплаты перезаписывают состояние друг друга)
+CHAT_ADVISORY_LOCKS = os.environ.get('CHAT_ADVISORY_LOCKS', 'true').lower() == 'true'
+CHAT_LOCK_TIMEOUT_MS = int(os.environ.get('CHAT_LOCK_TIMEOUT_MS', '10000'))
+
+def advisory_lock_key(chat_id: int) -> int:
+    '''chat_id в диапазоне int4 для pg_advisory_lock(int, int); совпадение ключей лишь упорядочит два чата'''
+    return (chat_id + 2 ** 31) % 2 ** 32 - 2 ** 31
+
+def get_update_chat_id(update: Dict[str, Any]) -> Optional[int]:
+    '''Чат, к которому относится Update (для callback_query - чат сообщения с кнопкой)'''
+    for event_type in ('message', 'edited_message', 'callback_query'):
+        event = update.get(event_type)
+        if not event:
+            continue
+        chat = (event.get('message') or {}).get('chat') if event_type == 'callback_query' else event.get('chat')
+        return (chat or {}).get('id') or (event.get('from') or {}).get('id')
+    return None
+
+@contextlib.contextmanager
+def chat_lock(bot_id: int, chat_id: Optional[int]):
+    '''Advisory lock Postgres на чат на время обработки Update; другие чаты не ждут'''
+    if not CHAT_ADVISORY_LOCKS or chat_id is None:
+        yield
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    locked = False
+    try:
+        cursor.execute(f'''SELECT set_config('lock_timeout', '{CHAT_LOCK_TIMEOUT_MS}ms', true),
+                                 pg_advisory_lock({int(bot_id)}, {advisory_lock_key(chat_id)})''')
+        # Блокировка сессионная и переживает commit; commit лишь закрывает транзакцию с lock_timeout
+        conn.commit()
+        locked = True
+    except psycopg2.errors.LockNotAvailable:
+        conn.rollback()
+        print(f"[WARN Bot {bot_id}] Chat {chat_id} lock wait exceeded {CHAT_LOCK_TIMEOUT_MS} ms, processing without it")
+    try:
+        yield
+    finally:
+        try:
+            if locked:
+                cursor.execute(f"SELECT pg_advisory_unlock({int(bot_id)}, {advisory_lock_key(chat_id)})")
+                conn.commit()
+            cursor.close()
+            conn.close()
+        except Exception:
+            # Соединение с неснятой блокировкой в пул не возвращаем: закрытие сессии снимет ее
+            conn._conn.close()
+            conn.close()
 
 def get_owner_telegram_id(bot_id: int) -> Optional[int]:
     '''Получить Telegram ID владельца бота'''
@@ -46,21 +257,104 @@ def is_user_admin(bot_id: int, telegram_user_id: int) -> bool:
     
     return result and result.get('is_admin', False)
 
-def get_bot_by_token(token: str) -> Optional[Dict]:
-    '''Получить бота по токену'''
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+class BotConfigCache:
+    '''Кэш настроек ботов в памяти процесса с инвалидацией по config_version'''
+    
+    def __init__(self, ttl: float = 300.0, version_check_interval: float = 5.0):
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self._by_id: Dict[int, Dict[str, Any]] = {}
+        self._id_by_token_hash: Dict[str, int] = {}
+        self.stats = {'hits': 0, 'version_checks': 0, 'loads': 0}
+    
+    @staticmethod
+    def token_hash(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+    
+    def _store(self, bot: Optional[Dict]) -> Optional[Dict]:
+        if not bot:
+            return None
+        bot = dict(bot)
+        now = time.monotonic()
+        self._by_id[bot['id']] = {'bot': bot, 'loaded_at': now, 'checked_at': now}
+        self._id_by_token_hash[self.token_hash(bot['telegram_token'])] = bot['id']
+        return bot
+    
+    def _load_by_id(self, bot_id: int) -> Optional[Dict]:
+        self.stats['loads'] += 1
+        conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        query = f'SELECT * FROM t_p5255237_telegram_bot_service.bots WHERE id = {int(bot_id)}'
+        cursor.execute(query)
+        bot = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        if not bot:
+            self._by_id.pop(bot_id, None)
+        return self._store(bot)
     
-    token_escaped = token.replace("'", "''")
-    query = f'''SELECT * FROM t_p5255237_telegram_bot_service.bots 
-               WHERE telegram_token = '{token_escaped}' 
-               AND status = 'active' 
-               AND moderation_status = 'approved' '''
-    cursor.execute(query)
-    bot = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return dict(bot) if bot else None
+    def _load_by_token(self, token: str) -> Optional[Dict]:
+        self.stats['loads'] += 1
+        conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        token_escaped = token.replace("'", "''")
+        query = f'''SELECT * FROM t_p5255237_telegram_bot_service.bots 
+                   WHERE telegram_token = '{token_escaped}' 
+                   ORDER BY (status = 'active' AND moderation_status = 'approved') DESC, id
+                   LIMIT 1'''
+        cursor.execute(query)
+        bot = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        return self._store(bot)
+    
+    def _fetch_version(self, bot_id: int) -> Optional[int]:
+        self.stats['version_checks'] += 1
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        query = f'SELECT config_version FROM t_p5255237_telegram_bot_service.bots WHERE id = {int(bot_id)}'
+        cursor.execute(query)
+        row = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        return row[0] if row else None
+    
+    def get(self, bot_id: int) -> Optional[Dict]:
+        '''Настройки бота по id; в Postgres идем только если версия изменилась или истек TTL'''
+        entry = self._by_id.get(bot_id)
+        now = time.monotonic()
+        if entry and now - entry['loaded_at'] < self.ttl:
+            if now - entry['checked_at'] < self.version_check_interval:
+                self.stats['hits'] += 1
+                return entry['bot']
+            version = self._fetch_version(bot_id)
+            entry['checked_at'] = now
+            if version is not None and version == entry['bot'].get('config_version'):
+                self.stats['hits'] += 1
+                return entry['bot']
+        return self._load_by_id(bot_id)
+    
+    def get_by_token(self, token: str) -> Optional[Dict]:
+        '''Настройки бота по токену (ключ кэша - хэш токена)'''
+        bot_id = self._id_by_token_hash.get(self.token_hash(token))
+        if bot_id is not None:
+            bot = self.get(bot_id)
+            if bot and bot['telegram_token'] == token:
+                return bot
+            self._id_by_token_hash.pop(self.token_hash(token), None)
+        return self._load_by_token(token)
+
+bot_config_cache = BotConfigCache(
+    ttl=float(os.environ.get('BOT_CONFIG_CACHE_TTL', '300')),
+    version_check_interval=float(os.environ.get('BOT_CONFIG_VERSION_CHECK_INTERVAL', '5'))
+)
+
+def get_bot_by_token(token: str) -> Optional[Dict]:
+    '''Получить активного бота по токену (из кэша; возвращаемый словарь нельзя изменять)'''
+    bot = bot_config_cache.get_by_token(token)
+    if not bot or bot.get('status') != 'active' or bot.get('moderation_status') != 'approved':
+        return None
+    return bot
 
 def register_telegram_user(bot_id: int, user_data: Dict, owner_telegram_id: int = None) -> int:
     '''Регистрирует пользователя Telegram в базе данных и проверяет администратора'''
@@ -76,7 +370,7 @@ def register_telegram_user(bot_id: int, user_data: Dict, owner_telegram_id: int
     first_name_escaped = first_name.replace("'", "''")
     last_name_escaped = last_name.replace("'", "''")
     
-    check_query = f'''SELECT id, is_admin FROM t_p5255237_telegram_bot_service.bot_users 
+    check_query = f'''SELECT id, is_admin, is_blocked FROM t_p5255237_telegram_bot_service.bot_users 
                      WHERE bot_id = {bot_id} AND telegram_user_id = {user_id}'''
     cursor.execute(check_query)
     existing = cursor.fetchone()
@@ -90,6 +384,11 @@ def register_telegram_user(bot_id: int, user_data: Dict, owner_telegram_id: int
                               SET is_admin = true WHERE id = {db_user_id}'''
             cursor.execute(update_query)
             conn.commit()
+        if existing.get('is_blocked'):
+            # Пользователь снова пишет боту - значит разблокировал, возвращаем его в рассылки
+            cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.bot_users 
+                              SET is_blocked = FALSE, blocked_at = NULL WHERE id = {db_user_id}''')
+            conn.commit()
     else:
         insert_query = f'''INSERT INTO t_p5255237_telegram_bot_service.bot_users 
                           (bot_id, telegram_user_id, username, first_name, last_name, is_admin)
@@ -147,6 +446,28 @@ def clear_user_state(bot_id: int, telegram_user_id: int):
     cursor.close()
     conn.close()
 
+def allocate_qr_code(cursor, bot_id: int, code_type: str, user_id: int) -> Optional[Dict]:
+    '''Атомарно пометить использованным первый свободный QR-ключ (в транзакции вызывающего).
+    Если свободны только ключи из блоков, арендованных движком, берется один из них: выдача из блока
+    проверяет lease_owner и is_used и просто пропустит такой ключ'''
+    code_type_escaped = code_type.replace("'", "''")
+    for lease_condition in ('AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP)', ''):
+        cursor.execute(f'''UPDATE t_p5255237_telegram_bot_service.qr_codes 
+                          SET is_used = true, used_by_user_id = {user_id}, used_at = CURRENT_TIMESTAMP,
+                              lease_owner = NULL, lease_expires_at = NULL
+                          WHERE id = (
+                              SELECT id FROM t_p5255237_telegram_bot_service.qr_codes 
+                              WHERE bot_id = {bot_id} AND code_type = '{code_type_escaped}' AND is_used = false 
+                              {lease_condition}
+                              ORDER BY code_number LIMIT 1
+                              FOR UPDATE SKIP LOCKED
+                          )
+                          RETURNING *''')
+        qr_code = cursor.fetchone()
+        if qr_code:
+            return dict(qr_code)
+    return None
+
 def get_free_qr_key(bot_id: int, user_id: int, telegram_user_id: int) -> Optional[Dict]:
     '''Получить свободный бесплатный QR-ключ с проверкой ограничений'''
     conn = get_db_connection()
@@ -167,18 +488,9 @@ def get_free_qr_key(bot_id: int, user_id: int, telegram_user_id: int) -> Optiona
         conn.close()
         return {'already_received': True}
     
-    query = f'''SELECT * FROM t_p5255237_telegram_bot_service.qr_codes 
-               WHERE bot_id = {bot_id} AND code_type = 'free' AND is_used = false 
-               ORDER BY code_number LIMIT 1'''
-    cursor.execute(query)
-    qr_code = cursor.fetchone()
+    qr_code = allocate_qr_code(cursor, bot_id, 'free', user_id)
     
     if qr_code:
-        update_query = f'''UPDATE t_p5255237_telegram_bot_service.qr_codes 
-                          SET is_used = true, used_by_user_id = {user_id}, used_at = CURRENT_TIMESTAMP 
-                          WHERE id = {qr_code['id']}'''
-        cursor.execute(update_query)
-        
         if not user_info['is_admin']:
             mark_user_query = f'''UPDATE t_p5255237_telegram_bot_service.bot_users 
                                  SET received_free_qr = true, free_qr_received_at = CURRENT_TIMESTAMP 
@@ -189,20 +501,25 @@ def get_free_qr_key(bot_id: int, user_id: int, telegram_user_id: int) -> Optiona
     
     cursor.close()
     conn.close()
-    return dict(qr_code) if qr_code else None
+    return qr_code
+
+# Копия блока отрисовки и кэша QR из job-worker/index.py (функции деплоятся по отдельности): ключи кэша
+# и PNG должны совпадать с job-worker, иначе заранее отрисованные файлы не находятся (сверяет test_engine.py)
+QR_RENDER_VERSION = 1
 
-def generate_qr_base64(code_number: int, is_vip: bool = False) -> str:
-    '''Генерирует QR-код как base64 строку (с VIP обложкой если нужно)'''
+def render_qr_png(payload: str, variant: str) -> bytes:
+    '''Отрисовывает QR-код как PNG: free - только код, vip - код на VIP обложке'''
+    import qrcode
+    from PIL import Image, ImageDraw
     qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(f'POLYTOPE_KEY_{code_number}')
+    qr.add_data(payload)
     qr.make(fit=True)
     qr_img = qr.make_image(fill_color="black", back_color="white")
     
-    if not is_vip:
+    if variant != 'vip':
         bio = BytesIO()
         qr_img.save(bio, 'PNG')
-        bio.seek(0)
-        return base64.b64encode(bio.read()).decode()
+        return bio.getvalue()
     
     qr_size = qr_img.size[0]
     cover_width = qr_size
@@ -226,12 +543,417 @@ def generate_qr_base64(code_number: int, is_vip: bool = False) -> str:
     
     bio = BytesIO()
     cover.save(bio, 'PNG')
-    bio.seek(0)
-    return base64.b64encode(bio.read()).decode()
+    return bio.getvalue()
+
+class LruCache:
+    '''Словарь не больше max_items элементов: при переполнении вытесняется давно не использованный'''
+    
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: OrderedDict = OrderedDict()
+    
+    def get(self, key: Any) -> Any:
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+    
+    def put(self, key: Any, value: Any) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+    
+    def pop(self, key: Any) -> None:
+        self._items.pop(key, None)
+
+class QrImageCache:
+    '''Готовые PNG QR-кодов ключей по (code_number, variant): LRU в памяти процесса и content-addressed каталог на диске'''
+    
+    def __init__(self, directory: str, max_items: int = 256):
+        self.directory = directory
+        self._memory = LruCache(max_items)
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'renders': 0, 'disk_errors': 0}
+    
+    @staticmethod
+    def payload(code_number: int) -> str:
+        return f'POLYTOPE_KEY_{code_number}'
+    
+    @staticmethod
+    def key(code_number: int, variant: str) -> str:
+        payload = QrImageCache.payload(code_number)
+        return hashlib.sha256(f'{QR_RENDER_VERSION}:{variant}:{payload}'.encode('utf-8')).hexdigest()
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f'{key}.png')
+    
+    def _read(self, key: str) -> Optional[bytes]:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError:
+            self.stats['disk_errors'] += 1
+            return None
+    
+    def _write(self, key: str, image: bytes) -> None:
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(image)
+            os.replace(tmp_path, path)
+        except OSError:
+            self.stats['disk_errors'] += 1
+    
+    def _render(self, code_number: int, variant: str, key: str) -> bytes:
+        image = render_qr_png(self.payload(code_number), variant)
+        self.stats['renders'] += 1
+        self._write(key, image)
+        return image
+    
+    def get(self, code_number: int, variant: str) -> bytes:
+        key = self.key(code_number, variant)
+        with self._lock:
+            image = self._memory.get(key)
+        if image is not None:
+            self.stats['memory_hits'] += 1
+            return image
+        
+        image = self._read(key)
+        if image is not None:
+            self.stats['disk_hits'] += 1
+        else:
+            image = self._render(code_number, variant, key)
+        with self._lock:
+            self._memory.put(key, image)
+        return image
+    
+    def prerender(self, code_number: int, variant: str) -> bool:
+        '''Отрисовать в дисковый кэш, не вытесняя LRU; False - файл уже был'''
+        key = self.key(code_number, variant)
+        if self.directory and os.path.exists(self._path(key)):
+            return False
+        self._render(code_number, variant, key)
+        return True
+
+qr_image_cache = QrImageCache(
+    directory=os.environ.get('QR_CACHE_DIR', '/tmp/qr-cache'),
+    max_items=int(os.environ.get('QR_CACHE_MAX_ITEMS', '256'))
+)
+
+def generate_qr_image(code_number: int, variant: str = 'free') -> bytes:
+    '''PNG QR-кода ключа (free или vip) из кэша; отрисовывается при первом обращении'''
+    return qr_image_cache.get(code_number, variant)
+
+def qr_asset_key(code_number: int, variant: str) -> str:
+    '''Ключ картинки QR-кода для кэша file_id (совпадает с ключом дискового кэша отрисовки)'''
+    return f"qr:{QrImageCache.key(code_number, variant)}"
+
+
+class TelegramFileCache:
+    '''file_id уже загруженных в Telegram картинок по (bot_id, asset_key): LRU в памяти и таблица telegram_file_ids'''
+    
+    def __init__(self, max_items: int = 2048):
+        self._memory = LruCache(max_items)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'db_hits': 0, 'uploads': 0, 'invalidated': 0}
+    
+    def _remember(self, key: Tuple[int, str], file_id: str) -> None:
+        with self._lock:
+            self._memory.put(key, file_id)
+    
+    def _execute(self, query: str, fetch: bool = False) -> Optional[Dict]:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute(query)
+            row = cursor.fetchone() if fetch else None
+            conn.commit()
+            cursor.close()
+            return row
+        finally:
+            conn.close()
+    
+    def get(self, bot_id: int, asset_key: str) -> Optional[str]:
+        with self._lock:
+            file_id = self._memory.get((bot_id, asset_key))
+        if file_id is not None:
+            self.stats['hits'] += 1
+            return file_id
+        asset_key_escaped = asset_key.replace("'", "''")
+        row = self._execute(f'''SELECT file_id FROM t_p5255237_telegram_bot_service.telegram_file_ids 
+                               WHERE bot_id = {int(bot_id)} AND asset_key = '{asset_key_escaped}' ''', fetch=True)
+        if not row:
+            return None
+        self.stats['db_hits'] += 1
+        self._remember((bot_id, asset_key), row['file_id'])
+        return row['file_id']
+    
+    def put(self, bot_id: int, asset_key: str, file_id: str) -> None:
+        self._remember((bot_id, asset_key), file_id)
+        asset_key_escaped = asset_key.replace("'", "''")
+        file_id_escaped = file_id.replace("'", "''")
+        self._execute(f'''INSERT INTO t_p5255237_telegram_bot_service.telegram_file_ids (bot_id, asset_key, file_id)
+                         VALUES ({int(bot_id)}, '{asset_key_escaped}', '{file_id_escaped}')
+                         ON CONFLICT (bot_id, asset_key) DO UPDATE 
+                         SET file_id = EXCLUDED.file_id, updated_at = CURRENT_TIMESTAMP''')
+    
+    def forget(self, bot_id: int, asset_key: str) -> None:
+        self.stats['invalidated'] += 1
+        with self._lock:
+            self._memory.pop((bot_id, asset_key))
+        asset_key_escaped = asset_key.replace("'", "''")
+        self._execute(f'''DELETE FROM t_p5255237_telegram_bot_service.telegram_file_ids 
+                         WHERE bot_id = {int(bot_id)} AND asset_key = '{asset_key_escaped}' ''')
+    
+    def send_photo(self, bot_id: int, asset_key: str, send: Callable[[Any], Dict], photo: Callable[[], Any]) -> Dict:
+        '''Отправить картинку по сохраненному file_id; при первой отправке загрузить photo() и запомнить file_id'''
+        file_id = self.get(bot_id, asset_key)
+        if file_id is not None:
+            result = send(file_id)
+            # file_id мог стать недействительным - тогда загружаем файл заново
+            if result.get('ok') or 'file' not in str(result.get('description', '')).lower():
+                return result
+            self.forget(bot_id, asset_key)
+        
+        result = send(photo())
+        self.stats['uploads'] += 1
+        sizes = (result.get('result') or {}).get('photo') if result.get('ok') else None
+        if sizes:
+            # Фото уже доставлено: ошибка записи кэша не должна превращать Update в повторную доставку
+            try:
+                self.put(bot_id, asset_key, sizes[-1]['file_id'])
+            except Exception as e:
+                print(f"[WARN] file_id for bot {bot_id} not saved: {e}")
+        return result
+
+telegram_file_cache = TelegramFileCache(max_items=int(os.environ.get('TELEGRAM_FILE_CACHE_MAX_ITEMS', '2048')))
+
+class TokenBucket:
+    '''Корзина токенов; токены можно занимать в долг - долг и есть очередь ожидающих отправок'''
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self) -> float:
+        '''Занять токен и вернуть, сколько секунд ждать его появления (FIFO без блокировок)'''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def is_idle(self) -> bool:
+        '''Корзина снова полная - ее можно выбросить без потери ограничения'''
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class TelegramHttpClient:
+    '''Общая keep-alive сессия к Bot API: пул соединений, таймауты, ограниченные повторы и задержки по методам'''
+    
+    RETRY_STATUSES = (500, 502, 503, 504)
+    
+    def __init__(self, connect_timeout: float = 3.05, read_timeout: float = 10.0, max_retries: int = 2,
+                 backoff: float = 0.5, max_retry_wait: float = 5.0, pool_size: int = 10):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_wait = max_retry_wait
+        self.pool_size = pool_size
+        self._session = None
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, float]] = {}
+    
+    @property
+    def session(self) -> 'requests.Session':
+        # requests подключается при первом вызове Bot API, а не при холодном старте
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+                    self._session = session
+        return self._session
+    
+    def _record(self, api_method: str, elapsed: float, retries: int, failed: bool) -> None:
+        with self._lock:
+            method_stats = self.stats.get(api_method)
+            if method_stats is None:
+                method_stats = self.stats[api_method] = {'calls': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+            elapsed_ms = elapsed * 1000
+            method_stats['calls'] += 1
+            method_stats['errors'] += int(failed)
+            method_stats['retries'] += retries
+            method_stats['total_ms'] = round(method_stats['total_ms'] + elapsed_ms, 1)
+            method_stats['max_ms'] = round(max(method_stats['max_ms'], elapsed_ms), 1)
+    
+    def _retry_delay(self, response: Optional['requests.Response'], attempt: int, retry_throttled: bool) -> Optional[float]:
+        '''Сколько ждать перед повтором; None - не повторять'''
+        if attempt >= self.max_retries:
+            return None
+        if response is None or response.status_code in self.RETRY_STATUSES:
+            return self.backoff * 2 ** attempt
+        if response.status_code == 429 and retry_throttled:
+            try:
+                retry_after = float(response.json().get('parameters', {}).get('retry_after', 1))
+            except ValueError:
+                retry_after = 1.0
+            return retry_after if retry_after <= self.max_retry_wait else None
+        return None
+    
+    def post(self, token: str, api_method: str, retry_throttled: bool = True, **request_kwargs) -> 'requests.Response':
+        '''Вызов Bot API; повторяются 5xx, ошибки соединения и 429 (если его не обрабатывает вызывающий)'''
+        import requests
+        url = f'https://api.telegram.org/bot{token}/{api_method}'
+        request_kwargs.setdefault('timeout', self.timeout)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, **request_kwargs)
+            except requests.exceptions.ConnectionError:
+                delay = self._retry_delay(None, attempt, retry_throttled)
+                if delay is None:
+                    self._record(api_method, time.monotonic() - started, attempt, True)
+                    raise
+            except requests.exceptions.Timeout:
+                # Таймаут чтения не повторяем: запрос мог уже дойти, и повтор продублирует сообщение
+                self._record(api_method, time.monotonic() - started, attempt, True)
+                raise
+            else:
+                delay = self._retry_delay(response, attempt, retry_throttled)
+                if delay is None:
+                    self._record(api_method, time.monotonic() - started, attempt, response.status_code >= 400)
+                    return response
+            attempt += 1
+            time.sleep(delay)
+
+telegram_http = TelegramHttpClient(
+    connect_timeout=float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', '3.05')),
+    read_timeout=float(os.environ.get('TELEGRAM_READ_TIMEOUT', '10')),
+    max_retries=int(os.environ.get('TELEGRAM_HTTP_RETRIES', '2')),
+    pool_size=int(os.environ.get('TELEGRAM_HTTP_POOL_SIZE', '10'))
+)
+
+# Те же лимиты, что в telegram-bot-engine, но не middleware aiogram: webhook шлет синхронно через requests
+# из нескольких потоков, поэтому ждем через time.sleep, корзины защищены блокировкой, а 429 читаем из ответа
+class TelegramRateLimiter:
+    '''Ограничение исходящих сообщений по лимитам Telegram (на бота, на чат, на группу); на 429 ждем retry_after'''
+    
+    def __init__(self, bot_rate: float = 30.0, chat_rate: float = 1.0, group_rate: float = 20 / 60,
+                 max_retries: int = 3, max_wait: float = 30.0):
+        self.bot_rate = bot_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self._bot_buckets: Dict[str, TokenBucket] = {}
+        self._chat_buckets: Dict[Tuple[str, Any], TokenBucket] = {}
+        self._paused_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.stats = {'queued': 0, 'sent': 0, 'throttled': 0, 'dropped': 0}
+    
+    def _reserve(self, bot_key: str, chat_id: Any) -> float:
+        with self._lock:
+            bot_bucket = self._bot_buckets.get(bot_key)
+            if bot_bucket is None:
+                bot_bucket = self._bot_buckets[bot_key] = TokenBucket(self.bot_rate, self.bot_rate)
+            delay = bot_bucket.reserve()
+            chat_bucket = self._chat_buckets.get((bot_key, chat_id))
+            if chat_bucket is None:
+                if len(self._chat_buckets) > 10000:
+                    self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_idle()}
+                is_group = not isinstance(chat_id, int) or chat_id < 0
+                chat_bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, 1 if is_group else 3)
+                self._chat_buckets[(bot_key, chat_id)] = chat_bucket
+            delay = max(delay, chat_bucket.reserve())
+            return max(delay, self._paused_until.get(bot_key, 0.0) - time.monotonic())
+    
+    def post(self, token: str, api_method: str, chat_id: Any, **request_kwargs) -> 'requests.Response':
+        '''Отправить вызов Bot API в пределах лимитов; 429 повторяем после retry_after'''
+        bot_key = token.split(':', 1)[0]
+        for attempt in range(self.max_retries + 1):
+            delay = self._reserve(bot_key, chat_id)
+            if delay > 0:
+                self.stats['queued'] += 1
+                time.sleep(delay)
+            # 429 здесь, а не в клиенте: пауза должна затронуть все отправки этого бота
+            response = telegram_http.post(token, api_method, retry_throttled=False, **request_kwargs)
+            if response.status_code != 429:
+                self.stats['sent'] += 1
+                return response
+            self.stats['throttled'] += 1
+            try:
+                retry_after = float(response.json().get('parameters', {}).get('retry_after', 1))
+            except ValueError:
+                retry_after = 1.0
+            with self._lock:
+                self._paused_until[bot_key] = max(self._paused_until.get(bot_key, 0.0), time.monotonic() + retry_after)
+            if retry_after > self.max_wait:
+                break
+        self.stats['dropped'] += 1
+        print(f"[WARN] Telegram flood control: {api_method} to {chat_id} dropped")
+        return response
+
+telegram_limiter = TelegramRateLimiter(
+    bot_rate=float(os.environ.get('TELEGRAM_BOT_RATE', '30')),
+    chat_rate=float(os.environ.get('TELEGRAM_CHAT_RATE', '1')),
+    group_rate=float(os.environ.get('TELEGRAM_GROUP_RATE', str(20 / 60))),
+    max_wait=float(os.environ.get('TELEGRAM_MAX_RETRY_WAIT', '30'))
+)
+
+class WebhookReply:
+    '''Первый вызов Bot API за Update, который уходит в теле ответа на webhook вместо отдельного запроса'''
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.token: Optional[str] = None
+        self.payload: Optional[Dict] = None
+    
+    def begin(self, token: str) -> None:
+        self.token = token if self.enabled else None
+        self.payload = None
+    
+    def defer(self, api_method: str, data: Dict) -> bool:
+        '''Отложить вызов до ответа на webhook, если слот свободен'''
+        if self.token is None or self.payload is not None:
+            return False
+        self.payload = {'method': api_method, **data}
+        return True
+    
+    def flush(self) -> None:
+        '''Отправить отложенный вызов обычным запросом, чтобы следующий вызов не обогнал его'''
+        payload, self.payload = self.payload, None
+        if payload is not None:
+            data = dict(payload)
+            api_method = data.pop('method')
+            if 'chat_id' in data:
+                telegram_limiter.post(self.token, api_method, data['chat_id'], json=data)
+            else:
+                telegram_http.post(self.token, api_method, json=data)
+    
+    def take(self) -> Optional[Dict]:
+        '''Забрать отложенный вызов для тела ответа и закрыть слот до следующего Update'''
+        payload, self.payload = self.payload, None
+        self.token = None
+        return payload
+
+webhook_reply = WebhookReply(enabled=os.environ.get('WEBHOOK_REPLY_ENABLED', 'true').lower() == 'true')
 
 def send_telegram_message(token: str, chat_id: int, text: str, reply_markup: Dict = None):
     '''Отправляет сообщение в Telegram'''
-    url = f'https://api.telegram.org/bot{token}/sendMessage'
     data = {
         'chat_id': chat_id,
         'text': text,
@@ -240,14 +962,15 @@ def send_telegram_message(token: str, chat_id: int, text: str, reply_markup: Dic
     if reply_markup:
         data['reply_markup'] = reply_markup
     
-    response = requests.post(url, json=data)
+    if webhook_reply.defer('sendMessage', data):
+        return {'ok': True, 'result': None}
+    webhook_reply.flush()
+    
+    response = telegram_limiter.post(token, 'sendMessage', chat_id, json=data)
     return response.json()
 
-def send_telegram_photo(token: str, chat_id: int, photo_base64: str, caption: str, reply_markup: Dict = None):
-    '''Отправляет фото в Telegram'''
-    url = f'https://api.telegram.org/bot{token}/sendPhoto'
-    
-    files = {'photo': ('qr.png', base64.b64decode(photo_base64), 'image/png')}
+def send_telegram_photo(token: str, chat_id: int, photo: Union[bytes, str], caption: str, reply_markup: Dict = None):
+    '''Отправляет фото в Telegram: PNG-байты загружаются файлом, строка передается как file_id'''
     data = {
         'chat_id': chat_id,
         'caption': caption,
@@ -255,8 +978,41 @@ def send_telegram_photo(token: str, chat_id: int, photo_base64: str, caption: st
     }
     if reply_markup:
         data['reply_markup'] = json.dumps(reply_markup)
+    files = None
+    if isinstance(photo, str):
+        data['photo'] = photo
+    else:
+        files = {'photo': ('qr.png', photo, 'image/png')}
+    
+    # Файлы в ответе на webhook не передать, поэтому сначала отправляем отложенный вызов
+    webhook_reply.flush()
+    response = telegram_limiter.post(token, 'sendPhoto', chat_id, data=data, files=files)
+    return response.json()
+
+def send_qr_photo(bot_data: Dict, chat_id: int, code_number: int, variant: str, caption: str, reply_markup: Dict = None):
+    '''Отправляет картинку QR-ключа; повторная отправка того же ключа (например, админу) идет по file_id без загрузки'''
+    return telegram_file_cache.send_photo(
+        bot_data['id'], qr_asset_key(code_number, variant),
+        lambda photo: send_telegram_photo(bot_data['telegram_token'], chat_id, photo, caption, reply_markup),
+        lambda: generate_qr_image(code_number, variant)
+    )
+
+def edit_telegram_message(token: str, chat_id: int, message_id: int, text: str, reply_markup: Dict = None):
+    '''Редактирует текст сообщения в Telegram'''
+    data = {
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'text': text,
+        'parse_mode': 'HTML'
+    }
+    if reply_markup:
+        data['reply_markup'] = reply_markup
     
-    response = requests.post(url, data=data, files=files)
+    if webhook_reply.defer('editMessageText', data):
+        return {'ok': True, 'result': None}
+    webhook_reply.flush()
+    
+    response = telegram_limiter.post(token, 'editMessageText', chat_id, json=data)
     return response.json()
 
 def create_main_menu_keyboard(payment_enabled: bool = True, button_texts: dict = None, bot_id: int = None, telegram_user_id: int = None) -> Dict:
@@ -357,8 +1113,6 @@ def handle_free_key(bot_data: Dict, message: Dict):
         return
     
     if qr_key:
-        qr_base64 = generate_qr_base64(qr_key['code_number'], is_vip=False)
-        
         caption_template = message_texts.get('free_key_success',
             "✅ Ваш бесплатный ключ №{code_number}\n\n"
             "Покажите этот QR-код на кассе:\n"
@@ -375,7 +1129,7 @@ def handle_free_key(bot_data: Dict, message: Dict):
             ])
         
         inline_keyboard = create_inline_keyboard(inline_buttons) if inline_buttons else None
-        send_telegram_photo(bot_data['telegram_token'], chat_id, qr_base64, caption, inline_keyboard)
+        send_qr_photo(bot_data, chat_id, qr_key['code_number'], 'free', caption, inline_keyboard)
     else:
         text = message_texts.get('free_key_empty',
             "😔 Бесплатные ключи на сегодня закончились.\n\n"
@@ -483,23 +1237,13 @@ def handle_admin_free_vip(bot_data: Dict, message: Dict):
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
-    qr_query = f'''SELECT * FROM t_p5255237_telegram_bot_service.qr_codes 
-                  WHERE bot_id = {bot_data['id']} AND code_type = 'vip' AND is_used = false 
-                  ORDER BY code_number LIMIT 1'''
-    cursor.execute(qr_query)
-    qr_code = cursor.fetchone()
+    qr_code = allocate_qr_code(cursor, bot_data['id'], 'vip', user_id)
     
     if qr_code:
-        update_query = f'''UPDATE t_p5255237_telegram_bot_service.qr_codes 
-                          SET is_used = true, used_by_user_id = {user_id}, used_at = CURRENT_TIMESTAMP 
-                          WHERE id = {qr_code['id']}'''
-        cursor.execute(update_query)
         conn.commit()
         cursor.close()
         conn.close()
         
-        qr_base64 = generate_qr_base64(qr_code['code_number'], is_vip=True)
-        
         vip_message = bot_data.get('vip_purchase_message', 'VIP-ключ открывает доступ к эксклюзивным материалам и привилегиям.')
         
         caption = (
@@ -508,13 +1252,114 @@ def handle_admin_free_vip(bot_data: Dict, message: Dict):
             f"Покажите этот код на кассе для получения доступа к VIP-товарам"
         )
         
-        send_telegram_photo(bot_data['telegram_token'], chat_id, qr_base64, caption)
+        send_qr_photo(bot_data, chat_id, qr_code['code_number'], 'vip', caption)
     else:
         cursor.close()
         conn.close()
         text = "😔 VIP-ключи закончились."
         send_telegram_message(bot_data['telegram_token'], chat_id, text)
 
+# Пользователей на странице списка в статистике: 20 записей укладываются в лимит 4096 символов сообщения
+STATS_PAGE_SIZE = int(os.environ.get('STATS_PAGE_SIZE', '20'))
+
+def fetch_stats_counters(cursor, bot_id: int) -> Dict:
+    '''Все счетчики статистики одним запросом: по одному проходу по ключам, пользователям и платежам бота'''
+    cursor.execute(f'''SELECT q.*, u.*, p.*
+        FROM (
+            SELECT COUNT(*) FILTER (WHERE code_type = 'free') as free_total,
+                   COUNT(*) FILTER (WHERE code_type = 'free' AND is_used = true) as free_used,
+                   COUNT(*) FILTER (WHERE code_type = 'vip') as vip_total,
+                   COUNT(*) FILTER (WHERE code_type = 'vip' AND is_used = true) as vip_used
+            FROM t_p5255237_telegram_bot_service.qr_codes
+            WHERE bot_id = {bot_id}
+        ) q
+        CROSS JOIN (
+            SELECT COUNT(*) as users_total,
+                   COUNT(*) FILTER (WHERE received_free_qr = true) as users_with_free,
+                   COUNT(*) FILTER (WHERE received_vip_qr = true) as users_with_vip
+            FROM t_p5255237_telegram_bot_service.bot_users
+            WHERE bot_id = {bot_id}
+        ) u
+        CROSS JOIN (
+            SELECT COUNT(*) as payments_total,
+                   COALESCE(SUM(amount), 0) as payments_sum,
+                   COUNT(*) FILTER (WHERE status = 'CONFIRMED') as payments_confirmed,
+                   COALESCE(SUM(amount) FILTER (WHERE status = 'CONFIRMED'), 0) as payments_confirmed_sum,
+                   COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE) as payments_today,
+                   COALESCE(SUM(amount) FILTER (WHERE created_at >= CURRENT_DATE), 0) as payments_today_sum
+            FROM t_p5255237_telegram_bot_service.payments
+            WHERE bot_id = {bot_id}
+        ) p''')
+    return cursor.fetchone()
+
+def fetch_stats_users(cursor, bot_id: int, cursor_id: int = 0, backward: bool = False,
+                      limit: int = STATS_PAGE_SIZE) -> Tuple[List[Dict], bool]:
+    '''Страница пользователей с выданными ключами после (или до) bu.id = cursor_id; второй элемент - есть ли еще строки дальше'''
+    if backward:
+        condition, order = f'id < {cursor_id}', 'DESC'
+    else:
+        condition, order = f'id > {cursor_id}', 'ASC'
+    # Сначала ограничиваем пользователей по индексу, телефон и ключи ищем только для строк страницы
+    cursor.execute(f'''SELECT 
+            bu.id,
+            bu.first_name, 
+            bu.last_name, 
+            bu.username,
+            bu.received_free_qr,
+            bu.received_vip_qr,
+            p.customer_phone,
+            free_qr.code_number as free_qr_number,
+            vip_qr.code_number as vip_qr_number
+        FROM (
+            SELECT id, bot_id, telegram_user_id, first_name, last_name, username, received_free_qr, received_vip_qr
+            FROM t_p5255237_telegram_bot_service.bot_users
+            WHERE bot_id = {bot_id} AND (received_free_qr = true OR received_vip_qr = true) AND {condition}
+            ORDER BY id {order}
+            LIMIT {limit + 1}
+        ) bu
+        LEFT JOIN LATERAL (
+            SELECT customer_phone FROM t_p5255237_telegram_bot_service.payments
+            WHERE bot_id = bu.bot_id AND telegram_user_id = bu.telegram_user_id AND status = 'CONFIRMED'
+            ORDER BY created_at DESC LIMIT 1
+        ) p ON true
+        LEFT JOIN LATERAL (
+            SELECT code_number FROM t_p5255237_telegram_bot_service.qr_codes
+            WHERE used_by_user_id = bu.id AND code_type = 'free'
+            ORDER BY used_at DESC NULLS LAST LIMIT 1
+        ) free_qr ON true
+        LEFT JOIN LATERAL (
+            SELECT code_number FROM t_p5255237_telegram_bot_service.qr_codes
+            WHERE used_by_user_id = bu.id AND code_type = 'vip'
+            ORDER BY used_at DESC NULLS LAST LIMIT 1
+        ) vip_qr ON true
+        ORDER BY bu.id {order}''')
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+def render_stats_users_page(rows: List[Dict], first_number: int, has_prev: bool, has_next: bool) -> Tuple[str, Optional[Dict]]:
+    '''Текст страницы списка и кнопки "◀ ▶" с курсором (id крайней строки и номер первой строки соседней страницы)'''
+    lines = ["<b>📋 Список пользователей с QR-кодами:</b>\n"]
+    for number, user in enumerate(rows, first_number):
+        full_name = f"{user.get('first_name') or ''} {user.get('last_name') or ''}".strip() or user.get('username') or 'Без имени'
+        lines.append(f"{number}. {html.escape(full_name[:64])}")
+        lines.append(f"   📱 Телефон: {html.escape(user.get('customer_phone') or 'не указан')}")
+        if user.get('free_qr_number'):
+            lines.append(f"   🎁 Бесплатный QR: №{user['free_qr_number']}")
+        if user.get('vip_qr_number'):
+            lines.append(f"   💎 VIP QR: №{user['vip_qr_number']}")
+        lines.append("")
+    
+    buttons = []
+    if has_prev:
+        buttons.append({'text': '◀', 'callback_data': f"stats_users:prev:{rows[0]['id']}:{max(1, first_number - STATS_PAGE_SIZE)}"})
+    if has_next:
+        buttons.append({'text': '▶', 'callback_data': f"stats_users:next:{rows[-1]['id']}:{first_number + len(rows)}"})
+    return '\n'.join(lines), create_inline_keyboard([buttons]) if buttons else None
+
 def handle_stats(bot_data: Dict, chat_id: int, telegram_user_id: int):
     '''Показать статистику по ключам (только для администратора)'''
     if not is_user_admin(bot_data['id'], telegram_user_id):
@@ -525,90 +1370,28 @@ def handle_stats(bot_data: Dict, chat_id: int, telegram_user_id: int):
     try:
         conn = get_db_connection()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
+        try:
+            stats = fetch_stats_counters(cursor, bot_data['id'])
+            users_page, has_next = fetch_stats_users(cursor, bot_data['id'])
+        finally:
+            cursor.close()
+            conn.close()
         
-        free_total_query = f'''SELECT COUNT(*) as total FROM t_p5255237_telegram_bot_service.qr_codes 
-                              WHERE bot_id = {bot_data['id']} AND code_type = 'free' '''
-        cursor.execute(free_total_query)
-        free_total = cursor.fetchone()['total']
-        
-        free_used_query = f'''SELECT COUNT(*) as used FROM t_p5255237_telegram_bot_service.qr_codes 
-                             WHERE bot_id = {bot_data['id']} AND code_type = 'free' AND is_used = true'''
-        cursor.execute(free_used_query)
-        free_used = cursor.fetchone()['used']
-        
+        free_total = stats['free_total']
+        free_used = stats['free_used']
         free_available = free_total - free_used
-        
-        vip_total_query = f'''SELECT COUNT(*) as total FROM t_p5255237_telegram_bot_service.qr_codes 
-                             WHERE bot_id = {bot_data['id']} AND code_type = 'vip' '''
-        cursor.execute(vip_total_query)
-        vip_total = cursor.fetchone()['total']
-        
-        vip_used_query = f'''SELECT COUNT(*) as used FROM t_p5255237_telegram_bot_service.qr_codes 
-                            WHERE bot_id = {bot_data['id']} AND code_type = 'vip' AND is_used = true'''
-        cursor.execute(vip_used_query)
-        vip_used = cursor.fetchone()['used']
-        
+        vip_total = stats['vip_total']
+        vip_used = stats['vip_used']
         vip_available = vip_total - vip_used
-        
-        users_total_query = f'''SELECT COUNT(*) as total FROM t_p5255237_telegram_bot_service.bot_users 
-                               WHERE bot_id = {bot_data['id']}'''
-        cursor.execute(users_total_query)
-        users_total = cursor.fetchone()['total']
-        
-        users_with_free_query = f'''SELECT COUNT(*) as count FROM t_p5255237_telegram_bot_service.bot_users 
-                                   WHERE bot_id = {bot_data['id']} AND received_free_qr = true'''
-        cursor.execute(users_with_free_query)
-        users_with_free = cursor.fetchone()['count']
-        
-        users_with_vip_query = f'''SELECT COUNT(*) as count FROM t_p5255237_telegram_bot_service.bot_users 
-                                  WHERE bot_id = {bot_data['id']} AND received_vip_qr = true'''
-        cursor.execute(users_with_vip_query)
-        users_with_vip = cursor.fetchone()['count']
-        
-        payments_total_query = f'''SELECT COUNT(*) as total, COALESCE(SUM(amount), 0) as sum 
-                                  FROM t_p5255237_telegram_bot_service.payments 
-                                  WHERE bot_id = {bot_data['id']}'''
-        cursor.execute(payments_total_query)
-        payments_data = cursor.fetchone()
-        payments_total = payments_data['total']
-        payments_sum = payments_data['sum']
-        
-        payments_confirmed_query = f'''SELECT COUNT(*) as confirmed, COALESCE(SUM(amount), 0) as sum 
-                                      FROM t_p5255237_telegram_bot_service.payments 
-                                      WHERE bot_id = {bot_data['id']} AND status = 'CONFIRMED' '''
-        cursor.execute(payments_confirmed_query)
-        payments_confirmed_data = cursor.fetchone()
-        payments_confirmed = payments_confirmed_data['confirmed']
-        payments_confirmed_sum = payments_confirmed_data['sum']
-        
-        payments_today_query = f'''SELECT COUNT(*) as today, COALESCE(SUM(amount), 0) as sum 
-                                  FROM t_p5255237_telegram_bot_service.payments 
-                                  WHERE bot_id = {bot_data['id']} AND created_at >= CURRENT_DATE'''
-        cursor.execute(payments_today_query)
-        payments_today_data = cursor.fetchone()
-        payments_today = payments_today_data['today']
-        payments_today_sum = payments_today_data['sum']
-        
-        users_list_query = f'''SELECT 
-            bu.first_name, 
-            bu.last_name, 
-            bu.username,
-            bu.received_free_qr,
-            bu.received_vip_qr,
-            p.customer_phone,
-            free_qr.code_number as free_qr_number,
-            vip_qr.code_number as vip_qr_number
-        FROM t_p5255237_telegram_bot_service.bot_users bu
-        LEFT JOIN t_p5255237_telegram_bot_service.payments p ON bu.telegram_user_id = p.telegram_user_id AND bu.bot_id = p.bot_id AND p.status = 'CONFIRMED'
-        LEFT JOIN t_p5255237_telegram_bot_service.qr_codes free_qr ON free_qr.used_by_user_id = bu.id AND free_qr.code_type = 'free'
-        LEFT JOIN t_p5255237_telegram_bot_service.qr_codes vip_qr ON vip_qr.used_by_user_id = bu.id AND vip_qr.code_type = 'vip'
-        WHERE bu.bot_id = {bot_data['id']} AND (bu.received_free_qr = true OR bu.received_vip_qr = true)
-        ORDER BY bu.id'''
-        cursor.execute(users_list_query)
-        users_list = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
+        users_total = stats['users_total']
+        users_with_free = stats['users_with_free']
+        users_with_vip = stats['users_with_vip']
+        payments_total = stats['payments_total']
+        payments_sum = stats['payments_sum']
+        payments_confirmed = stats['payments_confirmed']
+        payments_confirmed_sum = stats['payments_confirmed_sum']
+        payments_today = stats['payments_today']
+        payments_today_sum = stats['payments_today_sum']
         
         text = (
             f"📊 <b>Статистика бота</b>\n\n"
@@ -632,149 +1415,109 @@ def handle_stats(bot_data: Dict, chat_id: int, telegram_user_id: int):
         
         send_telegram_message(bot_data['telegram_token'], chat_id, text)
         
-        if users_list:
-            users_text = "\n<b>📋 Список пользователей с QR-кодами:</b>\n\n"
-            for idx, user in enumerate(users_list, 1):
-                first_name = user.get('first_name', '')
-                last_name = user.get('last_name', '')
-                username = user.get('username', '')
-                phone = user.get('customer_phone', 'не указан')
-                free_qr = user.get('free_qr_number')
-                vip_qr = user.get('vip_qr_number')
-                
-                full_name = f"{first_name} {last_name}".strip() or username or 'Без имени'
-                
-                users_text += f"{idx}. {full_name}\n"
-                users_text += f"   📱 Телефон: {phone}\n"
-                
-                if free_qr:
-                    users_text += f"   🎁 Бесплатный QR: №{free_qr}\n"
-                if vip_qr:
-                    users_text += f"   💎 VIP QR: №{vip_qr}\n"
-                
-                users_text += "\n"
-            
-            send_telegram_message(bot_data['telegram_token'], chat_id, users_text)
+        if users_page:
+            users_text, keyboard = render_stats_users_page(users_page, 1, False, has_next)
+            send_telegram_message(bot_data['telegram_token'], chat_id, users_text, keyboard)
         
     except Exception as e:
         send_telegram_message(bot_data['telegram_token'], chat_id, f"⚠️ Ошибка при получении статистики: {str(e)}")
 
-def handle_check_payment(bot_data: Dict, chat_id: int, telegram_user_id: int):
-    '''Проверка статуса всех платежей пользователя за сегодня'''
+def handle_stats_users_page(bot_data: Dict, chat_id: int, telegram_user_id: int, message_id: int, data: str):
+    '''Перелистывание списка пользователей статистики: редактирует сообщение со списком'''
+    try:
+        _, direction, cursor_id, first_number = data.split(':')
+        backward = direction == 'prev'
+        cursor_id, first_number = int(cursor_id), int(first_number)
+    except ValueError:
+        return
+    if not is_user_admin(bot_data['id'], telegram_user_id):
+        return
+    
     try:
         conn = get_db_connection()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
+        rows, has_more = fetch_stats_users(cursor, bot_data['id'], cursor_id, backward)
+        cursor.close()
+        conn.close()
         
-        # Получаем внутренний user_id и проверяем статус VIP
-        user_query = f'''SELECT id, received_vip_qr, is_admin FROM t_p5255237_telegram_bot_service.bot_users 
-                        WHERE bot_id = {bot_data['id']} AND telegram_user_id = {telegram_user_id}'''
-        cursor.execute(user_query)
-        user_record = cursor.fetchone()
-        
-        if not user_record:
-            cursor.close()
-            conn.close()
-            send_telegram_message(bot_data['telegram_token'], chat_id, "⚠️ Ошибка: пользователь не найден")
+        if not rows:
             return
-        
-        user_id = user_record['id']
-        is_admin = user_record.get('is_admin', False)
-        already_received_vip = user_record.get('received_vip_qr', False)
-        
-        if already_received_vip and not is_admin:
-            send_telegram_message(bot_data['telegram_token'], chat_id, 
-                "✅ Вы уже получили свой VIP-ключ!\n\nКаждый пользователь может получить только один VIP-ключ за оплату.")
+        # Назад уходим со страницы, после которой точно что-то есть, и наоборот
+        has_prev, has_next = (has_more, True) if backward else (cursor_id > 0, has_more)
+        if backward and not has_prev:
+            first_number = 1
+        users_text, keyboard = render_stats_users_page(rows, first_number, has_prev, has_next)
+        edit_telegram_message(bot_data['telegram_token'], chat_id, message_id, users_text, keyboard)
+    except Exception as e:
+        send_telegram_message(bot_data['telegram_token'], chat_id, f"⚠️ Ошибка при получении статистики: {str(e)}")
+
+def handle_check_payment(bot_data: Dict, chat_id: int, telegram_user_id: int):
+    '''Статус платежей пользователя за сегодня (его обновляют уведомления T-Bank и страховочная проверка job-worker)'''
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        try:
+            cursor.execute(f'''SELECT id, is_admin FROM t_p5255237_telegram_bot_service.bot_users 
+                              WHERE bot_id = {bot_data['id']} AND telegram_user_id = {telegram_user_id}''')
+            user_record = cursor.fetchone()
+            if not user_record:
+                send_telegram_message(bot_data['telegram_token'], chat_id, "⚠️ Ошибка: пользователь не найден")
+                return
+            
+            cursor.execute(f'''SELECT p.order_id, p.status, qr.code_number AS vip_code_number
+                              FROM t_p5255237_telegram_bot_service.payments p
+                              LEFT JOIN t_p5255237_telegram_bot_service.qr_codes qr ON qr.id = p.vip_qr_code_id
+                              WHERE p.bot_id = {bot_data['id']} 
+                              AND p.telegram_user_id = {telegram_user_id}
+                              AND p.status IN ('NEW', 'AUTHORIZED', 'CONFIRMED')
+                              AND p.created_at >= CURRENT_DATE
+                              ORDER BY p.created_at DESC''')
+            payments = cursor.fetchall()
+            confirmed = [payment for payment in payments if payment['status'] == 'CONFIRMED']
+            
+            # Выдачу ключа делает задача deliver_vip_key: она закрепляет ключ за платежом, поэтому повтор не выдаст второй
+            for payment in confirmed:
+                if payment['vip_code_number'] is None:
+                    job_payload = json.dumps({
+                        'bot_id': bot_data['id'],
+                        'chat_id': chat_id,
+                        'order_id': payment['order_id'],
+                        'user_id': user_record['id'],
+                        'is_admin': bool(user_record.get('is_admin'))
+                    }).replace("'", "''")
+                    dedup_key_escaped = f"deliver_vip_key:{payment['order_id']}".replace("'", "''")
+                    cursor.execute(f'''INSERT INTO t_p5255237_telegram_bot_service.jobs (job_type, payload, dedup_key)
+                                      VALUES ('deliver_vip_key', '{job_payload}'::jsonb, '{dedup_key_escaped}')
+                                      ON CONFLICT (dedup_key) DO NOTHING''')
+            conn.commit()
+        finally:
             cursor.close()
             conn.close()
-            return
-        
-        # Получаем все платежи пользователя за сегодня со статусом NEW, AUTHORIZED
-        payments_query = f'''SELECT order_id, payment_id, status, amount 
-                            FROM t_p5255237_telegram_bot_service.payments 
-                            WHERE bot_id = {bot_data['id']} 
-                            AND telegram_user_id = {telegram_user_id}
-                            AND status IN ('NEW', 'AUTHORIZED')
-                            AND created_at >= CURRENT_DATE
-                            ORDER BY created_at DESC'''
-        cursor.execute(payments_query)
-        payments = cursor.fetchall()
         
         if not payments:
             send_telegram_message(bot_data['telegram_token'], chat_id, "⚠️ У вас нет активных платежей за сегодня")
-            cursor.close()
-            conn.close()
             return
         
-        confirmed_count = 0
-        
-        # Проверяем каждый платёж
-        for payment in payments:
-            order_id = payment['order_id']
-            
-            try:
-                # Запрашиваем статус платежа через API
-                response = requests.post(
-                    'https://functions.poehali.dev/b4079ccb-abcb-4171-b656-2462d93e1ac9',
-                    json={'order_id': order_id},
-                    timeout=10
-                )
-                result = response.json()
-                
-                if result.get('confirmed'):
-                    confirmed_count += 1
-                    
-                    # Получаем свободный VIP QR-ключ
-                    qr_query = f'''SELECT * FROM t_p5255237_telegram_bot_service.qr_codes 
-                                  WHERE bot_id = {bot_data['id']} AND code_type = 'vip' AND is_used = false 
-                                  ORDER BY code_number LIMIT 1'''
-                    cursor.execute(qr_query)
-                    qr_code = cursor.fetchone()
-                    
-                    if qr_code:
-                        # Помечаем ключ как использованный
-                        update_query = f'''UPDATE t_p5255237_telegram_bot_service.qr_codes 
-                                          SET is_used = true, used_by_user_id = {user_id}, used_at = CURRENT_TIMESTAMP 
-                                          WHERE id = {qr_code['id']}'''
-                        cursor.execute(update_query)
-                        
-                        # Помечаем что пользователь получил VIP-ключ (кроме админа)
-                        if not is_admin:
-                            mark_vip_query = f'''UPDATE t_p5255237_telegram_bot_service.bot_users 
-                                               SET received_vip_qr = true, vip_qr_received_at = CURRENT_TIMESTAMP 
-                                               WHERE bot_id = {bot_data['id']} AND telegram_user_id = {telegram_user_id}'''
-                            cursor.execute(mark_vip_query)
-                        
-                        conn.commit()
-                        
-                        # Генерируем QR-код
-                        qr_base64 = generate_qr_base64(qr_code['code_number'], is_vip=True)
-                        
-                        vip_message = bot_data.get('vip_purchase_message', 'VIP-ключ открывает доступ к эксклюзивным материалам и привилегиям.')
-                        
-                        caption = (
-                            f"{vip_message}\n\n"
-                            f"✅ Оплата подтверждена! Спасибо за покупку!\n\n"
-                            f"💎 Ваш VIP QR-код №{qr_code['code_number']}\n\n"
-                            f"Покажите этот код на кассе для получения доступа к VIP-товарам"
-                        )
-                        
-                        send_telegram_photo(bot_data['telegram_token'], chat_id, qr_base64, caption)
-                    else:
-                        send_telegram_message(bot_data['telegram_token'], chat_id, "✅ Оплата подтверждена! Но VIP-ключи закончились. Обратитесь к администратору.")
-                        
-            except Exception as e:
-                # Игнорируем ошибки отдельных платежей
-                pass
-        
-        cursor.close()
-        conn.close()
-        
-        if confirmed_count == 0:
+        if not confirmed:
             send_telegram_message(
                 bot_data['telegram_token'], 
                 chat_id, 
-                f"⏳ Проверено платежей: {len(payments)}\n\nОплаты ещё не поступили. Попробуйте через минуту после оплаты."
+                f"⏳ Платежей в обработке: {len(payments)}\n\nКак только банк подтвердит оплату, VIP-ключ придёт в этот чат автоматически."
+            )
+            return
+        
+        vip_message = bot_data.get('vip_purchase_message', 'VIP-ключ открывает доступ к эксклюзивным материалам и привилегиям.')
+        for payment in confirmed:
+            if payment['vip_code_number'] is None:
+                send_telegram_message(bot_data['telegram_token'], chat_id, "✅ Оплата подтверждена! VIP-ключ будет отправлен в этот чат.")
+                continue
+            caption = (
+                f"{vip_message}\n\n"
+                f"✅ Оплата подтверждена! Спасибо за покупку!\n\n"
+                f"💎 Ваш VIP QR-код №{payment['vip_code_number']}\n\n"
+                f"Покажите этот код на кассе для получения доступа к VIP-товарам"
             )
+            send_qr_photo(bot_data, chat_id, payment['vip_code_number'], 'vip', caption)
             
     except Exception as e:
         send_telegram_message(bot_data['telegram_token'], chat_id, f"⚠️ Ошибка при проверке статуса: {str(e)}")
@@ -825,6 +1568,7 @@ def handle_first_name_input(bot_data: Dict, chat_id: int, telegram_user_id: int,
 
 def handle_phone_input_and_create_payment(bot_data: Dict, chat_id: int, telegram_user_id: int, phone: str):
     '''Обработка телефона и создание платежа'''
+    import requests
     user_state = get_user_state(bot_data['id'], telegram_user_id)
     if not user_state:
         return
@@ -974,83 +1718,111 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         update = json.loads(event.get('body', '{}'))
         
-        if 'message' in update:
-            message = update['message']
-            text = message.get('text', '')
-            chat_id = message['chat']['id']
-            telegram_user_id = message['from']['id']
-            
-            # Проверяем состояние пользователя
-            user_state = get_user_state(bot_data['id'], telegram_user_id)
-            
-            if user_state and user_state.get('state') != 'idle':
-                state = user_state['state']
-                
-                if state == 'waiting_last_name':
-                    handle_last_name_input(bot_data, chat_id, telegram_user_id, text)
-                elif state == 'waiting_first_name':
-                    handle_first_name_input(bot_data, chat_id, telegram_user_id, text)
-                elif state == 'waiting_phone':
-                    handle_phone_input_and_create_payment(bot_data, chat_id, telegram_user_id, text)
-            else:
-                # Обычная обработка команд
-                payment_enabled = bot_data.get('payment_enabled', True)
-                button_texts = bot_data.get('button_texts', {})
+        # Telegram повторяет доставку, если ответ задержался: такой Update уже обработан или обрабатывается
+        update_id = update.get('update_id')
+        if update_id is not None and not update_dedup.claim(bot_data['id'], update_id):
+            print(f"[DEDUP Bot {bot_data['id']}] Update {update_id} already processed, skipping")
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'ok': True}),
+                'isBase64Encoded': False
+            }
+        
+        webhook_reply.begin(bot_token)
+        # Блокировка чата снимается в finally до возврата соединений в пул
+        chat_guard = contextlib.ExitStack()
+        try:
+            chat_guard.enter_context(chat_lock(bot_data['id'], get_update_chat_id(update)))
+            if 'message' in update:
+                message = update['message']
+                text = message.get('text', '')
+                chat_id = message['chat']['id']
+                telegram_user_id = message['from']['id']
                 
-                print(f"[DEBUG Webhook Bot {bot_data['id']}] Received text: '{text}'")
-                print(f"[DEBUG Webhook Bot {bot_data['id']}] Payment enabled: {payment_enabled}")
-                print(f"[DEBUG Webhook Bot {bot_data['id']}] Button texts: {button_texts}")
+                # Проверяем состояние пользователя
+                user_state = get_user_state(bot_data['id'], telegram_user_id)
                 
-                free_key_text = button_texts.get('free_key', '🎁 Получить бесплатный ключ')
-                secret_shop_text = button_texts.get('secret_shop', '🔐 Узнать про Тайную витрину')
-                buy_vip_text = button_texts.get('buy_vip', '💎 Купить VIP-ключ')
-                help_text = button_texts.get('help', '❓ Помощь')
+                if user_state and user_state.get('state') != 'idle':
+                    state = user_state['state']
+                    
+                    if state == 'waiting_last_name':
+                        handle_last_name_input(bot_data, chat_id, telegram_user_id, text)
+                    elif state == 'waiting_first_name':
+                        handle_first_name_input(bot_data, chat_id, telegram_user_id, text)
+                    elif state == 'waiting_phone':
+                        handle_phone_input_and_create_payment(bot_data, chat_id, telegram_user_id, text)
+                else:
+                    # Обычная обработка команд
+                    payment_enabled = bot_data.get('payment_enabled', True)
+                    button_texts = bot_data.get('button_texts', {})
+                    
+                    print(f"[DEBUG Webhook Bot {bot_data['id']}] Received text: '{text}'")
+                    print(f"[DEBUG Webhook Bot {bot_data['id']}] Payment enabled: {payment_enabled}")
+                    print(f"[DEBUG Webhook Bot {bot_data['id']}] Button texts: {button_texts}")
+                    
+                    free_key_text = button_texts.get('free_key', '🎁 Получить бесплатный ключ')
+                    secret_shop_text = button_texts.get('secret_shop', '🔐 Узнать про Тайную витрину')
+                    buy_vip_text = button_texts.get('buy_vip', '💎 Купить VIP-ключ')
+                    help_text = button_texts.get('help', '❓ Помощь')
+                    
+                    if text == '/start':
+                        handle_start(bot_data, message)
+                    elif text == '/stats':
+                        handle_stats(bot_data, chat_id, telegram_user_id)
+                    elif text == free_key_text or text == '🎁 Получить бесплатный ключ':
+                        handle_free_key(bot_data, message)
+                    elif payment_enabled and (text == secret_shop_text or text == '🔐 Узнать про Тайную витрину'):
+                        handle_secret_shop(bot_data, chat_id)
+                    elif payment_enabled and (text == buy_vip_text or text == '💎 Купить VIP-ключ'):
+                        handle_buy_vip(bot_data, chat_id)
+                    elif text == '👑 Получить бесплатный VIP-ключ (Админ)':
+                        handle_admin_free_vip(bot_data, message)
+                    elif text == '📊 Статистика':
+                        handle_stats(bot_data, chat_id, telegram_user_id)
+                    elif payment_enabled and (text == help_text or text == '❓ Помощь'):
+                        handle_help(bot_data, chat_id)
+                    elif not payment_enabled:
+                        print(f"[DEBUG Webhook Bot {bot_data['id']}] Payment disabled, ignoring message")
+            
+            elif 'callback_query' in update:
+                callback = update['callback_query']
+                chat_id = callback['message']['chat']['id']
+                telegram_user_id = callback['from']['id']
+                data = callback['data']
                 
-                if text == '/start':
-                    handle_start(bot_data, message)
-                elif text == '/stats':
-                    handle_stats(bot_data, chat_id, telegram_user_id)
-                elif text == free_key_text or text == '🎁 Получить бесплатный ключ':
-                    handle_free_key(bot_data, message)
-                elif payment_enabled and (text == secret_shop_text or text == '🔐 Узнать про Тайную витрину'):
+                if data == 'secret_shop':
                     handle_secret_shop(bot_data, chat_id)
-                elif payment_enabled and (text == buy_vip_text or text == '💎 Купить VIP-ключ'):
+                elif data == 'buy_vip':
                     handle_buy_vip(bot_data, chat_id)
-                elif text == '👑 Получить бесплатный VIP-ключ (Админ)':
-                    handle_admin_free_vip(bot_data, message)
-                elif text == '📊 Статистика':
-                    handle_stats(bot_data, chat_id, telegram_user_id)
-                elif payment_enabled and (text == help_text or text == '❓ Помощь'):
-                    handle_help(bot_data, chat_id)
-                elif not payment_enabled:
-                    print(f"[DEBUG Webhook Bot {bot_data['id']}] Payment disabled, ignoring message")
-        
-        elif 'callback_query' in update:
-            callback = update['callback_query']
-            chat_id = callback['message']['chat']['id']
-            telegram_user_id = callback['from']['id']
-            data = callback['data']
-            
-            if data == 'secret_shop':
-                handle_secret_shop(bot_data, chat_id)
-            elif data == 'buy_vip':
-                handle_buy_vip(bot_data, chat_id)
-            elif data == 'start_payment':
-                handle_start_payment(bot_data, chat_id, telegram_user_id)
-            elif data == 'main_menu':
-                handle_start(bot_data, {'chat': {'id': chat_id}, 'from': callback['from']})
-            elif data == 'check_payment':
-                handle_check_payment(bot_data, chat_id, telegram_user_id)
-            
-            requests.post(
-                f"https://api.telegram.org/bot{bot_data['telegram_token']}/answerCallbackQuery",
-                json={'callback_query_id': callback['id']}
-            )
+                elif data == 'start_payment':
+                    handle_start_payment(bot_data, chat_id, telegram_user_id)
+                elif data == 'main_menu':
+                    handle_start(bot_data, {'chat': {'id': chat_id}, 'from': callback['from']})
+                elif data == 'check_payment':
+                    handle_check_payment(bot_data, chat_id, telegram_user_id)
+                elif data.startswith('stats_users:'):
+                    handle_stats_users_page(bot_data, chat_id, telegram_user_id, callback['message']['message_id'], data)
+                
+                # answerCallbackQuery не зависит от порядка, поэтому отложенное сообщение не сбрасываем
+                answer_data = {'callback_query_id': callback['id']}
+                if not webhook_reply.defer('answerCallbackQuery', answer_data):
+                    telegram_http.post(bot_data['telegram_token'], 'answerCallbackQuery', json=answer_data)
+        except Exception:
+            webhook_reply.flush()
+            if update_id is not None:
+                update_dedup.release(bot_data['id'], update_id)
+            raise
+        finally:
+            chat_guard.close()
+            db_pool.release_all()
+            print(f"[STATS] db_pool={db_pool.stats} limiter={telegram_limiter.stats} "
+                  f"http={telegram_http.stats} files={telegram_file_cache.stats}")
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'ok': True}),
+            'body': json.dumps(webhook_reply.take() or {'ok': True}),
             'isBase64Encoded': False
         }
     
@@ -1,11 +1,299 @@
 import json
 import os
-from typing import Dict, Any
+import atexit
+import hashlib
+import time
+import threading
+from typing import Dict, Any, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime, timedelta
 import asyncio
 from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+class PooledConnection:
+    '''Соединение, выданное пулом: close() возвращает его в пул вместо закрытия'''
+    
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            self._pool.putconn(self)
+            self._conn = None
+
+class ConnectionPool:
+    '''Пул соединений с PostgreSQL, который переживает тёплые вызовы функции'''
+    
+    def __init__(self, max_size: int = 5, health_check_after: float = 30.0):
+        self.max_size = max_size
+        self.health_check_after = health_check_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._in_use: Dict[int, PooledConnection] = {}
+        self._lock = threading.Lock()
+        self.stats = {'connects': 0, 'reuses': 0, 'discards': 0, 'health_checks': 0}
+    
+    def _connect(self):
+        database_url = os.environ.get('DATABASE_URL', '')
+        if not database_url:
+            raise ValueError('DATABASE_URL not configured')
+        self.stats['connects'] += 1
+        return psycopg2.connect(database_url)
+    
+    def _discard(self, conn) -> None:
+        self.stats['discards'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        self.stats['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self) -> PooledConnection:
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if self._is_healthy(conn, released_at):
+                    self.stats['reuses'] += 1
+                    pooled = PooledConnection(self, conn)
+                    self._in_use[id(conn)] = pooled
+                    return pooled
+                self._discard(conn)
+            
+            if len(self._in_use) >= self.max_size:
+                raise Exception(f'Connection pool exhausted (max_size={self.max_size})')
+            
+            conn = self._connect()
+            pooled = PooledConnection(self, conn)
+            self._in_use[id(conn)] = pooled
+            return pooled
+    
+    def putconn(self, pooled: PooledConnection) -> None:
+        conn = pooled._conn
+        with self._lock:
+            if self._in_use.get(id(conn)) is not pooled:
+                return
+            del self._in_use[id(conn)]
+            try:
+                # Завершаем незакрытую транзакцию, чтобы следующий запрос начал с чистого состояния
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+            if conn.closed or len(self._idle) >= self.max_size:
+                self._discard(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+    
+    def release_all(self) -> None:
+        '''Вернуть в пул соединения, которые не были закрыты в ходе запроса'''
+        for pooled in list(self._in_use.values()):
+            pooled.close()
+
+db_pool = ConnectionPool(max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')))
+
+def get_db_connection() -> PooledConnection:
+    '''Выдает подключение к базе данных из пула'''
+    return db_pool.getconn()
+
+class EventLoopRunner:
+    '''Один event loop на весь контейнер: живет между тёплыми вызовами функции'''
+    
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop
+    
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+    
+    def shutdown(self) -> None:
+        if self._loop is None or self._loop.is_closed():
+            return
+        pending = [t for t in asyncio.all_tasks(self._loop) if not t.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self._loop.close()
+
+class TelegramSessionManager:
+    '''HTTP-сессии к api.telegram.org по токену бота: keep-alive соединения переживают вызовы'''
+    
+    def __init__(self, idle_ttl: float = 300.0, middlewares: Optional[list] = None):
+        self.idle_ttl = idle_ttl
+        self.middlewares = middlewares or []
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0}
+    
+    async def acquire(self, token: str) -> AiohttpSession:
+        '''Сессия для токена; заодно закрывает сессии, простаивающие дольше idle_ttl'''
+        await self.evict_idle()
+        key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        entry = self._sessions.get(key)
+        if entry:
+            self.stats['reused'] += 1
+        else:
+            self.stats['created'] += 1
+            session = AiohttpSession()
+            for middleware in self.middlewares:
+                session.middleware(middleware)
+            entry = {'session': session}
+            self._sessions[key] = entry
+        entry['last_used'] = time.monotonic()
+        return entry['session']
+    
+    async def evict_idle(self) -> None:
+        now = time.monotonic()
+        for key, entry in list(self._sessions.items()):
+            if now - entry['last_used'] >= self.idle_ttl:
+                del self._sessions[key]
+                self.stats['evicted'] += 1
+                await entry['session'].close()
+    
+    async def close_all(self) -> None:
+        for entry in self._sessions.values():
+            await entry['session'].close()
+        self._sessions.clear()
+
+class TokenBucket:
+    '''Корзина токенов; токены можно занимать в долг - долг и есть очередь ожидающих отправок'''
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self) -> float:
+        '''Занять токен и вернуть, сколько секунд ждать его появления (FIFO без блокировок)'''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def is_idle(self) -> bool:
+        '''Корзина снова полная - ее можно выбросить без потери ограничения'''
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class TelegramRateLimiter:
+    '''Ограничение исходящих сообщений по лимитам Telegram: на бота, на личный чат и на группу; 429 ждем retry_after'''
+    
+    # Методы, которые Telegram считает отправкой сообщения в чат
+    LIMITED_PREFIXES = ('send', 'copy', 'forward')
+    
+    def __init__(self, bot_rate: float = 30.0, chat_rate: float = 1.0, group_rate: float = 20 / 60,
+                 max_retries: int = 3, max_wait: float = 30.0):
+        self.bot_rate = bot_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self._bot_buckets: Dict[int, TokenBucket] = {}
+        self._chat_buckets: Dict[Tuple[int, Any], TokenBucket] = {}
+        # Бот получил 429: до этого момента его отправки ждут
+        self._paused_until: Dict[int, float] = {}
+        self.waiting = 0
+        self.stats = {'queued': 0, 'sent': 0, 'throttled': 0, 'dropped': 0}
+    
+    def _chat_bucket(self, bot_id: int, chat_id: Any) -> TokenBucket:
+        key = (bot_id, chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_idle()}
+            # Отрицательный chat_id и @username - группы и каналы, у них лимит ниже
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = TokenBucket(rate, 1 if is_group else 3)
+            self._chat_buckets[key] = bucket
+        return bucket
+    
+    def _reserve(self, bot_id: int, chat_id: Any) -> float:
+        bot_bucket = self._bot_buckets.get(bot_id)
+        if bot_bucket is None:
+            bot_bucket = self._bot_buckets[bot_id] = TokenBucket(self.bot_rate, self.bot_rate)
+        delay = bot_bucket.reserve()
+        if chat_id is not None:
+            delay = max(delay, self._chat_bucket(bot_id, chat_id).reserve())
+        return max(delay, self._paused_until.get(bot_id, 0.0) - time.monotonic())
+    
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        if not method.__api_method__.startswith(self.LIMITED_PREFIXES):
+            return await make_request(bot, method)
+        
+        chat_id = getattr(method, 'chat_id', None)
+        for attempt in range(self.max_retries + 1):
+            delay = self._reserve(bot.id, chat_id)
+            if delay > 0:
+                self.stats['queued'] += 1
+                self.waiting += 1
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    self.waiting -= 1
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats['throttled'] += 1
+                self._paused_until[bot.id] = max(self._paused_until.get(bot.id, 0.0), time.monotonic() + e.retry_after)
+                if attempt == self.max_retries or e.retry_after > self.max_wait:
+                    self.stats['dropped'] += 1
+                    print(f"[WARN] Telegram flood control for bot {bot.id}: {method.__api_method__} to {chat_id} dropped, retry_after={e.retry_after}")
+                    raise
+                continue
+            self.stats['sent'] += 1
+            return result
+
+telegram_rate_limiter = TelegramRateLimiter(
+    bot_rate=float(os.environ.get('TELEGRAM_BOT_RATE', '30')),
+    chat_rate=float(os.environ.get('TELEGRAM_CHAT_RATE', '1')),
+    group_rate=float(os.environ.get('TELEGRAM_GROUP_RATE', str(20 / 60))),
+    max_wait=float(os.environ.get('TELEGRAM_MAX_RETRY_WAIT', '30'))
+)
+
+loop_runner = EventLoopRunner()
+telegram_sessions = TelegramSessionManager(
+    idle_ttl=float(os.environ.get('TELEGRAM_SESSION_IDLE_TTL', '300')),
+    middlewares=[telegram_rate_limiter]
+)
+
+def _shutdown_runtime() -> None:
+    '''Закрыть сессии и event loop при остановке контейнера'''
+    try:
+        if loop_runner._loop is not None and not loop_runner._loop.is_closed():
+            loop_runner.run(telegram_sessions.close_all())
+        loop_runner.shutdown()
+    except Exception as e:
+        print(f"[ERROR] Runtime shutdown failed: {e}")
+
+atexit.register(_shutdown_runtime)
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -14,6 +302,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
           context - cloud function context
     Returns: HTTP response with reminder stats
     '''
+    # Соединения, не возвращенные прошлым вызовом (ранний return или исключение), возвращаем в пул
+    db_pool.release_all()
+    
     method: str = event.get('httpMethod', 'POST')
     
     if method == 'OPTIONS':
@@ -32,8 +323,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     # Get tomorrow's date (bookings to remind about)
     tomorrow = (datetime.now() + timedelta(days=1)).date()
     
-    database_url = os.environ.get('DATABASE_URL', '')
-    conn = psycopg2.connect(database_url)
+    conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     # Get all active bookings for tomorrow
@@ -57,17 +347,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     # Send reminders
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    sent_count = 0
-    for booking in bookings:
-        try:
-            result = loop.run_until_complete(send_reminder(booking))
-            if result:
-                sent_count += 1
-        except Exception as e:
-            print(f"Error sending reminder for booking {booking['id']}: {str(e)}")
+    sent_count = loop_runner.run(send_reminders(bookings))
     
     return {
         'statusCode': 200,
@@ -75,19 +355,41 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'body': json.dumps({
             'message': 'Reminders sent',
             'total_bookings': len(bookings),
-            'sent': sent_count
+            'sent': sent_count,
+            'telegram_rate_limiter': telegram_rate_limiter.stats
         }),
         'isBase64Encoded': False
     }
 
-async def send_reminder(booking: dict) -> bool:
-    '''Отправить напоминание пользователю и администраторам'''
-    bot_token = booking.get('telegram_token')
-    if not bot_token:
-        return False
-    
-    bot = Bot(token=bot_token)
+async def send_reminders(bookings: List[dict]) -> int:
+    '''Разослать напоминания: один Bot и одна HTTP-сессия на токен'''
+    bookings_by_token: Dict[str, List[dict]] = {}
+    for booking in bookings:
+        if booking.get('telegram_token'):
+            bookings_by_token.setdefault(booking['telegram_token'], []).append(booking)
     
+    # Боты рассылают параллельно: лимиты Telegram считаются на бота, их соблюдает telegram_rate_limiter
+    results = await asyncio.gather(*(
+        send_bot_reminders(bot_token, token_bookings)
+        for bot_token, token_bookings in bookings_by_token.items()
+    ))
+    return sum(results)
+
+async def send_bot_reminders(bot_token: str, bookings: List[dict]) -> int:
+    '''Напоминания одного бота по очереди'''
+    session = await telegram_sessions.acquire(bot_token)
+    bot = Bot(token=bot_token, session=session)
+    sent_count = 0
+    for booking in bookings:
+        try:
+            if await send_reminder(bot, booking):
+                sent_count += 1
+        except Exception as e:
+            print(f"Error sending reminder for booking {booking['id']}: {str(e)}")
+    return sent_count
+
+async def send_reminder(bot: Bot, booking: dict) -> bool:
+    '''Отправить напоминание пользователю и администраторам'''
     booking_date_str = booking['booking_date'].strftime('%d.%m.%Y')
     booking_time_str = str(booking['booking_time'])[:5]
     
@@ -142,5 +444,4 @@ async def send_reminder(booking: dict) -> bool:
         except Exception as e:
             print(f"Failed to send reminder to admin {admin_id}: {str(e)}")
     
-    await bot.session.close()
     return True
@@ -0,0 +1,9 @@
+-- Версия конфигурации бота: увеличивается при каждом изменении настроек,
+-- чтобы тёплые экземпляры функций сразу сбрасывали кэш настроек
+ALTER TABLE t_p5255237_telegram_bot_service.bots
+ADD COLUMN IF NOT EXISTS config_version INTEGER NOT NULL DEFAULT 1;
+
+-- Индекс для поиска бота по токену в telegram-webhook
+CREATE INDEX IF NOT EXISTS idx_bots_telegram_token ON t_p5255237_telegram_bot_service.bots(telegram_token);
+
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.bots.config_version IS 'Версия настроек бота для инвалидации кэша';
@@ -0,0 +1,3 @@
+-- Частичный индекс для списка активных ботов (GET telegram-bot-engine)
+CREATE INDEX IF NOT EXISTS idx_bots_active_approved ON t_p5255237_telegram_bot_service.bots(id)
+WHERE status = 'active' AND moderation_status = 'approved';
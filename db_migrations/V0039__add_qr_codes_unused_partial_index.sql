@@ -0,0 +1,4 @@
+-- Частичный индекс по свободным ключам: выдача ключа (UPDATE ... FOR UPDATE SKIP LOCKED)
+-- читает только неиспользованные коды и не замедляется по мере их расходования
+CREATE INDEX IF NOT EXISTS idx_qr_codes_unused ON t_p5255237_telegram_bot_service.qr_codes(bot_id, code_type, code_number)
+WHERE is_used = false;
@@ -0,0 +1,8 @@
+-- Аренда блоков свободных QR-ключей воркерами telegram-bot-engine:
+-- пока аренда не истекла, ключ выдает только воркер-владелец
+ALTER TABLE t_p5255237_telegram_bot_service.qr_codes
+ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(64),
+ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;
+
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.qr_codes.lease_owner IS 'Воркер, арендовавший свободный ключ';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.qr_codes.lease_expires_at IS 'Срок аренды; после него невыданный ключ снова доступен всем';
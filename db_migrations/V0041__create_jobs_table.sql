@@ -0,0 +1,35 @@
+-- Очередь отложенных задач (проверка платежей, выдача VIP-ключей), которую разбирает функция job-worker
+CREATE TABLE IF NOT EXISTS t_p5255237_telegram_bot_service.jobs (
+    id BIGSERIAL PRIMARY KEY,
+    job_type VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    last_error TEXT,
+    locked_by VARCHAR(64),
+    locked_at TIMESTAMP,
+    dedup_key VARCHAR(255) UNIQUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Выборка готовых к запуску задач читает только ожидающие
+CREATE INDEX IF NOT EXISTS idx_jobs_pending_run_at ON t_p5255237_telegram_bot_service.jobs(run_at)
+WHERE status = 'pending';
+
+-- Поиск зависших задач, воркер которых не завершился
+CREATE INDEX IF NOT EXISTS idx_jobs_running_locked_at ON t_p5255237_telegram_bot_service.jobs(locked_at)
+WHERE status = 'running';
+
+-- Идемпотентная выдача VIP-ключа по платежу: ключ закрепляется за платежом до отправки
+ALTER TABLE t_p5255237_telegram_bot_service.payments
+ADD COLUMN IF NOT EXISTS vip_qr_code_id INTEGER,
+ADD COLUMN IF NOT EXISTS vip_delivered_at TIMESTAMP;
+
+COMMENT ON TABLE t_p5255237_telegram_bot_service.jobs IS 'Очередь отложенных задач с повторами';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.jobs.status IS 'pending, running, done или failed';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.jobs.dedup_key IS 'Ключ для защиты от повторной постановки одной и той же задачи';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.payments.vip_qr_code_id IS 'VIP-ключ, закрепленный за оплаченным платежом';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.payments.vip_delivered_at IS 'Когда VIP-ключ отправлен пользователю';
@@ -0,0 +1,3 @@
+-- Сверка платежей выбирает только незавершенные платежи, упорядоченные по времени последней проверки
+CREATE INDEX IF NOT EXISTS idx_payments_reconcile_due ON t_p5255237_telegram_bot_service.payments(last_check_at NULLS FIRST)
+WHERE status IN ('NEW', 'AUTHORIZED');
@@ -0,0 +1,51 @@
+-- Рассылки владельцев ботов по пользователям бота (все или сегмент)
+CREATE TABLE IF NOT EXISTS t_p5255237_telegram_bot_service.broadcasts (
+    id SERIAL PRIMARY KEY,
+    bot_id INTEGER NOT NULL REFERENCES t_p5255237_telegram_bot_service.bots(id),
+    message_text TEXT NOT NULL,
+    segment VARCHAR(30) NOT NULL DEFAULT 'all',
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    sent_count INTEGER NOT NULL DEFAULT 0,
+    failed_count INTEGER NOT NULL DEFAULT 0,
+    blocked_count INTEGER NOT NULL DEFAULT 0,
+    locked_by VARCHAR(64),
+    locked_at TIMESTAMP,
+    created_by INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcasts_bot_id ON t_p5255237_telegram_bot_service.broadcasts(bot_id, created_at DESC);
+
+-- Разбор рассылок читает только незавершенные
+CREATE INDEX IF NOT EXISTS idx_broadcasts_active ON t_p5255237_telegram_bot_service.broadcasts(id)
+WHERE status IN ('pending', 'running');
+
+-- Результат доставки по каждому получателю: повторная отправка после сбоя пропускает уже доставленных
+CREATE TABLE IF NOT EXISTS t_p5255237_telegram_bot_service.broadcast_deliveries (
+    broadcast_id INTEGER NOT NULL REFERENCES t_p5255237_telegram_bot_service.broadcasts(id),
+    user_id INTEGER NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    error TEXT,
+    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (broadcast_id, user_id)
+);
+
+-- Пользователь заблокировал бота (Telegram ответил 403): в рассылки не попадает
+ALTER TABLE t_p5255237_telegram_bot_service.bot_users
+ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE,
+ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP;
+
+-- Получатели рассылки выбираются по bot_id упорядоченно по id (keyset-пагинация)
+CREATE INDEX IF NOT EXISTS idx_bot_users_bot_id_id ON t_p5255237_telegram_bot_service.bot_users(bot_id, id)
+WHERE is_blocked IS NOT TRUE;
+
+COMMENT ON TABLE t_p5255237_telegram_bot_service.broadcasts IS 'Рассылки сообщений пользователям бота';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.broadcasts.segment IS 'all, free_qr, vip_qr или no_vip';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.broadcasts.status IS 'pending, running, done или canceled';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.broadcasts.last_user_id IS 'Контрольная точка: id последнего обработанного bot_users';
+COMMENT ON TABLE t_p5255237_telegram_bot_service.broadcast_deliveries IS 'Статус доставки рассылки каждому получателю';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.broadcast_deliveries.status IS 'sent, failed или blocked';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.bot_users.is_blocked IS 'Пользователь заблокировал бота';
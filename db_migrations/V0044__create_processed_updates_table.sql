@@ -0,0 +1,12 @@
+-- Обработанные Update от Telegram: повторная доставка webhook не запускает обработчики второй раз
+CREATE TABLE IF NOT EXISTS t_p5255237_telegram_bot_service.processed_updates (
+    bot_id INTEGER NOT NULL,
+    update_id BIGINT NOT NULL,
+    processed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (bot_id, update_id)
+);
+
+-- Удаление записей старше срока хранения
+CREATE INDEX IF NOT EXISTS idx_processed_updates_processed_at ON t_p5255237_telegram_bot_service.processed_updates(processed_at);
+
+COMMENT ON TABLE t_p5255237_telegram_bot_service.processed_updates IS 'Идемпотентность обработки Update по (bot_id, update_id); хранится ограниченное время';
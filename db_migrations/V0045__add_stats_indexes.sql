@@ -0,0 +1,13 @@
+-- Индексы для статистики администратора (handle_stats в telegram-webhook)
+
+-- Номер выданного пользователю ключа: поиск по used_by_user_id вместо просмотра всех ключей бота
+CREATE INDEX IF NOT EXISTS idx_qr_codes_used_by_user ON t_p5255237_telegram_bot_service.qr_codes(used_by_user_id, code_type)
+WHERE used_by_user_id IS NOT NULL;
+
+-- Телефон из последнего подтвержденного платежа пользователя
+CREATE INDEX IF NOT EXISTS idx_payments_confirmed_user ON t_p5255237_telegram_bot_service.payments(bot_id, telegram_user_id, created_at DESC)
+WHERE status = 'CONFIRMED';
+
+-- Список пользователей, получивших ключи, в порядке регистрации
+CREATE INDEX IF NOT EXISTS idx_bot_users_received_qr ON t_p5255237_telegram_bot_service.bot_users(bot_id, id)
+WHERE received_free_qr = true OR received_vip_qr = true;
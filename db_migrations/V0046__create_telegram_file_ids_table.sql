@@ -0,0 +1,13 @@
+-- file_id картинок, уже загруженных в Telegram: повторная отправка того же QR-кода или фото товара
+-- передает file_id вместо повторной загрузки файла (file_id действует только для бота, который его получил)
+CREATE TABLE IF NOT EXISTS t_p5255237_telegram_bot_service.telegram_file_ids (
+    bot_id INTEGER NOT NULL,
+    asset_key VARCHAR(255) NOT NULL,
+    file_id VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (bot_id, asset_key)
+);
+
+COMMENT ON TABLE t_p5255237_telegram_bot_service.telegram_file_ids IS 'Кэш Telegram file_id отправленных картинок по (bot_id, asset_key)';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.telegram_file_ids.asset_key IS 'qr:<ключ кэша QR-картинки> или url:<sha256 адреса картинки>';
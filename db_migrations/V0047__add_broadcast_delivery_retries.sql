@@ -0,0 +1,12 @@
+-- Временные ошибки доставки (429 после всех повторов, 5xx, сеть) не окончательные: получатель
+-- записывается со статусом retry и получает рассылку повторно, пока не кончатся попытки
+ALTER TABLE t_p5255237_telegram_bot_service.broadcast_deliveries
+ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 1;
+
+-- Повторный проход читает только ожидающих повтора
+CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_retry ON t_p5255237_telegram_bot_service.broadcast_deliveries(broadcast_id, user_id)
+WHERE status = 'retry';
+
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.broadcast_deliveries.status IS 'sent, failed, blocked или retry (ждет повторной отправки)';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.broadcast_deliveries.attempts IS 'Сколько раз пытались доставить';
+COMMENT ON COLUMN t_p5255237_telegram_bot_service.broadcast_deliveries.sent_at IS 'Время последней попытки';